@@ -14,6 +14,7 @@ import hashlib
 import re
 from shapely.geometry import Polygon
 from Pipeline.logger import log
+from Pipeline.Runtime import runtime
 from Pipeline.utils import bands_for_resolution
 import datetime
 from Pipeline.utils import extract_mercator, is_dir_valid
@@ -246,7 +247,7 @@ class Downloader:
         self.__before_download()
         data = list(self.__get_next_download())
         paths = []
-        with ThreadPoolExecutor(max_workers=5) as executor:
+        with ThreadPoolExecutor(max_workers=runtime.pool_size(5)) as executor:
             for mercator, entries in data:
                 path = self.root_path + mercator
                 executor.submit(self.__download_data, entries, path, bands, primary_spatial_res)
@@ -10,6 +10,7 @@ from rasterio.warp import calculate_default_transform, reproject
 import subprocess
 from shapely.geometry import Polygon
 from rasterio.mask import mask
+from Pipeline.Expression import BandExpr
 gdal.UseExceptions()
 
 
@@ -23,6 +24,8 @@ class Band:
                 slice_index = find_closest_slice(slice_index)
 
         self.path = path
+        #  File the band was read from before the resampling, e.g. 20m SCL of a granule at 10m
+        self.native_path = path
         self.profile = None
         with rasterio.open(self.path) as dataset:
             self.profile = dataset.profile
@@ -34,6 +37,38 @@ class Band:
         self.__rasterio_reference = None
         self.polygon = None
 
+    @staticmethod
+    def from_array(data: np.ndarray, profile: dict) -> 'Band':
+        """
+        Band backed by an array instead of a file, e.g. a result that has not been persisted yet.
+        :param data: 2D array
+        :param profile: rasterio profile the data belong to (transformation, projection)
+        """
+        band = Band.__new__(Band)
+        band.path = None
+        band.native_path = None
+        band.profile = dict(profile)
+        band.profile.update(width=data.shape[1], height=data.shape[0], dtype=data.dtype.name, count=1)
+        band.slice_index = 1
+        band.raster_image = data
+        band._was_raster_read = True
+        band._Band__rasterio_reference = None
+        band.polygon = None
+        return band
+
+    @property
+    def in_memory(self) -> bool:
+        return self.path is None
+
+    def attach_file(self, path: str) -> None:
+        """
+        Persisted in-memory band, it is read from the file from now on. The array is kept until free_resources.
+        """
+        self.path = path
+        self.native_path = path
+        with rasterio.open(self.path) as dataset:
+            self.profile = dataset.profile
+
     def load_raster(self) -> None:
         """
         Since the raster images might be quite big,
@@ -60,6 +95,15 @@ class Band:
             self.__rasterio_reference = rasterio.open(self.path)
         return self.__rasterio_reference
 
+    def read_window(self, window) -> np.ndarray:
+        """
+        Read only the window of the raster, the whole image is never loaded.
+        :param window: rasterio window
+        """
+        if self.in_memory:
+            return self.raster_image[window.toslices()] if window is not None else self.raster_image
+        return self.rasterio_ref().read(1, window=window)
+
     def raster(self) -> np.array:
         """
         Basic getter.
@@ -107,6 +151,7 @@ class Band:
         if delete:
             os.remove(self.path)
         self.path = new_path
+        self.native_path = new_path
         with rasterio.open(self.path) as dataset:
             self.profile = dataset.profile
         return new_path
@@ -142,13 +187,30 @@ class Band:
         if delete:
             os.remove(self.path)
         self.path = self.path + "_res" + ext
+        if delete:
+            self.native_path = self.path
+
+    def is_loaded(self) -> bool:
+        return self._was_raster_read
+
+    def expr(self) -> BandExpr:
+        """
+        Lazy expression of the band, e.g. (band.expr() > 100).evaluate(), see BandExpr.
+        """
+        return BandExpr.band(self)
 
     def free_resources(self) -> None:
         """
         Delete the pointers to the data and call garbage collector to free the memory.
+        In-memory band has nothing to reload the data from, it keeps them.
         """
+        if self.in_memory:
+            return
         self.raster_image = None
         self._was_raster_read = False
+        if self.__rasterio_reference is not None:
+            self.__rasterio_reference.close()
+            self.__rasterio_reference = None
 
     def __del__(self):
         if self.__rasterio_reference is not None:
@@ -158,10 +220,10 @@ class Band:
         """
         :param other: threshold value
         """
-        return np.copy(self.raster()) > other
+        return self.raster() > other
 
     def __lt__(self, other: int):
         """
         :param other: threshold value
         """
-        return np.copy(self.raster()) < other
+        return self.raster() < other
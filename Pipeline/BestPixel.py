@@ -0,0 +1,196 @@
+"""
+Generic best-pixel compositing engine with pluggable compiled scorers
+"""
+from typing import List, Dict, Callable, Tuple
+
+import numpy as np
+from numba import njit, prange
+
+from Pipeline.logger import log
+
+
+@njit
+def ndvi_score(f, doy, params):
+    """
+    f = [B8A, B04], the greenest pixel wins.
+    """
+    den = f[0] + f[1]
+    if den == 0:
+        return -np.inf
+    return (f[0] - f[1]) / den
+
+
+@njit
+def cloud_probability_score(f, doy, params):
+    """
+    f = [probability], params = [nodata], the least cloudy pixel wins.
+    """
+    if f[0] >= params[0]:
+        return -np.inf
+    return -f[0]
+
+
+@njit
+def doy_distance_score(f, doy, params):
+    """
+    params = [target DOY], the pixel closest to the target date wins.
+    """
+    return -abs(doy - params[0])
+
+
+@njit
+def aot_score(f, doy, params):
+    """
+    f = [AOT], the pixel with the lowest aerosol optical thickness wins.
+    """
+    if f[0] == 0:
+        return -np.inf
+    return -f[0]
+
+
+@njit
+def weighted_cloud_score(f, doy, params):
+    """
+    f = [probability], params = [nodata, probability weight, DOY weight, target DOY].
+    Cloud probability penalized by the distance to the target date.
+    """
+    if f[0] >= params[0]:
+        return -np.inf
+    return -(params[1] * f[0] + params[2] * abs(doy - params[3]))
+
+
+class Scorer:
+    """
+    Per-pixel score of a candidate, higher wins.
+    The function is an njit function (features, doy, params) -> float, where features are the values of `bands`
+    at the pixel. -inf or NaN marks an invalid candidate.
+    """
+
+    def __init__(self, name: str, function: Callable, bands: Tuple[str, ...] = (), params: Tuple[float, ...] = (),
+                 quality_gain: float = 1.0, quality_offset: float = 0.0):
+        """
+        :param name: identifier, kernels are cached by the function
+        :param function: njit scoring function
+        :param bands: feature bands, "PROB" stands for the s2cloudless probability
+        :param params: default parameters of the function
+        :param quality_gain: quality output is score * gain + offset, clipped to uint16
+        :param quality_offset: see quality_gain
+        """
+        self.name = name
+        self.function = function
+        self.bands = tuple(bands)
+        self.params = tuple(params)
+        self.quality_gain = quality_gain
+        self.quality_offset = quality_offset
+
+    def __repr__(self):
+        return f"Scorer({self.name}, bands: {self.bands}, params: {self.params})"
+
+
+class Scorers:
+    NDVI = Scorer("ndvi", ndvi_score, ("B8A", "B04"), quality_gain=10000, quality_offset=10000)
+    CLOUD_PROBABILITY = Scorer("cloud_probability", cloud_probability_score, ("PROB",), (255,), quality_gain=-1)
+    DOY_DISTANCE = Scorer("doy_distance", doy_distance_score, (), (182,), quality_gain=-1)
+    AOT = Scorer("aot", aot_score, ("AOT",), quality_gain=-1)
+    WEIGHTED_CLOUD = Scorer("weighted_cloud", weighted_cloud_score, ("PROB",), (255, 1.0, 0.5, 182), quality_gain=-1)
+
+    @staticmethod
+    def get(name: str) -> Scorer:
+        for scorer in [Scorers.NDVI, Scorers.CLOUD_PROBABILITY, Scorers.DOY_DISTANCE, Scorers.AOT,
+                       Scorers.WEIGHTED_CLOUD]:
+            if scorer.name == name:
+                return scorer
+        raise ValueError(f"Unknown scorer {name}")
+
+
+# score function -> compiled kernel, scorers with the same name may have different functions
+_kernels: Dict[Callable, Callable] = {}
+
+
+def _compile(scorer: Scorer) -> Callable:
+    score = scorer.function
+    if score in _kernels:
+        return _kernels[score]
+
+    @njit(parallel=True)
+    def kernel(data, features, doys, params, tie, best, result, doy):
+        n, bands, height, width = data.shape
+        for y in prange(height):
+            for x in range(width):
+                for i in range(n):
+                    # no data in any of the bands
+                    empty = True
+                    for k in range(bands):
+                        if data[i, k, y, x] != 0:
+                            empty = False
+                            break
+                    if empty:
+                        continue
+                    s = score(features[i, :, y, x], doys[i], params)
+                    if not s > -np.inf:
+                        continue
+                    if s > best[y, x] or (s == best[y, x] and ((tie > 0 and doys[i] > doy[y, x]) or
+                                                               (tie < 0 and doys[i] < doy[y, x]))):
+                        best[y, x] = s
+                        doy[y, x] = doys[i]
+                        for k in range(bands):
+                            result[k, y, x] = data[i, k, y, x]
+
+    log.debug(f"Compiling best-pixel kernel for {scorer}")
+    _kernels[score] = kernel
+    return kernel
+
+
+class BestPixelEngine:
+    """
+    Picks the best candidate for each pixel by the score of the scorer.
+    Candidates are added in batches, the state (best score, picked values, DOY) is kept between them.
+    Ties are broken per pixel by the date: "latest", "earliest" or "first" (first added candidate stays).
+    """
+    ties = {"latest": 1, "earliest": -1, "first": 0}
+
+    def __init__(self, scorer: Scorer, bands: int, shape: Tuple[int, int], params: Tuple[float, ...] = None,
+                 tie: str = "latest"):
+        """
+        :param scorer: e.g. Scorers.NDVI
+        :param bands: number of output bands
+        :param shape: shape of the bands
+        :param params: parameters of the scorer, scorer defaults by default
+        :param tie: tie-breaking rule
+        """
+        if tie not in BestPixelEngine.ties:
+            raise ValueError(f"Tie-breaking has to be one of {list(BestPixelEngine.ties)}")
+        self.scorer = scorer
+        self.params = np.asarray(params if params is not None else scorer.params, dtype=np.float64)
+        self.tie = BestPixelEngine.ties[tie]
+        self.kernel = _compile(scorer)
+        self.score = np.full(shape, -np.inf, dtype=np.float64)
+        self.result = np.zeros(shape=(bands,) + tuple(shape), dtype=np.uint16)
+        self.doy = np.zeros(shape, dtype=np.uint16)
+
+    def add(self, data: List[np.ndarray], features: List[Dict[str, np.ndarray]], doys: List[int]) -> None:
+        """
+        :param data: stacked bands of each candidate (bands, height, width)
+        :param features: feature bands (scorer.bands) of each candidate
+        :param doys: DOY of each candidate
+        """
+        if len(data) == 0:
+            return
+        stacked = np.stack(data).astype(np.uint16, copy=False)
+        shape = (len(data), len(self.scorer.bands)) + self.score.shape
+        stacked_features = np.empty(shape=shape, dtype=np.float32)
+        for i, candidate in enumerate(features):
+            for j, band in enumerate(self.scorer.bands):
+                stacked_features[i, j] = candidate[band]
+        self.kernel(stacked, stacked_features, np.asarray(doys, dtype=np.int64), self.params, self.tie,
+                    self.score, self.result, self.doy)
+
+    def quality(self) -> np.ndarray:
+        """
+        Score of the picked pixels mapped to uint16 by the gain and offset of the scorer, 0 where nothing was picked.
+        """
+        picked = np.isfinite(self.score)
+        quality = np.zeros(self.score.shape, dtype=np.uint16)
+        values = self.score[picked] * self.scorer.quality_gain + self.scorer.quality_offset
+        quality[picked] = np.clip(np.round(values), 0, 65535)
+        return quality
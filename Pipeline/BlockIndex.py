@@ -0,0 +1,81 @@
+import numpy as np
+import rasterio
+from typing import Tuple, Optional
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+
+class S2BlockIndex:
+    """
+    Coarse validity index of a granule.
+    Band is decoded at the reduced resolution (60m by default), which is cheap for JPEG2000 because the decoder
+    touches only the lower resolution levels. Readers and kernels use the index to skip windows without data.
+    """
+
+    def __init__(self, path: Optional[str], shape: Tuple[int, int], coarse_shape: Tuple[int, int] = (1830, 1830),
+                 data: np.ndarray = None):
+        """
+        :param path: raster where no data is represented by 0, SCL is preferred
+        :param shape: shape of the raster the windows are queried for (working resolution)
+        :param coarse_shape: shape of the index
+        :param data: raster in memory, used instead of the path (see Band.from_array)
+        """
+        coarse_shape = (min(coarse_shape[0], shape[0]), min(coarse_shape[1], shape[1]))
+        if data is not None:
+            rows = ((np.arange(coarse_shape[0]) + 0.5) * data.shape[0] / coarse_shape[0]).astype(np.intp)
+            cols = ((np.arange(coarse_shape[1]) + 0.5) * data.shape[1] / coarse_shape[1]).astype(np.intp)
+            valid = data[np.ix_(rows, cols)] > 0
+        else:
+            with rasterio.open(path) as dataset:
+                valid = dataset.read(1, out_shape=coarse_shape, resampling=Resampling.nearest) > 0
+        #  Nearest decimation might miss a thin strip of data at the edge of the swath, each cell therefore takes
+        #  its neighbours into account as well. The index may over-report data but never under-report it.
+        self.valid = S2BlockIndex._dilate(valid)
+        self.shape = shape
+        self.scale_y = shape[0] / coarse_shape[0]
+        self.scale_x = shape[1] / coarse_shape[1]
+        #  Summed-area table, any window is answered with four lookups
+        self._integral = np.pad(self.valid.astype(np.uint32).cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+
+    @staticmethod
+    def _dilate(valid: np.ndarray) -> np.ndarray:
+        padded = np.pad(valid, 1)
+        result = np.zeros_like(valid)
+        h, w = valid.shape
+        for dy in range(3):
+            for dx in range(3):
+                result |= padded[dy:dy + h, dx:dx + w]
+        return result
+
+    def _to_coarse(self, window: Optional[Window]) -> Tuple[int, int, int, int]:
+        """
+        Map window in working resolution to the (inclusive) cells of the index that cover it.
+        """
+        if window is None:
+            return 0, 0, self.valid.shape[0], self.valid.shape[1]
+        y0 = int(window.row_off // self.scale_y)
+        x0 = int(window.col_off // self.scale_x)
+        y1 = int(np.ceil((window.row_off + window.height) / self.scale_y))
+        x1 = int(np.ceil((window.col_off + window.width) / self.scale_x))
+        y0, x0 = min(max(y0, 0), self.valid.shape[0] - 1), min(max(x0, 0), self.valid.shape[1] - 1)
+        y1, x1 = min(max(y1, y0 + 1), self.valid.shape[0]), min(max(x1, x0 + 1), self.valid.shape[1])
+        return y0, x0, y1, x1
+
+    def count(self, window: Window = None) -> int:
+        """
+        Number of valid cells of the index that intersect the window.
+        """
+        y0, x0, y1, x1 = self._to_coarse(window)
+        s = self._integral
+        return int(s[y1, x1] - s[y0, x1] - s[y1, x0] + s[y0, x0])
+
+    def has_data(self, window: Window = None) -> bool:
+        """
+        :param window: rasterio window in working resolution, None stands for the whole granule
+        :return: False only if the window is entirely no data
+        """
+        return self.count(window) > 0
+
+    def valid_fraction(self, window: Window = None) -> float:
+        y0, x0, y1, x1 = self._to_coarse(window)
+        return self.count(window) / ((y1 - y0) * (x1 - x0))
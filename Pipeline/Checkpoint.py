@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import time
+from typing import Tuple, Union, List
+
+import numpy as np
+
+from Pipeline.logger import log
+
+
+class Checkpoint:
+    """
+    Progress of a running task, kept in <dataset>/result_checkpoint until the task finishes.
+    Intermediate arrays are memory-mapped .npy files and progress.json lists the completed steps
+    (batches, windows), a restarted task with the same configuration skips them and continues.
+    Small steps (e.g. median windows) are flushed in groups, every flush_steps steps or flush_seconds seconds,
+    steps which were not flushed yet are computed again after a restart.
+    Checkpoint without a path is disabled, arrays live in memory and nothing is written.
+    """
+    directory = "result_checkpoint"
+    progress_file = "progress.json"
+
+    def __init__(self, path: str = None, fingerprint: dict = None, flush_steps: int = 1, flush_seconds: float = None):
+        """
+        :param path: checkpoint directory, None disables checkpointing
+        :param fingerprint: configuration of the task, progress of a different configuration is discarded
+        :param flush_steps: flush after this many steps
+        :param flush_seconds: flush when this many seconds passed since the last flush, None disables it
+        """
+        self.path = path
+        self.flush_steps = max(1, flush_steps)
+        self.flush_seconds = flush_seconds
+        self._unflushed = 0
+        self._flushed_at = time.monotonic()
+        # json round trip, so that tuples compare equal to the loaded lists
+        self.fingerprint = json.loads(json.dumps(fingerprint or {}))
+        self.done = set()
+        self.arrays = {}
+        if self.path is None:
+            return
+        progress_file = self.path + os.path.sep + Checkpoint.progress_file
+        if os.path.isfile(progress_file):
+            with open(progress_file) as f:
+                meta = json.load(f)
+            if meta["fingerprint"] == self.fingerprint:
+                self.done = set(meta["done"])
+                log.info(f"Resuming from checkpoint {self.path}, completed steps: {len(self.done)}")
+            else:
+                log.warning(f"Checkpoint {self.path} belongs to a different configuration, starting over")
+                shutil.rmtree(self.path)
+        elif os.path.isdir(self.path):
+            #  Arrays without progress are not trustworthy
+            shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def for_worker(worker, task: str, granules: List, flush_steps: int = 1, flush_seconds: float = None,
+                   **params) -> 'Checkpoint':
+        """
+        :param worker: s2worker of the task
+        :param task: name of the task
+        :param granules: granules processed by the task, in the order of processing
+        :param flush_steps: see Checkpoint
+        :param flush_seconds: see Checkpoint
+        :param params: other parameters which change the computation, e.g. constraint
+        """
+        fingerprint = {"task": task, "spatial_resolution": worker.spatial_resolution,
+                       "output_bands": list(worker.output_bands),
+                       "granules": [os.path.basename(os.path.normpath(g.path)) for g in granules], **params}
+        return Checkpoint(worker.main_dataset_path + os.path.sep + Checkpoint.directory, fingerprint, flush_steps,
+                          flush_seconds)
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    @property
+    def resumed(self) -> bool:
+        return len(self.done) > 0
+
+    def array(self, name: str, shape: Tuple, dtype, fill: Union[int, float, np.ndarray] = 0) -> np.ndarray:
+        """
+        Intermediate array of the task. Resumed checkpoint returns the array as it was left,
+        otherwise a new one is created and filled.
+        :param fill: initial value, scalar or array of the shape
+        """
+        if not self.enabled:
+            if isinstance(fill, np.ndarray):
+                return fill.astype(dtype, copy=False)
+            return np.full(shape, fill, dtype=dtype)
+        path = self.path + os.path.sep + name + ".npy"
+        if self.resumed and os.path.isfile(path):
+            array = np.lib.format.open_memmap(path, mode="r+")
+            if array.shape != tuple(shape) or array.dtype != np.dtype(dtype):
+                raise ValueError(f"Checkpoint array {name} is {array.shape} {array.dtype}, expected {shape} {dtype}")
+        else:
+            array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(shape))
+            array[...] = fill
+        self.arrays[name] = array
+        return array
+
+    def is_done(self, step: str) -> bool:
+        return step in self.done
+
+    def mark_done(self, step: str) -> None:
+        """
+        Record the step, it is flushed together with the other steps of its group (see flush).
+        """
+        self.done.add(step)
+        if not self.enabled:
+            return
+        self._unflushed += 1
+        if self._unflushed >= self.flush_steps or \
+                (self.flush_seconds is not None and time.monotonic() - self._flushed_at >= self.flush_seconds):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Flush the arrays and record the steps, a step counts as done only after its data are on the disk.
+        """
+        self._unflushed = 0
+        self._flushed_at = time.monotonic()
+        if not self.enabled:
+            return
+        for array in self.arrays.values():
+            array.flush()
+        progress_file = self.path + os.path.sep + Checkpoint.progress_file
+        with open(progress_file + ".tmp", "w") as f:
+            json.dump({"fingerprint": self.fingerprint, "done": sorted(self.done)}, f)
+        os.replace(progress_file + ".tmp", progress_file)
+
+    def remove(self) -> None:
+        """
+        Task is finished, drop the checkpoint.
+        """
+        self.arrays = {}
+        if self.enabled and os.path.isdir(self.path):
+            shutil.rmtree(self.path)
@@ -0,0 +1,132 @@
+import json
+import os
+import shutil
+from typing import List, Dict, Optional, Tuple
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from Pipeline.logger import log
+
+
+class CompositeState:
+    """
+    Per-pixel state of a composite, persisted in <dataset>/result_state next to the result.
+    It holds the score that decides the winning pixel (e.g. max NDVI, min cloud probability) and the names of the
+    granules that are already folded into the result, the winning values and DOY are the result files themselves.
+    New granules are then folded into the existing result without reprocessing the old ones.
+    """
+    directory = "result_state"
+    state_file = "state.json"
+
+    def __init__(self, path: str, task: str, spatial_resolution: int, output_bands: List[str],
+                 processed: List[str] = None, arrays: Dict[str, np.ndarray] = None):
+        """
+        :param path: state directory
+        :param task: name of the task, state of one task is not usable by another
+        :param spatial_resolution: working resolution of the result
+        :param output_bands: bands of the result
+        :param processed: names of the granules (SAFE directories) which are in the result
+        :param arrays: name -> array, e.g. {"score": ndvi_result}
+        """
+        self.path = path
+        self.task = task
+        self.spatial_resolution = spatial_resolution
+        self.output_bands = list(output_bands)
+        self.processed = list(processed) if processed is not None else []
+        self.arrays = arrays if arrays is not None else {}
+
+    @staticmethod
+    def state_path(worker) -> str:
+        return worker.main_dataset_path + os.path.sep + CompositeState.directory
+
+    @staticmethod
+    def granule_name(granule) -> str:
+        return os.path.basename(os.path.normpath(granule.path))
+
+    @staticmethod
+    def load(worker, task: str) -> Optional['CompositeState']:
+        """
+        Load the state of the previous run.
+        :return: None if there is no state or it does not match the worker (task, resolution, bands)
+        """
+        path = CompositeState.state_path(worker)
+        state_file = path + os.path.sep + CompositeState.state_file
+        if not os.path.isfile(state_file):
+            log.info(f"No composite state in {path}, all granules are going to be processed")
+            return None
+        if not os.path.isdir(worker.save_result_path) and not os.path.isdir(worker.save_result_path + "_previous"):
+            log.warning(f"Composite state in {path} has no result, it is going to be replaced")
+            return None
+        with open(state_file) as f:
+            meta = json.load(f)
+        if meta["task"] != task or meta["spatial_resolution"] != worker.spatial_resolution or \
+                meta["output_bands"] != list(worker.output_bands):
+            log.warning(f"Composite state in {path} belongs to a different computation ({meta['task']}, "
+                        f"{meta['spatial_resolution']}m, {meta['output_bands']}), it is going to be replaced")
+            return None
+        arrays = {name: np.load(path + os.path.sep + name + ".npy") for name in meta["arrays"]}
+        return CompositeState(path, task, meta["spatial_resolution"], meta["output_bands"], meta["processed"], arrays)
+
+    def new_granules(self, granules: list) -> list:
+        """
+        Granules which are not folded into the result yet.
+        """
+        return [g for g in granules if CompositeState.granule_name(g) not in self.processed]
+
+    def update(self, granules: list, arrays: Dict[str, np.ndarray]) -> None:
+        for g in granules:
+            name = CompositeState.granule_name(g)
+            if name not in self.processed:
+                self.processed.append(name)
+        self.arrays = arrays
+
+    def save(self) -> None:
+        """
+        Arrays are written first and the state file last, an interrupted save leaves the previous state file,
+        folding the same granule in twice does not change the result.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        for name, array in self.arrays.items():
+            np.save(self.path + os.path.sep + name + ".npy", array)
+        meta = {"task": self.task, "spatial_resolution": self.spatial_resolution, "output_bands": self.output_bands,
+                "processed": self.processed, "arrays": list(self.arrays.keys())}
+        state_file = self.path + os.path.sep + CompositeState.state_file
+        with open(state_file + ".tmp", "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(state_file + ".tmp", state_file)
+        log.info(f"Composite state saved to {self.path}, granules: {len(self.processed)}")
+
+    @staticmethod
+    def stash_result(worker) -> Optional[str]:
+        """
+        Move the previous result aside, the new result is written to the same directory.
+        A stash left by an interrupted run is the result the state belongs to, it is reused and the partial
+        result is dropped.
+        :return: path to the previous result or None
+        """
+        previous = worker.save_result_path + "_previous"
+        if os.path.isdir(previous):
+            if os.path.isdir(worker.save_result_path):
+                shutil.rmtree(worker.save_result_path)
+        elif os.path.isdir(worker.save_result_path):
+            os.rename(worker.save_result_path, previous)
+        return previous if os.path.isdir(previous) else None
+
+    @staticmethod
+    def result_file(result_path: str, key: str, spatial_resolution: int) -> str:
+        return result_path + os.path.sep + key + "_" + str(spatial_resolution) + ".tif"
+
+    @staticmethod
+    def read_result(result_path: str, keys: List[str], spatial_resolution: int,
+                    window: Window = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Read the bands and DOY of the previous result.
+        :return: stacked bands (uint16) and DOY
+        """
+        def read(key: str) -> np.ndarray:
+            with rasterio.open(CompositeState.result_file(result_path, key, spatial_resolution)) as src:
+                return src.read(1, window=window)
+
+        return np.stack([read(key) for key in keys]).astype(np.uint16, copy=False), read("DOY").astype(np.uint16)
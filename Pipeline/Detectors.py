@@ -1,14 +1,19 @@
 import logging
 import os
-import skimage.transform
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from Download.DownloadExceptions import IncorrectInput
 from Pipeline.Granule import S2Granule
 from Pipeline.GranuleCalculator import GranuleCalculator
 import numpy as np
+import rasterio
 from Pipeline.logger import log
-from typing import List
-from Pipeline.utils import extract_mercator, s2_get_resolution, slice_raster, glue_raster
+from Pipeline.Mask import CoarseMask, S2JIT
+from Pipeline.Runtime import runtime
+from Pipeline.Precision import precision
+from typing import List, Dict, Optional, Iterator, Union
+from Pipeline.utils import extract_mercator, s2_get_resolution, slice_raster, slice_window, glue_raster, \
+    upsample_nearest
 from Download.Sentinel2 import Downloader
 from skimage.exposure import rescale_intensity
 from s2cloudless import S2PixelCloudDetector
@@ -51,17 +56,25 @@ class S2Detectors:
         # linear transformation
         return 1.5 * (ndvi + 1)
 
-    # TODO: After some generalization add l1c
     @staticmethod
-    def sentinel_cloudless(g: S2Granule, probability: bool = False) -> np.ndarray:
+    def _no_data(g: S2Granule, lazy: bool = False) -> Union[np.ndarray, CoarseMask]:
         """
-        Cloud detection based on machine learning algorithm by SentinelHub.
-        Granule is identified and accompanying L1C dataset is downloaded and mas computed.
-        In future we might save these mask and use them but for now we will download the data and compute the mask
-        over and over.
-        @param g - granule.
-        @param probability - if we want the function to return probability mask instead of 0,1,255 mask
-        :return: based on the probability parameter, we return either mask of 0,1,255 or probability mask <0, 255>
+        Mask of the granule that is automatically discarded (taken as cloudy).
+        """
+        if lazy:
+            return CoarseMask(np.full(shape=(1, 1), fill_value=255, dtype=precision.probability),
+                              s2_get_resolution(g.spatial_resolution))
+        res = np.full(shape=(s2_get_resolution(g.spatial_resolution)), fill_value=255, dtype=precision.probability)
+        if g.slice_index > 1:
+            return slice_raster(g.slice_index, res)
+        return res
+
+    @staticmethod
+    def _prepare_l1c(g: S2Granule) -> Optional[np.ndarray]:
+        """
+        Identify the granule, download the accompanying L1C dataset and prepare the data for s2cloudless.
+        @param g - granule
+        :return: stacked L1C data in 160m, None if the L1C dataset is not available
         """
         # Workspace preparation phase
         working_path = g.path + os.path.sep + "L1C"
@@ -69,8 +82,7 @@ class S2Detectors:
             os.mkdir(working_path)
         except NotImplementedError:
             log.error("Error while creating mask for {}".format(g.path))
-            #  Automatically discarded (taken as cloudy)
-            return np.ones(shape=(s2_get_resolution(g.spatial_resolution))) * 255  # no data
+            return None
 
         #  Data preparation phase
         #  We find the accompanying tile with data-take and mercator
@@ -82,10 +94,7 @@ class S2Detectors:
                                     product_type="S2MSI1C", mercator_tiles=[mercator])
         except IncorrectInput:
             log.error("Did not find corresponding l1c this dataset wont be taken")
-            res = np.ones(shape=(s2_get_resolution(g.spatial_resolution))) * 255
-            if g.slice_index > 1:
-                return slice_raster(g.slice_index, res)
-            return res
+            return None
 
         necessary_bands = ["B01", "B02", "B04", "B05", "B08", "B8A", "B09", "B10", "B11", "B12"]
         #  This is generalized download, in this case we expect only one iteration
@@ -94,20 +103,24 @@ class S2Detectors:
 
         # Data will be automatically resampled during the creation of the granule
         l1c_granule = S2Granule(l1c_raster, 160, necessary_bands, granule_type="L1C")
-
-        #  Cloudless time, compute mask
-        data = l1c_granule.stack_bands(necessary_bands, dstack=True) / 10000.0
+        data = precision.scale_reflectance(l1c_granule.stack_bands(necessary_bands, dstack=True))
         l1c_granule.free_resources()
+        return data
 
-        cloud_detector = S2PixelCloudDetector()
-        product = None
-        if probability:
-            product = cloud_detector.get_cloud_probability_maps(data)
-        else:
-            product = cloud_detector.get_cloud_masks(data)
+    @staticmethod
+    def _finalize_cloudless(g: S2Granule, product: np.ndarray, probability: bool = False,
+                            lazy: bool = False) -> Union[np.ndarray, CoarseMask]:
+        """
+        Bring the 160m s2cloudless product to the working resolution of the granule and mark no data.
+        Product is converted to the probability type of the precision policy (percent in uint8 by default).
+        Lazy mask stays in 160m, no data is left to the kernel (see CoarseMask).
+        """
+        product = precision.cloud_mask(product, probability)
+        if lazy:
+            return CoarseMask(product, s2_get_resolution(g.spatial_resolution))
         #  Mask is in 160m spatial resolution, we need to up-sample to working spatial res., using nearest interpolation
         #  0 (no clouds), 1 (clouds), 255 (no data)
-        product = skimage.transform.resize(product, order=0, output_shape=s2_get_resolution(g.spatial_resolution))
+        product = upsample_nearest(product, s2_get_resolution(g.spatial_resolution))
         # For some reason it marks no data as no cloud therefore we will filter them out with SCL
         nodata = g["SCL"] < 1
         if g.slice_index != 1:
@@ -118,3 +131,158 @@ class S2Detectors:
         if g.slice_index > 1:
             return slice_raster(g.slice_index, product)
         return product
+
+    # TODO: After some generalization add l1c
+    @staticmethod
+    def sentinel_cloudless(g: S2Granule, probability: bool = False,
+                           lazy: bool = False) -> Union[np.ndarray, CoarseMask]:
+        """
+        Cloud detection based on machine learning algorithm by SentinelHub.
+        Granule is identified and accompanying L1C dataset is downloaded and mas computed.
+        In future we might save these mask and use them but for now we will download the data and compute the mask
+        over and over.
+        @param g - granule.
+        @param probability - if we want the function to return probability mask instead of 0,1,255 mask,
+        probability is in the type of the precision policy, percent in uint8 (255 no data) by default
+        @param lazy - return CoarseMask in 160m instead of the mask in the working resolution, granule cannot be sliced
+        :return: based on the probability parameter, we return either mask of 0,1,255 or probability mask <0, 255>
+        """
+        if lazy and g.slice_index > 1:
+            raise ValueError("Lazy masks are not supported for sliced granules")
+        data = S2Detectors._prepare_l1c(g)
+        if data is None:
+            return S2Detectors._no_data(g, lazy)
+        return S2Detectors._finalize_cloudless(g, _s2cloudless_inference(data, probability), probability, lazy)
+
+    @staticmethod
+    def sentinel_cloudless_batch(granules: List[S2Granule], probability: bool = False, download_workers: int = 4,
+                                 processes: int = None, lazy: bool = False,
+                                 ordered: bool = True) -> Iterator[Union[np.ndarray, CoarseMask, tuple]]:
+        """
+        Same as sentinel_cloudless, but for many granules at once.
+        L1C datasets are downloaded concurrently, the inference of a granule is submitted to the process pool as soon
+        as its download finishes and each mask is handed over as soon as its inference completes, while the caller
+        consumes the masks one by one.
+        @param granules - granules we want the masks for
+        @param probability - see sentinel_cloudless
+        @param download_workers - number of concurrent downloads, capped by the runtime budget
+        @param processes - number of inference processes, by default the thread budget of the worker, under
+        the scheduler the inference runs in this process (see RuntimeConfig.daemon)
+        @param lazy - see sentinel_cloudless
+        @param ordered - yield the masks in the order of granules (a mask waits only for the ones before it),
+        otherwise (index of the granule, mask) in the order of completion
+        :return: generator of masks
+        """
+        if lazy and any(g.slice_index > 1 for g in granules):
+            raise ValueError("Lazy masks are not supported for sliced granules")
+        if runtime.daemon:
+            #  daemonic process of the scheduler is not allowed to have children, one inference at a time in a thread
+            log.info("s2cloudless inference runs in a single thread under the scheduler")
+            inference = ThreadPoolExecutor(max_workers=1)
+        else:
+            inference = ProcessPoolExecutor(max_workers=processes or runtime.worker_threads)
+        downloads = ThreadPoolExecutor(max_workers=runtime.pool_size(download_workers))
+        prepared, products = {}, {}
+        try:
+            prepared = {downloads.submit(S2Detectors._prepare_l1c, g): i for i, g in enumerate(granules)}
+            pending = set(prepared)
+            # index -> 160m product (None without L1C), finalized when it is handed over
+            done = {}
+            following = 0
+            while len(pending) > 0:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    if future in prepared:
+                        i = prepared.pop(future)
+                        data = future.result()
+                        if data is None:
+                            done[i] = None
+                        else:
+                            product = inference.submit(_s2cloudless_inference, data, probability)
+                            products[product] = i
+                            pending.add(product)
+                        del data
+                    else:
+                        done[products.pop(future)] = future.result()
+                ready = []
+                if ordered:
+                    while following in done:
+                        ready.append(following)
+                        following += 1
+                else:
+                    ready = list(done)
+                for i in ready:
+                    product = done.pop(i)
+                    mask = S2Detectors._no_data(granules[i], lazy) if product is None else \
+                        S2Detectors._finalize_cloudless(granules[i], product, probability, lazy)
+                    del product
+                    yield mask if ordered else (i, mask)
+        finally:
+            #  the consumer stopped early or something failed, the work not started yet is dropped
+            #  (Python 3.7 has no cancel_futures)
+            for future in list(prepared) + list(products):
+                future.cancel()
+            downloads.shutdown(wait=True)
+            inference.shutdown(wait=True)
+
+def _s2cloudless_inference(data: np.ndarray, probability: bool) -> np.ndarray:
+    """
+    Module level, so it can be sent to the worker processes.
+    """
+    cloud_detector = S2PixelCloudDetector()
+    if probability:
+        return cloud_detector.get_cloud_probability_maps(data)
+    return cloud_detector.get_cloud_masks(data)
+
+
+class SCLClassifier:
+    """
+    Look-up table based SCL detector for Per-Tile.
+    SCL is read slice by slice from the file of its native resolution (20m, or 60m for granules at 60m) even when
+    the granule works at 10m. Each slice is reduced into the counts of the classes and the cloud percentage is
+    the weighted sum of the counts, per-pixel weights are never computed.
+    """
+    # no data - punish more, 8, 9 - cloud probability medium/high, 10 - thin cirrus
+    default_weights = {0: 10, 8: 1, 9: 1, 10: 1}
+
+    def __init__(self, weights: Dict[int, int] = None):
+        """
+        :param weights: SCL class -> integer weight, classes that are not present have weight 0
+        """
+        self.weights = SCLClassifier.default_weights if weights is None else weights
+        self.lut = np.zeros(shape=256, dtype=np.int64)
+        for scl_class, weight in self.weights.items():
+            if int(weight) != weight:
+                raise ValueError(f"Weight of the SCL class {scl_class} has to be an integer, got {weight}")
+            self.lut[scl_class] = weight
+        self.flagged = self.lut != 0
+
+    def clear(self, scl: np.ndarray) -> np.ndarray:
+        """
+        Pixels without any weight, e.g. not cloudy and not no data.
+        :param scl: SCL values
+        """
+        return ~self.flagged[scl]
+
+    def cloud_fractions(self, g: S2Granule) -> np.ndarray:
+        """
+        :param g: granule which contains the data
+        :return: cloud percentage for each slice
+        """
+        band = g["SCL"]
+        index = g.slice_index
+        res_y, res_x = int(band.profile["height"]), int(band.profile["width"])
+        #  slices without any data are not read, they are all no data
+        result = np.full(shape=index ** 2, fill_value=self.lut[0], dtype=np.float64)
+        counts = np.zeros(shape=256, dtype=np.int64)
+        with rasterio.open(band.native_path) as src:
+            if src.height % index != 0 or src.width % index != 0:
+                raise ValueError(f"SCL of {src.height}x{src.width} pixels can't be classified in {index}x{index} "
+                                 f"slices")
+            for sl in range(index ** 2):
+                if not g.block_index().has_data(slice_window(index, sl, res_y, res_x)):
+                    continue
+                counts[:] = 0
+                S2JIT.s2_class_counts(src.read(1, window=slice_window(index, sl, src.height, src.width)), counts)
+                result[sl] = np.dot(counts, self.lut) / counts.sum()
+        return result
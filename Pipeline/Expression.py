@@ -0,0 +1,164 @@
+"""
+Lazy band-math expressions compiled to fused numba kernels
+"""
+import math
+import threading
+from typing import List, Dict, Callable
+
+import numpy as np
+from numba import njit, prange
+from rasterio.windows import Window
+
+from Pipeline.logger import log
+from Pipeline.utils import slice_raster
+
+
+@njit
+def _div(a, b):
+    return a / b if b != 0 else 0.0
+
+
+class BandExpr:
+    """
+    Expression over bands, operators are only recorded.
+    evaluate() compiles the whole expression into one numba kernel and runs it blockwise,
+    so there is a single allocation (the result) instead of one full-size temporary per operator.
+    Example: mask = ((granule.expr("B02") > 100) & (granule.expr("B8A") < 8000)).evaluate()
+    Comparisons and logical operators produce bool, arithmetic produces float32, division by zero gives 0.
+    """
+    arithmetic = ["+", "-", "*", "/"]
+    comparisons = [">", "<", ">=", "<=", "==", "!="]
+    logical = ["&", "|"]
+    # source -> compiled kernel, shared by the threads (e.g. S2IndexEngine)
+    _kernels: Dict[str, Callable] = {}
+    _kernels_lock = threading.Lock()
+
+    def __init__(self, op: str, args: list):
+        self.op = op
+        self.args = args
+
+    @staticmethod
+    def band(band) -> 'BandExpr':
+        return BandExpr("band", [band])
+
+    @staticmethod
+    def _wrap(other) -> 'BandExpr':
+        if isinstance(other, BandExpr):
+            return other
+        if hasattr(other, "expr"):
+            return other.expr()
+        return BandExpr("const", [other])
+
+    def _binary(self, op: str, other, reverse: bool = False) -> 'BandExpr':
+        other = BandExpr._wrap(other)
+        return BandExpr(op, [other, self] if reverse else [self, other])
+
+    def __add__(self, other): return self._binary("+", other)
+    def __radd__(self, other): return self._binary("+", other, True)
+    def __sub__(self, other): return self._binary("-", other)
+    def __rsub__(self, other): return self._binary("-", other, True)
+    def __mul__(self, other): return self._binary("*", other)
+    def __rmul__(self, other): return self._binary("*", other, True)
+    def __truediv__(self, other): return self._binary("/", other)
+    def __rtruediv__(self, other): return self._binary("/", other, True)
+    def __gt__(self, other): return self._binary(">", other)
+    def __lt__(self, other): return self._binary("<", other)
+    def __ge__(self, other): return self._binary(">=", other)
+    def __le__(self, other): return self._binary("<=", other)
+    def __eq__(self, other): return self._binary("==", other)
+    def __ne__(self, other): return self._binary("!=", other)
+    def __and__(self, other): return self._binary("&", other)
+    def __rand__(self, other): return self._binary("&", other, True)
+    def __or__(self, other): return self._binary("|", other)
+    def __ror__(self, other): return self._binary("|", other, True)
+    def __invert__(self): return BandExpr("~", [self])
+    def __neg__(self): return BandExpr("neg", [self])
+
+    __hash__ = object.__hash__
+
+    def bands(self) -> list:
+        """
+        Unique bands used in the expression, in the order of appearance.
+        """
+        if self.op == "band":
+            return [self.args[0]]
+        if self.op == "const":
+            return []
+        result = []
+        for arg in self.args:
+            result += [band for band in arg.bands() if all(band is not b for b in result)]
+        return result
+
+    def is_bool(self) -> bool:
+        return self.op in BandExpr.comparisons + BandExpr.logical + ["~"]
+
+    def _code(self, bands: list) -> str:
+        if self.op == "band":
+            index = [i for i, band in enumerate(bands) if band is self.args[0]][0]
+            return f"float(a{index}[y, x])"
+        if self.op == "const":
+            value = float(self.args[0])
+            if math.isnan(value):
+                return "np.nan"
+            if math.isinf(value):
+                return "np.inf" if value > 0 else "(-np.inf)"
+            return repr(value)
+        if self.op == "~":
+            return f"(not {self.args[0]._code(bands)})"
+        if self.op == "neg":
+            return f"(-{self.args[0]._code(bands)})"
+        left, right = self.args[0]._code(bands), self.args[1]._code(bands)
+        if self.op == "/":
+            return f"_div({left}, {right})"
+        if self.op in BandExpr.logical:
+            return f"({left} {'and' if self.op == '&' else 'or'} {right})"
+        return f"({left} {self.op} {right})"
+
+    def source(self, bands: list = None) -> str:
+        """
+        Python source of the kernel, compiled with numba.
+        """
+        bands = self.bands() if bands is None else bands
+        arguments = ", ".join(f"a{i}" for i in range(len(bands)))
+        return f"def kernel({arguments}, out):\n" \
+               f"    for y in prange(out.shape[0]):\n" \
+               f"        for x in range(out.shape[1]):\n" \
+               f"            out[y, x] = {self._code(bands)}\n"
+
+    def _compile(self, bands: list) -> Callable:
+        source = self.source(bands)
+        with BandExpr._kernels_lock:
+            if source not in BandExpr._kernels:
+                log.debug(f"Compiling expression kernel:\n{source}")
+                namespace = {"prange": prange, "_div": _div, "np": np}
+                exec(source, namespace)
+                BandExpr._kernels[source] = njit(parallel=True)(namespace["kernel"])
+            return BandExpr._kernels[source]
+
+    def evaluate(self, rows_per_block: int = 1024) -> np.ndarray:
+        """
+        Evaluate the expression.
+        If the bands are loaded (or cropped by polygon) the kernel runs over the arrays in memory,
+        otherwise the bands are streamed from the files block by block and never loaded as a whole.
+        :param rows_per_block: height of the blocks read from the files
+        :return: bool or float32 array of the band shape
+        """
+        bands = self.bands()
+        if len(bands) == 0:
+            raise ValueError("Expression does not contain any band")
+        kernel = self._compile(bands)
+        dtype = np.bool_ if self.is_bool() else np.float32
+        if all(band.is_loaded() for band in bands) or any(band.polygon is not None for band in bands):
+            arrays = [band.raster() for band in bands]
+            shape = arrays[0].shape
+            out = np.empty(shape=shape, dtype=dtype)
+            kernel(*[a.reshape(-1, shape[-1]) for a in arrays], out.reshape(-1, shape[-1]))
+            return out
+        height, width = int(bands[0].profile["height"]), int(bands[0].profile["width"])
+        out = np.empty(shape=(height, width), dtype=dtype)
+        for start in range(0, height, rows_per_block):
+            window = Window(col_off=0, row_off=start, width=width, height=min(rows_per_block, height - start))
+            kernel(*[band.read_window(window) for band in bands], out[start:start + window.height])
+        if bands[0].slice_index > 1:
+            return slice_raster(bands[0].slice_index, out)
+        return out
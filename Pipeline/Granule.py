@@ -6,6 +6,7 @@ import pyproj
 import shapely.ops
 from osgeo import gdal
 from Pipeline.Band import *
+from Pipeline.BlockIndex import S2BlockIndex
 from Pipeline.utils import *
 from Pipeline.logger import log
 from shapely.geometry import Polygon
@@ -14,6 +15,9 @@ gdal.UseExceptions()
 
 
 class S2Granule:
+    # Memory budget of the temporary products (granule.temp), 2 GiB
+    temp_max_bytes = 2 * 1024 ** 3
+
     # TODO: move some logic to the parser
     def __init__(self, path: str, spatial_res: int, desired_bands: List[str], slice_index: int = 1,
                  t_srs: str = 'EPSG:32633', granule_type: str = "L2A", polygon: Optional[Polygon] = None):
@@ -41,7 +45,10 @@ class S2Granule:
             raise Exception("None or not enough datasets have been provided!")
         self.slice_index = slice_index
         self.bands = self.__to_band_dictionary()
-        self.temp = {}
+        self.temp = TempCache(S2Granule.temp_max_bytes)
+        self._block_index = None
+        #  Writer of the in-memory result granule, see from_arrays
+        self._sink = None
         self.proj = self.get_projection()
         if self.polygon is not None:
             self.__trasnform_polygon()
@@ -49,6 +56,73 @@ class S2Granule:
                 band.polygon = self.polygon
         log.info(f"Initialized granule:\n{self}")
 
+    @staticmethod
+    def from_arrays(path: str, spatial_res: int, arrays: Dict[str, np.ndarray], profile: dict, sink=None,
+                    doy: int = 0) -> 'S2Granule':
+        """
+        Granule backed by arrays, e.g. the result of a task that has not been written to the disk.
+        Tasks and indices work with it as with any other granule, persist() writes it.
+        :param path: directory the granule is going to be persisted to
+        :param arrays: band -> 2D array in the working resolution
+        :param profile: rasterio profile of the arrays
+        :param sink: in-memory ResultSink that persists the arrays
+        """
+        bands = {key: Band.from_array(data, profile) for key, data in arrays.items()}
+        return S2Granule._from_bands(path, spatial_res, bands, profile["crs"], sink, doy)
+
+    @staticmethod
+    def from_files(path: str, spatial_res: int, paths: Dict[str, str], doy: int = 0) -> 'S2Granule':
+        """
+        Granule of the given files, keys do not have to be Sentinel-2 bands (e.g. B04_Q50 of QuantilePerPixel).
+        :param path: directory of the granule
+        :param paths: key -> path to the file in the working resolution
+        """
+        bands = {key: Band(file) for key, file in paths.items()}
+        return S2Granule._from_bands(path, spatial_res, bands, list(bands.values())[0].profile["crs"], None, doy)
+
+    @staticmethod
+    def _from_bands(path: str, spatial_res: int, bands: Dict[str, Band], crs, sink, doy: int) -> 'S2Granule':
+        granule = S2Granule.__new__(S2Granule)
+        granule.path = path
+        granule.spatial_resolution = spatial_res
+        granule.slice_index = 1
+        granule.t_srs = crs
+        granule.polygon = None
+        granule.granule_type = "L2A"
+        granule.desired_bands = list(bands.keys())
+        granule.meta_data_path = None
+        granule.meta_data_gdal = None
+        granule.meta_data = None
+        granule.data_take = None
+        granule.doy = doy
+        granule.paths_to_raster = []
+        granule.bands = {spatial_res: bands}
+        granule.temp = TempCache(S2Granule.temp_max_bytes)
+        granule._block_index = None
+        granule._sink = sink
+        granule.proj = crs
+        return granule
+
+    @property
+    def in_memory(self) -> bool:
+        return any(band.in_memory for band in self.bands[self.spatial_resolution].values())
+
+    def persist(self) -> str:
+        """
+        Write the in-memory granule to its path, bands are read from the files from now on.
+        :return: path to the granule
+        """
+        if self._sink is None:
+            return self.path
+        paths = self._sink.persist()
+        for key, path in paths.items():
+            if key in self.bands[self.spatial_resolution]:
+                self.bands[self.spatial_resolution][key].attach_file(path)
+            elif key == "rgb":
+                self.bands[self.spatial_resolution][key] = Band(path)
+        self._sink = None
+        return self.path
+
     def __trasnform_polygon(self, input_epsg: str = "EPSG:4326") -> None:
         """
         Method transform input polygon to coordinates used within bands.
@@ -117,7 +191,9 @@ class S2Granule:
                 b = Band(band, slice_index=self.slice_index)
                 #  Automatically resample band to working spatial resolution
                 if b.profile["width"] != s2_get_resolution(self.spatial_resolution)[0]:
-                    b.resample(s2_get_resolution(self.spatial_resolution)[0] / b.profile["width"], delete=True)
+                    #  SCL is classified at its native resolution, the file is kept (see SCLClassifier)
+                    b.resample(s2_get_resolution(self.spatial_resolution)[0] / b.profile["width"],
+                               delete=key != "SCL")
                 e_dict[self.spatial_resolution][key] = b
         for band in self.desired_bands:
             if band not in e_dict[self.spatial_resolution]:
@@ -162,9 +238,25 @@ class S2Granule:
         """
         b = Band(path_to_band, slice_index=self.slice_index)
         if b.profile["width"] != s2_get_resolution(self.spatial_resolution)[0]:
-            b.resample(s2_get_resolution(self.spatial_resolution)[0] / b.profile["width"], delete=True)
+            b.resample(s2_get_resolution(self.spatial_resolution)[0] / b.profile["width"], delete=key != "SCL")
         self.bands[self.spatial_resolution][key] = b
 
+    def find_band_file(self, key: str) -> Optional[str]:
+        """
+        Path to the file of a band which is not among the desired bands, e.g. SCL for masking.
+        File of the working resolution is preferred, if there is none the first one found is used.
+        :param key: band, e.g. 'SCL'
+        :return: path or None if the granule has no such file
+        """
+        candidates = list(self.paths_to_raster)
+        if os.path.isdir(self.path):
+            candidates += get_files_in_directory(self.path, '.jp2') + get_files_in_directory(self.path, '.tif')
+        candidates = [c for c in candidates if re.findall('B[0-9]+A?|TCI|AOT|WVP|SCL|rgb|DOY', c)[-1:] == [key]]
+        if len(candidates) == 0:
+            return None
+        preferred = [c for c in candidates if f"_{self.spatial_resolution}m" in os.path.basename(c)]
+        return (preferred + candidates)[0]
+
     def load_bands(self, desired_bands: List[str] = None) -> None:
         """
         Method for loading the raster data into memory. Exists to avoid loading at the
@@ -183,7 +275,22 @@ class S2Granule:
         """
         for band in self.bands[self.spatial_resolution].values():
             band.free_resources()
-        self.temp = {}
+        self.temp.clear()
+
+    def block_index(self, coarse_resolution: int = 60) -> S2BlockIndex:
+        """
+        Coarse no data index of the granule, computed on the first call and cached.
+        SCL is preferred because it is the cheapest band to decode, otherwise any band of the granule is used.
+        :param coarse_resolution: spatial resolution of the index
+        :return: S2BlockIndex
+        """
+        if self._block_index is None:
+            bands = self.bands[self.spatial_resolution]
+            band = bands["SCL"] if "SCL" in bands else list(bands.values())[0]
+            shape = (int(band.profile["height"]), int(band.profile["width"]))
+            self._block_index = S2BlockIndex(band.path, shape, s2_get_resolution(coarse_resolution),
+                                             data=band.raster_image if band.in_memory else None)
+        return self._block_index
 
     def update_granule(self, name: str, path: str) -> None:
         """
@@ -222,6 +329,14 @@ class S2Granule:
             for band in self.bands[self.spatial_resolution].values():
                 band.band_reproject(t_srs=self.t_srs)
 
+    def expr(self, item) -> BandExpr:
+        """
+        Lazy expression of the band with the active spatial resolution, operators are compiled into one kernel:
+        mask = ((granule.expr("B02") > 100) & (granule.expr("B8A") < 8000)).evaluate()
+        :param item: band for instance 'B01' or 'B8A'
+        """
+        return self[item].expr()
+
     def __getitem__(self, item) -> Band:
         """
         The band that will be returned is band with the active
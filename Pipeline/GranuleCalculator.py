@@ -3,22 +3,28 @@ import numpy as np
 from Pipeline.Granule import *
 from Pipeline.utils import *
 from osgeo import gdal
-from typing import Callable
+from typing import Callable, Dict
 import rasterio
 import os
 from rasterio.profiles import Profile as RasterioProfile
 from Pipeline.utils import profile_for_rgb
+from Pipeline.Mosaic import MosaicBuilder
+from Pipeline.OutputProfile import OutputProfile
+from Pipeline.Indices import S2IndexEngine
 
 
 class GranuleCalculator:
 
     @staticmethod
     def save_band_rast(raster: np.ndarray, path: str, prof: RasterioProfile = None, dtype: np.dtype = None,
-                       driver: str = None) -> str:
+                       driver: str = None, output_profile: OutputProfile = None) -> str:
         """
         Save numpy array as raster image.
+        If output profile is provided the file is written with its layout and compression (GeoTIFF only).
         Returns path to the file.
         """
+        if output_profile is not None:
+            return output_profile.write(raster, path, prof, dtype)
         if dtype is not None:
             prof.update(dtype=dtype)
         if driver is not None:
@@ -122,9 +128,7 @@ class GranuleCalculator:
         path = granule.path + os.path.sep + f"agriculture_{granule.spatial_resolution}"
         if not save:
             return stacked
-        for i in range(len(stacked)):
-            stacked[i] = rescale_intensity(stacked[i], 0, 4096)
-        stacked = stacked.astype(numpy.uint8)
+        stacked = apply_lut(stacked, stretch_lut(1.0, 0, 4096))
         profile = granule['B02'].profile
         profile = profile_for_rgb(profile)
         path = GranuleCalculator.save_band_rast(stacked, path, prof=profile, driver="GTiff")
@@ -137,27 +141,40 @@ class GranuleCalculator:
         path = granule.path + os.path.sep + f"infrared_{granule.spatial_resolution}"
         if not save:
             return stacked
-        for i in range(len(stacked)):
-            stacked[i] = rescale_intensity(stacked[i], 0, 4096)
-        stacked = stacked.astype(numpy.uint8)
+        stacked = apply_lut(stacked, stretch_lut(1.0, 0, 4096))
         profile = granule['B02'].profile
         profile = profile_for_rgb(profile)
         path = GranuleCalculator.save_band_rast(stacked, path, prof=profile)
         granule.add_another_band(path, "infrared")
         return stacked
 
+    @staticmethod
+    def s2_indices(granule: S2Granule, indices: List[str], save: bool = False) -> Dict[str, np.ndarray]:
+        """
+        Compute several spectral indices in one pass over the shared bands, see S2IndexEngine.
+        :param granule: granule that provides us data
+        :param indices: e.g. ["NDVI", "NDMI", "ARI1"]
+        :param save: if user wants to save the results inside the working dir of the granule
+        :return: index -> numpy array, precision.index type
+        """
+        result = S2IndexEngine.compute(granule, indices)
+        if save:
+            for index, array in result.items():
+                reference = S2IndexEngine.indices[index][0][0]
+                path = granule.path + os.path.sep + f"{index.lower()}_{granule.spatial_resolution}"
+                path = GranuleCalculator.save_band_rast(array, path=path, prof=granule[reference].profile,
+                                                        dtype=np.dtype('float32'), driver="GTiff")
+                granule.add_another_band(path, index.lower())
+        return result
+
     @staticmethod
     def s2_moisture_index(granule: S2Granule, save: bool = False):
-        path = granule.path + os.path.sep + f"moisture_index_{granule.spatial_resolution}"
-        b8 = granule['B8A'].raster().astype(float)
-        b11 = granule['B11'].raster().astype(float)
-        m1 = (b8 - b11)
-        m2 = (b8 + b11)
-        numpy.divide(m1, m2, out=m1, where=m2 != 0).squeeze()
+        m1 = S2IndexEngine.compute(granule, ["NDMI"])["NDMI"]
         if not save:
             return m1
+        path = granule.path + os.path.sep + f"moisture_index_{granule.spatial_resolution}"
         profile = granule['B8A'].profile
-        path = GranuleCalculator.save_band_rast(m1, path, prof=profile, dtype=np.dtype('float'), driver="GTiff")
+        path = GranuleCalculator.save_band_rast(m1, path, prof=profile, dtype=np.dtype('float32'), driver="GTiff")
         granule.add_another_band(path, "moisture_index")
         return m1
 
@@ -169,18 +186,14 @@ class GranuleCalculator:
         :param save: if user wants to save the result inside the working dir of the worker
         :return: numpy array
         """
-        nir = granule['B8A'].raster().astype(float)
-        red = granule['B04'].raster().astype(float)
-        _ndvi = ndvi(red=red, nir=nir)
-        granule.temp["NDVI"] = _ndvi
+        _ndvi = S2IndexEngine.compute(granule, ["NDVI"])["NDVI"]
         if not save:
             return _ndvi
         path = granule.path + os.path.sep + f"ndvi_{granule.spatial_resolution}"
         path = GranuleCalculator.save_band_rast(_ndvi, path=path, prof=granule['B8A'].profile,
-                                                dtype=np.dtype('float'), driver="GTiff")
+                                                dtype=np.dtype('float32'), driver="GTiff")
         # initialize new band
         granule.add_another_band(path, "ndvi")
-        del nir, red
         return _ndvi
 
     @staticmethod
@@ -194,24 +207,25 @@ class GranuleCalculator:
         The reflectance of anthocyanin is highest around 550nm. However, the same wavelengths are reflected by
         chlorophyll as well. To isolate the anthocyanins, the 700nm spectral band, that reflects only chlorophyll and
         not anthocyanins, is subtracted.
+        Pixels with no data in any of the bands are 0.
         """
         if granule is None or granule["B03"] is None or granule["B05"] is None:
             raise ValueError("granule is none")
-        b03 = 1 / granule["B03"].raster().astype(float)
-        b05 = 1 / granule["B05"].raster().astype(float)
-        ari1 = b03 - b05
-        granule.temp["ARI1"] = ari1
+        ari1 = S2IndexEngine.compute(granule, ["ARI1"])["ARI1"]
         if not save:
             return ari1
         path = granule.path + os.path.sep + f"ari1_{granule.spatial_resolution}"
         path = GranuleCalculator.save_band_rast(ari1, path=path, prof=granule["B03"].profile,
-                                                dtype=np.dtype('float'), driver="GTiff")
+                                                dtype=np.dtype('float32'), driver="GTiff")
         granule.add_another_band(path, "ari1")
         return ari1
 
     @staticmethod
     def s2_pertile_cloud_index_mask(granule: S2Granule, detector: Callable) -> np.array:
         log.debug(f"Worker {granule.doy}, cloud index mask.")
+        #  Detectors that are able to reduce straight into the cloud percentage, e.g. SCLClassifier
+        if hasattr(detector, "cloud_fractions"):
+            return detector.cloud_fractions(granule)
         #  Compute cloud mask for each tile
         arr = detector(granule)  # (slices, res_x, res_y)
         #  Each index represents one tile and cloud percentage
@@ -225,25 +239,57 @@ class GranuleCalculator:
         # return result
         return arr
 
+    @staticmethod
+    def s2_pertile_cloud_index_windowed(granule: S2Granule, band_key: str, block_detector: Callable) -> np.array:
+        """
+        Same as s2_pertile_cloud_index_mask, but the band is read slice by slice and the detector
+        works on the raw blocks. The whole band is never held in memory.
+        :param granule: granule which contains the data
+        :param band_key: band the detector works on, for instance 'SCL'
+        :param block_detector: function that takes numpy array and returns cloud mask of the same shape
+        :return: cloud percentage for each slice
+        """
+        log.debug(f"Worker {granule.doy}, windowed cloud index mask.")
+        band = granule[band_key]
+        res_y, res_x = int(band.profile["height"]), int(band.profile["width"])
+        #  Value of the slice that contains no data at all, such slices are not even read
+        empty = block_detector(np.zeros(shape=(1, 1), dtype=band.profile["dtype"])).mean()
+        result = np.zeros(shape=granule.slice_index ** 2)
+        for sl in range(granule.slice_index ** 2):
+            window = slice_window(granule.slice_index, sl, res_y, res_x)
+            if not granule.block_index().has_data(window):
+                result[sl] = empty
+                continue
+            arr = block_detector(band.read_window(window))
+            result[sl] = np.sum(arr) / arr.size
+        band.free_resources()
+        return result
+
     @staticmethod
     def build_mosaics(granules: List[S2Granule], path: str, name: str = "_mosaic", **kwargs) -> None:
         """
         Method gathers all initialized bands inside a Granule and compares it with the others.
         For each Band that is present in every Granule, mosaic is built.
+        kwargs are passed to the MosaicBuilder, e.g. threads=16 or vrt_only=True.
         """
         if len(granules) == 0:
             log.warning("Empty list of granules. Terminating...")
             return
+        #  Mosaic is built from the files, in-memory results are written first
+        for granule in granules:
+            granule.persist()
         bands = set(granules[0].get_initialized_bands())  # init values
         #  Get bands that are present in every granule
         for granule in granules:
             b = set(granule.get_initialized_bands())
             bands = bands.intersection(b)
         log.info(f"Bands in each granule : {bands}")
+        band_paths = {}
         for band in bands:
-            paths = [g.bands[g.spatial_resolution][band].path for g in granules]  # Paths to raster data
-            log.info(f"Band: {band}, paths: {paths}")
-            build_mosaic(path, paths, band + name, band == "rgb", **kwargs)
+            band_paths[band] = [g.bands[g.spatial_resolution][band].path for g in granules]  # Paths to raster data
+            log.info(f"Band: {band}, paths: {band_paths[band]}")
+        #  All bands are built concurrently under the thread budget of the builder
+        MosaicBuilder(**kwargs).build_all(path, band_paths, name)
 
     @staticmethod
     def info():
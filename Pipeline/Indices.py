@@ -0,0 +1,135 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict
+
+import numpy as np
+from rasterio.windows import Window
+
+from Pipeline.Granule import S2Granule
+from Pipeline.logger import log
+from Pipeline.Precision import precision
+from Pipeline.Runtime import runtime
+from Pipeline.utils import slice_raster
+
+
+def _normalized_difference(a: np.ndarray, b: np.ndarray, out: np.ndarray) -> None:
+    """
+    (a - b) / (a + b), 0 where both are 0.
+    """
+    den = a + b
+    out[:] = 0
+    np.divide(a - b, den, out=out, where=den != 0)
+
+
+def _ari1(b03: np.ndarray, b05: np.ndarray, out: np.ndarray) -> None:
+    """
+    1 / B03 - 1 / B05, 0 where any of the bands has no data.
+    """
+    valid = (b03 != 0) & (b05 != 0)
+    out[:] = 0
+    np.subtract(np.reciprocal(b03, where=valid, out=np.zeros_like(b03)),
+                np.reciprocal(b05, where=valid, out=np.zeros_like(b05)), out=out, where=valid)
+
+
+# bands of the NDVI validity mask, AOT is optional
+NDVI_MASK_BANDS = ["B02", "B04", "B8A", "AOT"]
+
+
+def ndvi_mask_bands(granule: S2Granule) -> List[str]:
+    """
+    Bands of NDVI_MASK_BANDS the granule provides, granules without AOT are masked by the reflectance only.
+    """
+    return [key for key in NDVI_MASK_BANDS if key != "AOT" or key in granule.bands[granule.spatial_resolution]]
+
+
+def ndvi_mask(bands: dict):
+    """
+    Pixels taken into account by the NDVI selection (NdviPerPixel, StripeExecutor, MaxNdviProduct).
+    Works with arrays (eager) and with BandExpr (one fused kernel after evaluate()).
+    :param bands: band -> array or BandExpr, AOT is applied only when present
+    :return: bool array or BandExpr, True where the pixel is valid
+    """
+    mask = (bands["B02"] > 100) & (bands["B04"] > 100) & (bands["B8A"] > 500) & (bands["B8A"] < 8000)
+    if "AOT" in bands:
+        mask = mask & (bands["AOT"] < 100)
+    return mask
+
+
+class S2IndexEngine:
+    """
+    Fused spectral-index engine.
+    All requested indices are computed in one blockwise pass over the shared input bands, each band is read once
+    and cast to the index type of the precision policy (float64, float32 with compact) block by block.
+    Bands which are not loaded are read from the files window by window (like BandExpr) and never loaded whole.
+    Blocks are processed in parallel (numpy releases the GIL). Results are cached in granule.temp.
+    """
+    # index -> (bands, function(*bands, out))
+    indices = {
+        "NDVI": (("B8A", "B04"), _normalized_difference),
+        "NDMI": (("B8A", "B11"), _normalized_difference),
+        "ARI1": (("B03", "B05"), _ari1),
+    }
+
+    @staticmethod
+    def compute(granule: S2Granule, indices: List[str], threads: int = None,
+                rows_per_block: int = 256) -> Dict[str, np.ndarray]:
+        """
+        :param granule: granule which contains the bands
+        :param indices: e.g. ["NDVI", "NDMI", "ARI1"]
+        :param threads: number of threads, by default the thread budget of the worker
+        :param rows_per_block: height of the blocks (first axis of the band arrays)
+        :return: index -> array of the band shape, precision.index type
+        """
+        for index in indices:
+            if index not in S2IndexEngine.indices:
+                raise ValueError(f"Index {index} is not supported, choose from {list(S2IndexEngine.indices)}")
+        dtype = precision.index
+        # results cached under another policy are recomputed
+        result = {index: granule.temp[index] for index in indices
+                  if index in granule.temp and granule.temp[index].dtype == dtype}
+        missing = [index for index in indices if index not in result]
+        if len(missing) == 0:
+            return result
+        keys = []
+        for index in missing:
+            keys += [key for key in S2IndexEngine.indices[index][0] if key not in keys]
+        bands = {key: granule[key] for key in keys}
+        # loaded bands (or cropped by polygon) are used as they are, the others are read block by block
+        in_memory = all(band.is_loaded() for band in bands.values()) or granule.polygon is not None
+        reference = bands[keys[0]]
+        if in_memory:
+            arrays = {key: band.raster() for key, band in bands.items()}
+            shape = arrays[keys[0]].shape
+        else:
+            shape = (int(reference.profile["height"]), int(reference.profile["width"]))
+        for index in missing:
+            result[index] = np.empty(shape=shape, dtype=dtype)
+        log.debug(f"Computing {missing} from {keys}")
+        lock = threading.Lock()
+
+        def process(start: int) -> None:
+            stop = min(start + rows_per_block, shape[0])
+            if in_memory:
+                block = {key: array[start:stop].astype(dtype) for key, array in arrays.items()}
+            else:
+                window = Window(col_off=0, row_off=start, width=shape[1], height=stop - start)
+                # dataset handles of the bands are shared, reads are serialized, the math runs in parallel
+                with lock:
+                    raw = {key: band.read_window(window) for key, band in bands.items()}
+                block = {key: data.astype(dtype) for key, data in raw.items()}
+            for _index in missing:
+                _keys, function = S2IndexEngine.indices[_index]
+                function(*[block[key] for key in _keys], out=result[_index][start:stop])
+
+        with ThreadPoolExecutor(max_workers=threads or runtime.worker_threads) as executor:
+            for _ in executor.map(process, range(0, shape[0], rows_per_block)):
+                pass
+        if not in_memory:
+            for band in bands.values():
+                if not band.is_loaded():
+                    band.free_resources()
+            if reference.slice_index > 1:
+                result.update({index: slice_raster(reference.slice_index, result[index]) for index in missing})
+        for index in missing:
+            granule.temp[index] = result[index]
+        return result
@@ -1,11 +1,46 @@
 """
 Faster calculations with numba
 """
+from typing import Tuple
+
 from numba import njit, prange
 import math
 import numpy as np
 
 
+class CoarseMask:
+    """
+    Mask kept at its native resolution (e.g. 160m s2cloudless) and applied to the working resolution lazily.
+    Pixel (y, x) of the working grid is data[rows[y], cols[x]], the same nearest neighbour as upsample_nearest,
+    the kernels read the mask through the index maps instead of an up-sampled copy k^2 times bigger.
+    """
+
+    def __init__(self, data: np.ndarray, shape: Tuple[int, int]):
+        """
+        :param data: 2D mask at its native resolution
+        :param shape: shape of the working resolution
+        """
+        self.data = data
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.rows = CoarseMask.index_map(data.shape[0], self.shape[0])
+        self.cols = CoarseMask.index_map(data.shape[1], self.shape[1])
+
+    @staticmethod
+    def index_map(coarse: int, fine: int) -> np.ndarray:
+        """
+        Index of the coarse pixel for each fine pixel along one axis.
+        """
+        if fine % coarse == 0:
+            return np.arange(fine, dtype=np.intp) // (fine // coarse)
+        return ((np.arange(fine) + 0.5) * coarse / fine).astype(np.intp)
+
+    def materialize(self) -> np.ndarray:
+        """
+        Mask up-sampled to the working resolution.
+        """
+        return self.data[np.ix_(self.rows, self.cols)]
+
+
 class S2JIT:
 
     # @staticmethod
@@ -114,3 +149,173 @@ class S2JIT:
                     final_mask[y, x] = _min_val
                     result[:, y, x] = current_data[index][:, y, x]
                     doy[y, x] = current_doy[index]
+
+    @staticmethod
+    @njit(parallel=True)
+    def s2_cloud_probability_analysis_coarse(current_data, current_masks, mask_rows, mask_cols, current_doy, result,
+                                             doy, final_mask) -> None:
+        """
+        s2_cloud_probability_analysis with the masks at their native resolution (see CoarseMask),
+        pixel (y, x) reads current_masks[i][mask_rows[i][y], mask_cols[i][x]].
+        No data of the up-sampled masks comes from SCL, here it is the observation without data in all the bands.
+        """
+        bands, height, width = result.shape
+        for y in prange(height):
+            for x in range(width):
+                _min_val = math.inf
+                index = 0
+                for i in range(len(current_masks)):
+                    empty = True
+                    for k in range(bands):
+                        if current_data[i][k, y, x] != 0:
+                            empty = False
+                            break
+                    if empty:
+                        continue
+                    value = current_masks[i][mask_rows[i][y], mask_cols[i][x]]
+                    if 255 > value <= _min_val:
+                        _min_val = value
+                        index = i
+                if _min_val <= final_mask[y, x]:
+                    final_mask[y, x] = _min_val
+                    for k in range(bands):
+                        result[k, y, x] = current_data[index][k, y, x]
+                    doy[y, x] = current_doy[index]
+
+    @staticmethod
+    @njit(parallel=True)
+    def s2_apply_lut(image, lut, out):
+        """
+        out[y, x] = lut[image[y, x]], rows are processed in parallel.
+        :param image: 2D array of integers, used as indices
+        :param lut: 1D look-up table
+        :param out: 2D array of the image shape and the look-up table dtype
+        """
+        for y in prange(image.shape[0]):
+            for x in range(image.shape[1]):
+                out[y, x] = lut[image[y, x]]
+        return out
+
+    @staticmethod
+    @njit
+    def s2_class_counts(image, counts):
+        """
+        Number of pixels of each class, e.g. of SCL, no per-pixel weights are materialized.
+        :param image: 2D array of integers (classes)
+        :param counts: 1D int64 array, one item per class, updated in place
+        """
+        for y in range(image.shape[0]):
+            for x in range(image.shape[1]):
+                counts[image[y, x]] += 1
+
+    @staticmethod
+    @njit(parallel=True)
+    def s2_histogram_coarse(block, valid, coarse, counts):
+        """
+        First pass of the radix quantile, histogram of the high bytes of the valid observations.
+        :param block: 2D uint16 array, 0 is no data
+        :param valid: 2D bool array, e.g. not cloudy
+        :param coarse: 3D array (y, x, 256), updated in place
+        :param counts: 2D array, number of valid observations, updated in place
+        """
+        for y in prange(block.shape[0]):
+            for x in range(block.shape[1]):
+                value = block[y, x]
+                if value != 0 and valid[y, x]:
+                    coarse[y, x, value >> 8] += 1
+                    counts[y, x] += 1
+
+    @staticmethod
+    @njit(parallel=True)
+    def s2_histogram_fine(block, valid, bins, fine):
+        """
+        Second pass of the radix quantile, histogram of the low bytes of the observations whose high byte is
+        the bin of the quantile.
+        :param bins: 3D array (quantile, y, x), high byte of each quantile, -1 where there is no observation
+        :param fine: 4D array (quantile, y, x, 256), updated in place
+        """
+        for y in prange(block.shape[0]):
+            for x in range(block.shape[1]):
+                value = block[y, x]
+                if value == 0 or not valid[y, x]:
+                    continue
+                for j in range(bins.shape[0]):
+                    if bins[j, y, x] == value >> 8:
+                        fine[j, y, x, value & 255] += 1
+
+    @staticmethod
+    @njit(parallel=True)
+    def s2_histogram_rank(hist, rank, out_bin, out_rest):
+        """
+        Find the bin which holds the observation of the rank (0-based) and the rank within the bin.
+        :param hist: 3D array (y, x, 256)
+        :param rank: 2D array, -1 where there is no observation
+        :param out_bin: 2D array, -1 where there is no observation
+        :param out_rest: 2D array, rank within the bin
+        """
+        for y in prange(rank.shape[0]):
+            for x in range(rank.shape[1]):
+                r = rank[y, x]
+                out_bin[y, x] = -1
+                out_rest[y, x] = 0
+                if r < 0:
+                    continue
+                cumulative = 0
+                for b in range(256):
+                    c = hist[y, x, b]
+                    if cumulative + c > r:
+                        out_bin[y, x] = b
+                        out_rest[y, x] = r - cumulative
+                        break
+                    cumulative += c
+
+    @staticmethod
+    @njit(parallel=True)
+    def s2_medoid(data, valid, spectral, doys, result, doy):
+        """
+        Per-pixel medoid, the observation with the smallest sum of euclidean distances to the other valid
+        observations. All bands of the medoid are taken, so they come from the same date.
+        :param data: 4D uint16 array (granule, band, y, x), 0 is no data
+        :param valid: 3D bool array (granule, y, x), e.g. not cloudy
+        :param spectral: indices of the bands the distance is computed from
+        :param doys: DOY of each granule
+        :param result: 3D array (band, y, x), updated where there is a valid observation
+        :param doy: 2D array, DOY of the medoid, updated where there is a valid observation
+        """
+        n, bands, height, width = data.shape
+        for y in prange(height):
+            candidates = np.empty(n, dtype=np.int64)
+            sums = np.empty(n, dtype=np.float64)
+            for x in range(width):
+                m = 0
+                for i in range(n):
+                    if not valid[i, y, x]:
+                        continue
+                    empty = False
+                    for k in range(bands):
+                        if data[i, k, y, x] == 0:
+                            empty = True
+                            break
+                    if not empty:
+                        candidates[m] = i
+                        sums[m] = 0.0
+                        m += 1
+                if m == 0:
+                    continue
+                # distance matrix is symmetric, each pair is computed once
+                for a in range(m):
+                    for b in range(a + 1, m):
+                        distance = 0.0
+                        for k in spectral:
+                            d = np.float64(data[candidates[a], k, y, x]) - np.float64(data[candidates[b], k, y, x])
+                            distance += d * d
+                        distance = np.sqrt(distance)
+                        sums[a] += distance
+                        sums[b] += distance
+                best = 0
+                for a in range(1, m):
+                    if sums[a] < sums[best]:
+                        best = a
+                for k in range(bands):
+                    result[k, y, x] = data[candidates[best], k, y, x]
+                doy[y, x] = doys[candidates[best]]
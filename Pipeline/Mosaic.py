@@ -0,0 +1,140 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict
+
+import rasterio
+from osgeo import gdal
+from rasterio.windows import Window
+
+from Pipeline.logger import log
+from Pipeline.Runtime import runtime
+from Pipeline.utils import format_path
+
+gdal.UseExceptions()
+
+
+class MosaicBuilder:
+    """
+    In-process mosaic engine.
+    Source tiles are merged through a GDAL VRT, which is either kept as the result (vrt_only) or materialized
+    window by window into a tiled, compressed GeoTIFF.
+    """
+
+    def __init__(self, threads: int = None, vrt_only: bool = False, block_size: int = 512,
+                 compress: str = "DEFLATE"):
+        """
+        :param threads: thread budget of the builder, by default the thread budget of the worker
+        :param vrt_only: do not materialize mosaics, return paths to the VRT files
+        :param block_size: size of the internal tiles of the output
+        :param compress: compression of monochromatic mosaics, RGB mosaics are always JPEG compressed
+        """
+        self.threads = threads or runtime.worker_threads
+        self.vrt_only = vrt_only
+        self.block_size = block_size
+        self.compress = compress
+
+    @staticmethod
+    def build_vrt(destination: str, paths: List[str], name: str = "mosaic") -> str:
+        """
+        Build virtual mosaic of the files, nothing is read except the headers.
+        :return: path to the VRT
+        """
+        vrt_path = format_path(destination) + name + ".vrt"
+        vrt = gdal.BuildVRT(vrt_path, paths)
+        if vrt is None:
+            raise Exception(f"Unable to build VRT from {paths}")
+        vrt.FlushCache()
+        vrt = None  # closing the dataset writes the file
+        return vrt_path
+
+    def build(self, destination: str, paths: List[str], name: str = "mosaic", rgb: bool = False,
+              threads: int = None) -> str:
+        """
+        Build mosaic from files.
+        :param destination: path where the mosaic will be available
+        :param paths: paths to the raster files
+        :param name: name of the result file
+        :param rgb: source files are uint8 RGB images
+        :param threads: overrides the thread budget of the builder, it never exceeds the budget of the worker
+        :return: path to the mosaic
+        """
+        vrt_path = MosaicBuilder.build_vrt(destination, paths, name)
+        if self.vrt_only:
+            return vrt_path
+        final_image = format_path(destination) + name + ".tif"
+        threads = runtime.pool_size(threads or self.threads)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            self._materialize(vrt_path, final_image, rgb, executor, threads)
+        os.remove(vrt_path)
+        return final_image
+
+    def build_all(self, destination: str, band_paths: Dict[str, List[str]], suffix: str = "_mosaic",
+                  rgb_keys: List[str] = ("rgb",)) -> Dict[str, str]:
+        """
+        Build mosaics of all bands. Bands go one after another and the windows of each band are copied by one
+        pool of the builder's threads, so the budget is never exceeded.
+        :param band_paths: band -> paths to the raster files
+        :return: band -> path to the mosaic
+        """
+        if self.vrt_only:
+            return {band: MosaicBuilder.build_vrt(destination, paths, band + suffix)
+                    for band, paths in band_paths.items()}
+        result = {}
+        threads = runtime.pool_size(self.threads)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for band, paths in band_paths.items():
+                vrt_path = MosaicBuilder.build_vrt(destination, paths, band + suffix)
+                result[band] = format_path(destination) + band + suffix + ".tif"
+                self._materialize(vrt_path, result[band], band in rgb_keys, executor, threads)
+                os.remove(vrt_path)
+        return result
+
+    def _windows(self, height: int, width: int) -> List[Window]:
+        """
+        Windows aligned to the internal tiles of the output.
+        """
+        bs = self.block_size
+        return [Window(col_off=col, row_off=row, width=min(bs, width - col), height=min(bs, height - row))
+                for row in range(0, height, bs) for col in range(0, width, bs)]
+
+    def _materialize(self, vrt_path: str, final_image: str, rgb: bool, executor: ThreadPoolExecutor,
+                     threads: int) -> None:
+        """
+        Copy the VRT into a tiled GeoTIFF. Windows are read and decoded in parallel by the executor, each thread
+        has its own dataset handle. Writes are serialized, GDAL compresses the blocks with NUM_THREADS.
+        :param threads: size of the executor
+        """
+        with rasterio.open(vrt_path) as src:
+            profile = src.profile.copy()
+        for key in ["blockxsize", "blockysize", "tiled", "compress", "interleave", "photometric"]:
+            profile.pop(key, None)
+        profile.update(driver="GTiff", tiled=True, blockxsize=self.block_size, blockysize=self.block_size,
+                       num_threads=threads, bigtiff="IF_SAFER")
+        #  NOTE: JPEG used to make artefacts on monochromatic pictures, it is kept for RGB only,
+        #  all mosaics are tiled
+        if rgb:
+            profile.update(compress="JPEG", photometric="YCBCR", interleave="pixel")
+        else:
+            profile.update(compress=self.compress)
+        log.info(f"Materializing {vrt_path} -> {final_image}, threads: {threads}")
+
+        local = threading.local()
+        sources = []
+        lock = threading.Lock()
+        with rasterio.open(final_image, "w", **profile) as dst:
+            def copy(window: Window) -> None:
+                if not hasattr(local, "src"):
+                    local.src = rasterio.open(vrt_path)
+                    with lock:
+                        sources.append(local.src)
+                data = local.src.read(window=window)
+                with lock:
+                    dst.write(data, window=window)
+
+            try:
+                for _ in executor.map(copy, self._windows(dst.height, dst.width)):
+                    pass
+            finally:
+                for src in sources:
+                    src.close()
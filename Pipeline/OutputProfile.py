@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.profiles import Profile as RasterioProfile
+
+from Pipeline.logger import log
+from Pipeline.Runtime import runtime
+
+
+class OutputProfile:
+    """
+    Layout and compression of the result files.
+    GTiff - tiled GeoTIFF
+    COG - Cloud-Optimized GeoTIFF, tiled with internal overviews placed before the data,
+          the files are directly range-readable by tile servers
+    """
+
+    def __init__(self, layout: str = "COG", compress: str = "DEFLATE", predictor: bool = True,
+                 block_size: int = 512, overviews: list = (2, 4, 8, 16, 32), num_threads: int = None,
+                 level: int = None):
+        """
+        :param layout: 'GTiff' or 'COG'
+        :param compress: GDAL compression, e.g. LZW, DEFLATE, ZSTD (requires GDAL built with zstd)
+        :param predictor: horizontal (integers) or floating point predictor, pays off with DEFLATE and ZSTD
+        :param block_size: size of the internal tiles
+        :param overviews: decimation factors of the internal overviews (COG only)
+        :param num_threads: threads GDAL uses for the compression, by default the thread budget of the worker
+        :param level: compression level (DEFLATE/ZSTD), None keeps the GDAL default
+        """
+        if layout not in ["GTiff", "COG"]:
+            raise ValueError(f"Unsupported layout {layout}, choose between GTiff and COG")
+        self.layout = layout
+        self.compress = compress
+        self.predictor = predictor
+        self.block_size = block_size
+        self.overviews = list(overviews)
+        self.num_threads = num_threads
+        self.level = level
+
+    @classmethod
+    def legacy(cls) -> 'OutputProfile':
+        """
+        LZW compressed GeoTIFF with 256 blocks, what the pipeline used to write.
+        """
+        return cls(layout="GTiff", compress="LZW", predictor=False, block_size=256, overviews=[])
+
+    @classmethod
+    def cog(cls, compress: str = "DEFLATE", **kwargs) -> 'OutputProfile':
+        return cls(layout="COG", compress=compress, **kwargs)
+
+    def creation_options(self, dtype) -> dict:
+        """
+        Options for the rasterio profile of the data type.
+        """
+        options = dict(driver="GTiff", tiled=True, blockxsize=self.block_size, blockysize=self.block_size,
+                       compress=self.compress,
+                       num_threads=self.num_threads or runtime.worker_threads)
+        if self.predictor:
+            options["predictor"] = 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+        if self.level is not None:
+            if self.compress.upper() == "ZSTD":
+                options["zstd_level"] = self.level
+            elif self.compress.upper() == "DEFLATE":
+                options["zlevel"] = self.level
+        return options
+
+    def profile(self, prof: RasterioProfile, dtype=None, count: int = 1) -> dict:
+        """
+        Copy of the profile updated with the creation options.
+        """
+        prof = dict(prof)
+        prof["width"], prof["height"] = int(prof["width"]), int(prof["height"])
+        if dtype is not None:
+            prof["dtype"] = dtype
+        prof.update(self.creation_options(prof["dtype"]))
+        prof["count"] = count
+        return prof
+
+    def write(self, raster: np.ndarray, path: str, prof: RasterioProfile, dtype=None) -> str:
+        """
+        Save 2D or 3D numpy array, '.tif' is appended to the path.
+        :return: path to the file
+        """
+        path += '.tif'
+        if raster.ndim not in [2, 3]:
+            log.error("Raster has bad dimensions.")
+            raise ValueError
+        data = raster if raster.ndim == 3 else raster[np.newaxis]
+        prof = self.profile(prof, dtype, count=len(data))
+        if self.layout == "GTiff":
+            with rasterio.open(path, 'w', **prof) as dst:
+                dst.write(data)
+            return path
+        self.write_cog(data, path, prof)
+        return path
+
+    def write_cog(self, data: np.ndarray, path: str, prof: dict) -> None:
+        """
+        Data and overviews are written to a temporary GeoTIFF next to the path and copied to the file in the COG
+        order, the data are never held twice in the memory.
+        """
+        tmp_path = path + ".tmp.tif"
+        try:
+            with rasterio.open(tmp_path, 'w', **prof) as tmp:
+                tmp.write(data)
+                if len(self.overviews) > 0:
+                    tmp.build_overviews(self.overviews, Resampling.nearest)
+                    tmp.update_tags(ns='rio_overview', resampling='nearest')
+            with rasterio.open(tmp_path) as tmp:
+                self.copy_as_cog(tmp, path, prof)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def copy_as_cog(self, src, path: str, prof: dict) -> None:
+        """
+        Copy opened dataset (with its overviews) to the path in the COG layout.
+        """
+        options = {key: value for key, value in prof.items()
+                   if key not in ["driver", "count", "width", "height", "dtype", "crs", "transform", "nodata"]}
+        rasterio.shutil.copy(src, path, driver="GTiff", copy_src_overviews=True, **options)
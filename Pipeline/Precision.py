@@ -0,0 +1,73 @@
+import numpy as np
+
+from Pipeline.logger import log
+
+
+class PrecisionPolicy:
+    """
+    Data types of the intermediates of the pipeline.
+    legacy (default): float64 as the pipeline has always computed, probability is kept in 0-1.
+    compact (opt-in): float32 indices and reflectance, cloud probability in percent as uint8 (255 is no data),
+    uint16 DOY.
+    Use the module level instance `precision` (Pipeline.Precision.precision) and change it with `set_precision`.
+    """
+    probability_nodata = 255
+
+    def __init__(self, name: str, index=np.float64, reflectance=np.float64, probability=np.float64, doy=np.uint16):
+        """
+        :param name: identifier, part of the checkpoint fingerprints
+        :param index: spectral indices (NDVI, NDMI, ARI1) and the scores derived from them
+        :param reflectance: reflectance scaled to 0-1 (s2cloudless input)
+        :param probability: cloud probability masks, integer types hold percent
+        :param doy: day of the year
+        """
+        self.name = name
+        self.index = np.dtype(index)
+        self.reflectance = np.dtype(reflectance)
+        self.probability = np.dtype(probability)
+        self.doy = np.dtype(doy)
+
+    @classmethod
+    def compact(cls) -> 'PrecisionPolicy':
+        return cls("compact", np.float32, np.float32, np.uint8, np.uint16)
+
+    @classmethod
+    def legacy(cls) -> 'PrecisionPolicy':
+        return cls("legacy")
+
+    def scale_reflectance(self, data: np.ndarray) -> np.ndarray:
+        """
+        Digital numbers (0-10000) to reflectance.
+        """
+        return np.divide(data, 10000, dtype=self.reflectance)
+
+    def cloud_mask(self, product: np.ndarray, probability: bool) -> np.ndarray:
+        """
+        s2cloudless product in the probability type.
+        :param product: probabilities in 0-1 or mask of 0 (clear), 1 (cloud)
+        :param probability: whether the product holds probabilities
+        """
+        if probability and np.issubdtype(self.probability, np.integer):
+            return np.rint(np.asarray(product) * 100).astype(self.probability)
+        return np.asarray(product).astype(self.probability, copy=False)
+
+    def __str__(self):
+        return f"{self.name}: index {self.index}, reflectance {self.reflectance}, probability {self.probability}, " \
+               f"DOY {self.doy}"
+
+
+precision = PrecisionPolicy.legacy()
+
+
+def set_precision(policy: PrecisionPolicy) -> PrecisionPolicy:
+    """
+    Update the policy of this process, the module level instance is updated in place so that the modules
+    that imported it see the change.
+    """
+    precision.name = policy.name
+    precision.index = policy.index
+    precision.reflectance = policy.reflectance
+    precision.probability = policy.probability
+    precision.doy = policy.doy
+    log.debug(f"Precision: {precision}")
+    return precision
@@ -0,0 +1,65 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Callable, Iterator, Any
+
+from Pipeline.logger import log
+from Pipeline.utils import available_memory
+
+
+class Prefetcher:
+    """
+    Loads the next items on background threads while the current one is processed.
+    Items are yielded in the order of the input, at most `depth` of them are loaded ahead. The depth is limited
+    so that the items in flight fit into half of the free memory.
+    Example: for batch in Prefetcher(batches, load_batch, item_bytes=batch_bytes): kernel(batch)
+    """
+
+    def __init__(self, items: Iterable, load: Callable[[Any], Any], depth: int = 1, item_bytes: int = None,
+                 max_bytes: int = None, threads: int = 1):
+        """
+        :param items: what is passed to load, e.g. batch indices or windows
+        :param load: function which loads one item
+        :param depth: number of items loaded while the current one is processed, 1 is double buffering
+        :param item_bytes: estimated size of one loaded item
+        :param max_bytes: memory for the items loaded ahead, by default half of the free memory
+        :param threads: loading threads, keep 1 when load runs parallel numba kernels (numba's default
+        threading layer does not allow parallel regions from several threads at once)
+        """
+        self.items = items
+        self.load = load
+        self.threads = threads
+        if max_bytes is None:
+            free = available_memory()
+            max_bytes = free // 2 if free is not None else None
+        if item_bytes is not None and max_bytes is not None:
+            depth = min(depth, max_bytes // max(1, item_bytes))
+        self.depth = max(0, depth)
+        if self.depth == 0:
+            log.warning("Not enough memory to prefetch, items are loaded one by one")
+
+    def __iter__(self) -> Iterator:
+        items = iter(self.items)
+        if self.depth == 0:
+            for item in items:
+                yield self.load(item)
+            return
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.threads)
+        try:
+            #  the current item and `depth` items ahead
+            for item in items:
+                pending.append(executor.submit(self.load, item))
+                if len(pending) > self.depth:
+                    break
+            while len(pending) > 0:
+                result = pending.popleft().result()
+                yield result
+                #  next item is submitted once the current one is released, at most depth + 1 are in memory
+                del result
+                for item in items:
+                    pending.append(executor.submit(self.load, item))
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,355 @@
+"""
+Compositing products fed from one shared read pass
+"""
+import calendar
+import copy
+from abc import ABC, abstractmethod
+from datetime import date
+from typing import List, Dict, Callable, Optional
+
+import numpy as np
+import rasterio
+from numba.typed import List as LIST
+from rasterio.windows import Window
+
+from Pipeline.Detectors import SCLClassifier
+from Pipeline.Granule import S2Granule
+from Pipeline.GranuleCalculator import GranuleCalculator
+from Pipeline.Indices import _normalized_difference, ndvi_mask, ndvi_mask_bands
+from Pipeline.logger import log
+from Pipeline.Mask import S2JIT
+from Pipeline.Precision import precision
+from Pipeline.Prefetch import Prefetcher
+from Pipeline.Worker import S2Worker
+
+
+class DoyBin:
+    """
+    Period of a temporal composite, inclusive range of days of the year.
+    """
+
+    def __init__(self, start: int, end: int, label: str = None):
+        if not 1 <= start <= end <= 366:
+            raise ValueError(f"Invalid DOY range {start}-{end}")
+        self.start = start
+        self.end = end
+        self.label = label if label is not None else f"{start:03d}-{end:03d}"
+
+    def __contains__(self, doy: int) -> bool:
+        return self.start <= doy <= self.end
+
+    def __repr__(self):
+        return f"DoyBin({self.start}, {self.end}, '{self.label}')"
+
+    @staticmethod
+    def from_dates(start: date, end: date, label: str = None) -> 'DoyBin':
+        if start.year != end.year:
+            raise ValueError("Period has to be within one year, DOY does not carry the year")
+        return DoyBin(start.timetuple().tm_yday, end.timetuple().tm_yday, label)
+
+    @staticmethod
+    def monthly(year: int) -> List['DoyBin']:
+        """
+        One bin per month, labels 01..12.
+        """
+        return [DoyBin.from_dates(date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1]),
+                                  f"{month:02d}") for month in range(1, 13)]
+
+    @staticmethod
+    def every(days: int, start: int = 1, end: int = 366) -> List['DoyBin']:
+        """
+        Consecutive bins of `days` days, e.g. every(10) for 10-day composites.
+        """
+        return [DoyBin(first, min(first + days - 1, end)) for first in range(start, end + 1, days)]
+
+
+class Product(ABC):
+    """
+    Accumulator of one composite.
+    The runner reads every window of every granule once and hands the blocks to all products that need them:
+    start(window), add(...) for each granule in the order of worker.granules, finish() -> blocks of the result.
+    Product with a period only accepts the granules sensed within it.
+    """
+    name = "product"
+
+    def __init__(self):
+        self.output_bands: List[str] = []
+        self.period: Optional[DoyBin] = None
+
+    def prepare(self, worker: S2Worker) -> None:
+        """
+        Called once before the read pass.
+        """
+        self.output_bands = list(worker.output_bands)
+
+    def inputs(self) -> List[str]:
+        """
+        Bands the product reads.
+        """
+        return self.output_bands
+
+    def outputs(self) -> List[str]:
+        """
+        Keys written to the result.
+        """
+        return self.output_bands + ["DOY"]
+
+    def accepts(self, granule: S2Granule) -> bool:
+        return self.period is None or granule.doy in self.period
+
+    def needs(self, index: int, granule: S2Granule, window: Window) -> bool:
+        return True
+
+    @abstractmethod
+    def start(self, window: Window) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add(self, index: int, granule: S2Granule, blocks: Dict[str, np.ndarray]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def finish(self) -> Dict[str, np.ndarray]:
+        raise NotImplementedError
+
+
+class MedianProduct(Product):
+    """
+    Per-pixel median of all granules, see MedianPerPixel.
+    Blocks of the window are stacked in chunks of rows that fit into max_bytes, not all at once.
+    """
+    name = "median"
+
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2):
+        """
+        :param max_bytes: memory of the stacked blocks and the median of one chunk
+        """
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.blocks = {}
+
+    def outputs(self) -> List[str]:
+        return self.output_bands
+
+    def start(self, window: Window) -> None:
+        self.blocks = {band: [] for band in self.output_bands}
+
+    def add(self, index: int, granule: S2Granule, blocks: Dict[str, np.ndarray]) -> None:
+        for band in self.output_bands:
+            self.blocks[band].append(blocks[band])
+
+    def finish(self) -> Dict[str, np.ndarray]:
+        result = {}
+        for band, blocks in self.blocks.items():
+            height, width = blocks[0].shape
+            # stack, the copy np.median partitions and the float64 median of each row
+            rows = max(1, self.max_bytes // (width * (2 * len(blocks) * blocks[0].itemsize + 8)))
+            median = np.empty(shape=(height, width), dtype=np.uint16)
+            for row in range(0, height, rows):
+                data = np.stack([block[row: row + rows] for block in blocks])
+                median[row: row + rows] = S2JIT.s2_median_analysis(data, np.median(data, axis=0))
+                del data
+            result[band] = median
+        self.blocks = {}
+        return result
+
+
+class MaxNdviProduct(Product):
+    """
+    Pixel with the highest NDVI, see NdviPerPixel. Granules are folded in batches of `constraint`,
+    so the result is the same as the one of NdviPerPixel.
+    """
+    name = "ndvi"
+
+    def __init__(self, constraint: int = 5):
+        super().__init__()
+        self.constraint = constraint
+        self.ndvi = []
+        self.data = []
+        self.doys = []
+        self.shape = None
+        self.mask_bands: List[str] = []
+
+    def prepare(self, worker: S2Worker) -> None:
+        super().prepare(worker)
+        # AOT is part of the mask only when every granule has it, blocks are read for all granules alike
+        self.mask_bands = [band for band in ndvi_mask_bands(worker.granules[0])
+                           if all(band in ndvi_mask_bands(g) for g in worker.granules)]
+
+    def inputs(self) -> List[str]:
+        return self.output_bands + [band for band in self.mask_bands if band not in self.output_bands]
+
+    def needs(self, index: int, granule: S2Granule, window: Window) -> bool:
+        # granules without any data are not taken into account at all
+        return granule.block_index().has_data()
+
+    def start(self, window: Window) -> None:
+        self.ndvi, self.data, self.doys = [], [], []
+        self.shape = (window.height, window.width)
+
+    def add(self, index: int, granule: S2Granule, blocks: Dict[str, np.ndarray]) -> None:
+        # same type as S2IndexEngine computes NdviPerPixel's NDVI in
+        ndvi = np.empty(shape=self.shape, dtype=precision.index)
+        _normalized_difference(blocks["B8A"].astype(ndvi.dtype), blocks["B04"].astype(ndvi.dtype), out=ndvi)
+        self.ndvi.append(np.where(ndvi_mask({band: blocks[band] for band in self.mask_bands}), ndvi, -1))
+        self.data.append(np.stack([blocks[band] for band in self.output_bands]))
+        self.doys.append(granule.doy)
+
+    def finish(self) -> Dict[str, np.ndarray]:
+        height, width = self.shape
+        ndvi_res = np.full(self.shape, -10, dtype=precision.index)
+        result = np.ones(shape=(len(self.output_bands), height, width), dtype=np.uint16)
+        doy = np.zeros(shape=self.shape, dtype=precision.doy)
+        for start in range(0, len(self.data), self.constraint):
+            data, doys = LIST(), LIST()
+            for i in range(start, min(start + self.constraint, len(self.data))):
+                data.append(self.data[i])
+                doys.append(self.doys[i])
+            ndvi = np.stack(self.ndvi[start: start + self.constraint]).astype(precision.index, copy=False)
+            S2JIT.s2_ndvi_pixel_analysis(ndvi, ndvi_res, data, doys, result, doy, width, height)
+        self.ndvi, self.data, self.doys = [], [], []
+        output = {band: result[i] for i, band in enumerate(self.output_bands)}
+        output["DOY"] = doy
+        return output
+
+
+class PerTileProduct(Product):
+    """
+    Least cloudy granule of each slice, see PerTile. Slices are scored from SCL before the read pass,
+    in the pass each granule is only read in the windows where it won a slice.
+    """
+    name = "pertile"
+
+    def __init__(self, detector: Callable = None):
+        super().__init__()
+        self.detector = detector if detector is not None else SCLClassifier()
+        self.winners = None
+        self.slice_shape = None
+        self.map = None
+        self.result = None
+        self.doy = None
+
+    def prepare(self, worker: S2Worker) -> None:
+        super().prepare(worker)
+        s = worker.slice_index
+        # granules out of the period never win
+        cloud_info = np.stack([GranuleCalculator.s2_pertile_cloud_index_mask(g, self.detector) if self.accepts(g)
+                               else np.full(s * s, np.inf) for g in worker.granules])
+        # slice i is the row block i // s and the column block i % s
+        self.winners = cloud_info.argmin(axis=0).reshape(s, s)
+        res_x, res_y = worker.get_res()
+        self.slice_shape = (res_x // s, res_y // s)
+
+    def _window_map(self, window: Window) -> np.ndarray:
+        rows = np.arange(window.row_off, window.row_off + window.height) // self.slice_shape[0]
+        cols = np.arange(window.col_off, window.col_off + window.width) // self.slice_shape[1]
+        return self.winners[rows][:, cols]
+
+    def needs(self, index: int, granule: S2Granule, window: Window) -> bool:
+        return bool((self._window_map(window) == index).any())
+
+    def start(self, window: Window) -> None:
+        self.map = self._window_map(window)
+        self.result = np.zeros(shape=(len(self.output_bands), window.height, window.width), dtype=np.uint16)
+        self.doy = np.zeros(shape=(window.height, window.width), dtype=np.uint16)
+
+    def add(self, index: int, granule: S2Granule, blocks: Dict[str, np.ndarray]) -> None:
+        won = self.map == index
+        for i, band in enumerate(self.output_bands):
+            self.result[i][won] = blocks[band][won]
+        self.doy[won] = granule.doy
+
+    def finish(self) -> Dict[str, np.ndarray]:
+        output = {band: self.result[i] for i, band in enumerate(self.output_bands)}
+        output["DOY"] = self.doy
+        self.result, self.doy, self.map = None, None, None
+        return output
+
+
+def temporal_products(products: List[Product], bins: List[DoyBin]) -> List[Product]:
+    """
+    Copy of each product for each period, e.g. temporal_products([MedianProduct()], DoyBin.monthly(2021))
+    gives products median_01 .. median_12.
+    """
+    result = []
+    for product in products:
+        for period in bins:
+            binned = copy.deepcopy(product)
+            binned.period = period
+            binned.name = f"{product.name}_{period.label}"
+            result.append(binned)
+    return result
+
+
+class MultiProductRunner:
+    """
+    Reads each window of each granule once and fans the blocks out to several products.
+    Every product is written to its own directory, <dataset>/result_<product.name>.
+    Products without any granule (e.g. a period without acquisitions) are skipped.
+    """
+
+    def __init__(self, worker: S2Worker, products: List[Product]):
+        names = [product.name for product in products]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Products must have unique names, got {names}")
+        self.worker = worker
+        self.products = []
+        for product in products:
+            if any(product.accepts(granule) for granule in worker.granules):
+                self.products.append(product)
+            else:
+                log.warning(f"Product {product.name} has no granules, skipping")
+
+    def result_path(self, product: Product) -> str:
+        return self.worker.save_result_path + "_" + product.name
+
+    def run(self) -> Dict[str, S2Granule]:
+        """
+        :return: product name -> result granule
+        """
+        worker = self.worker
+        for product in self.products:
+            product.prepare(worker)
+        sinks = {product.name: worker.open_result_sink(product.outputs(), self.result_path(product))
+                 for product in self.products}
+        with rasterio.open(worker.granules[0][worker.output_bands[0]].path) as reference:
+            windows = [window for _, window in reference.block_windows(1)]
+            dtype = reference.dtypes[0]
+            block_bytes = reference.block_shapes[0][0] * reference.block_shapes[0][1] * 2
+        keys = []
+        for product in self.products:
+            keys += [key for key in product.inputs() if key not in keys]
+        log.info(f"Products {[p.name for p in self.products]} over {len(windows)} window(s), bands: {keys}")
+
+        def load(window: Window):
+            granules = []
+            for index, granule in enumerate(worker.granules):
+                products = [p for p in self.products if p.accepts(granule) and p.needs(index, granule, window)]
+                if len(products) == 0:
+                    continue
+                needed = []
+                for product in products:
+                    needed += [key for key in product.inputs() if key not in needed]
+                if granule.block_index().has_data(window):
+                    blocks = {key: granule[key].read_window(window) for key in needed}
+                else:
+                    zeros = np.zeros(shape=(window.height, window.width), dtype=dtype)
+                    blocks = {key: zeros for key in needed}
+                granules.append((index, granule, products, blocks))
+            return window, granules
+
+        for window, granules in Prefetcher(windows, load, item_bytes=len(worker.granules) * len(keys) * block_bytes):
+            for product in self.products:
+                product.start(window)
+            for index, granule, products, blocks in granules:
+                for product in products:
+                    product.add(index, granule, blocks)
+            for product in self.products:
+                for key, data in product.finish().items():
+                    sinks[product.name].write(key, data, window)
+        result = {}
+        for product in self.products:
+            sinks[product.name].close()
+            result[product.name] = sinks[product.name].result(product.output_bands + ["rgb"])
+        worker.release_bands()
+        return result
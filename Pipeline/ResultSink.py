@@ -0,0 +1,228 @@
+import os
+import re
+import shutil
+import threading
+from typing import List, Dict, Tuple
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.profiles import Profile as RasterioProfile
+from rasterio.windows import Window
+
+from Pipeline.Granule import S2Granule
+from Pipeline.logger import log
+from Pipeline.OutputProfile import OutputProfile
+from Pipeline.utils import stretch_lut, apply_lut
+
+
+class ResultSink:
+    """
+    Streaming writer of the task result.
+    All output datasets are opened up front and the task writes (window, band, data) as soon as the data are
+    computed. RGB quicklook is derived from the B04, B03 and B02 blocks in flight, its JPEG tiles are assembled from
+    the windows and each tile is written once, when all three channels are complete. When the channels do not arrive
+    together (e.g. median goes band by band) and the buffered tiles exceed rgb_buffer_bytes, the missing tiles are
+    read back from the band files on close.
+    In-memory sink keeps the bands in arrays and writes nothing, the result granule is handed over to the next step
+    as it is and persist() writes it when (and if) it is needed.
+    """
+    rgb_bands = ["B04", "B03", "B02"]
+    # keys S2Granule finds by the names of the files
+    band_pattern = "B[0-9]+A?|TCI|AOT|WVP|SCL|rgb|DOY"
+    rgb_tile = 256
+
+    def __init__(self, path: str, keys: List[str], prof: RasterioProfile, spatial_resolution: int, tile: str,
+                 output_profile: OutputProfile = None, gain: float = 1.5, in_memory: bool = False,
+                 rgb_buffer_bytes: int = 64 * 1024 ** 2):
+        """
+        :param path: result directory, it is recreated if it already exists
+        :param keys: bands (and e.g. DOY) that are going to be written
+        :param prof: reference profile, transformation and projection of the result
+        :param spatial_resolution: used in the names of the files
+        :param tile: mercator, used in the name of the RGB file
+        :param output_profile: layout and compression of the files
+        :param gain: gain of the RGB quicklook
+        :param in_memory: keep the result in memory, nothing is written until persist()
+        :param rgb_buffer_bytes: limit of the incomplete RGB tiles kept in memory
+        """
+        self.path = path
+        self.keys = list(keys)
+        self.prof = prof
+        self.spatial_resolution = spatial_resolution
+        self.tile = tile
+        self.gain = gain
+        self.in_memory = in_memory
+        self.output_profile = output_profile if output_profile is not None else OutputProfile.legacy()
+        self.paths = {}
+        self.datasets = {}
+        self.arrays: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+        self.rgb = None
+        self.rgb_buffer_bytes = rgb_buffer_bytes
+        #  (tile row, tile column) -> channels of the incomplete tile and the number of pixels of each channel
+        self._rgb_pending: Dict[Tuple[int, int], Tuple[np.ndarray, np.ndarray]] = {}
+        self._rgb_written = set()
+        self._rgb_deferred = False
+        if in_memory:
+            shape = (int(prof["height"]), int(prof["width"]))
+            self.arrays = {key: np.zeros(shape=shape, dtype=np.uint16) for key in keys}
+            return
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            log.warning("Result directory already exists. File will be deleted.")
+            shutil.rmtree(path)
+            os.mkdir(path)
+        self.lut = stretch_lut(gain, 0, 4096)
+        for key in keys:
+            self.paths[key] = path + os.path.sep + key + "_" + str(spatial_resolution) + ".tif"
+            self.datasets[key] = rasterio.open(self._target(self.paths[key]), 'w',
+                                               **self.output_profile.profile(prof, "uint16"))
+        if all(band in keys for band in ResultSink.rgb_bands):
+            self.paths["rgb"] = path + os.path.sep + f"{tile}_rgb.tif"
+            self.rgb = rasterio.open(self.paths["rgb"], 'w', **ResultSink.rgb_profile(prof))
+
+    @staticmethod
+    def rgb_profile(prof: RasterioProfile) -> dict:
+        rgb_profile = dict(prof)
+        rgb_profile.update(width=int(prof["width"]), height=int(prof["height"]))
+        rgb_profile.update(dtype='uint8', count=3, driver="GTiff", interleave="PIXEL", photometric="YCBCR",
+                           compress="JPEG", tiled=True, blockxsize=ResultSink.rgb_tile,
+                           blockysize=ResultSink.rgb_tile, nodata=0)
+        return rgb_profile
+
+    def _target(self, path: str) -> str:
+        """
+        COG is not writable block by block, the data are streamed to a temporary GeoTIFF and copied on close.
+        """
+        return path + ".tmp.tif" if self.output_profile.layout == "COG" else path
+
+    def write(self, key: str, data: np.ndarray, window: Window = None) -> None:
+        """
+        :param key: band, e.g. 'B02' or 'DOY'
+        :param data: 2D array of the window (whole raster if window is None)
+        :param window: rasterio window
+        """
+        data = data.astype(np.uint16, copy=False)
+        if self.in_memory:
+            self.arrays[key][window.toslices() if window is not None else ...] = data
+            return
+        with self._lock:
+            self.datasets[key].write(data, 1, window=window)
+            if self.rgb is not None and key in ResultSink.rgb_bands:
+                self._write_rgb(key, data, window)
+
+    def _tile_window(self, ty: int, tx: int) -> Window:
+        t = ResultSink.rgb_tile
+        return Window(col_off=tx * t, row_off=ty * t, width=min(t, self.rgb.width - tx * t),
+                      height=min(t, self.rgb.height - ty * t))
+
+    def _write_rgb(self, key: str, data: np.ndarray, window: Window) -> None:
+        """
+        JPEG tiles must not be rewritten, the window is copied into the tiles it overlaps and a tile is written once
+        all three channels of it are present.
+        """
+        if self._rgb_deferred:
+            return
+        if window is None:
+            window = Window(col_off=0, row_off=0, width=self.rgb.width, height=self.rgb.height)
+        channel = ResultSink.rgb_bands.index(key)
+        values = apply_lut(data, self.lut)
+        t = ResultSink.rgb_tile
+        row_end, col_end = window.row_off + window.height, window.col_off + window.width
+        for ty in range(window.row_off // t, (row_end - 1) // t + 1):
+            for tx in range(window.col_off // t, (col_end - 1) // t + 1):
+                tile = self._tile_window(ty, tx)
+                y0, y1 = max(tile.row_off, window.row_off), min(tile.row_off + tile.height, row_end)
+                x0, x1 = max(tile.col_off, window.col_off), min(tile.col_off + tile.width, col_end)
+                if (ty, tx) not in self._rgb_pending:
+                    self._rgb_pending[(ty, tx)] = (np.zeros(shape=(3, tile.height, tile.width), dtype=np.uint8),
+                                                   np.zeros(shape=3, dtype=np.int64))
+                channels, filled = self._rgb_pending[(ty, tx)]
+                channels[channel, y0 - tile.row_off:y1 - tile.row_off, x0 - tile.col_off:x1 - tile.col_off] = \
+                    values[y0 - window.row_off:y1 - window.row_off, x0 - window.col_off:x1 - window.col_off]
+                filled[channel] += (y1 - y0) * (x1 - x0)
+                if (filled >= tile.height * tile.width).all():
+                    self.rgb.write(channels, window=tile)
+                    self._rgb_written.add((ty, tx))
+                    del self._rgb_pending[(ty, tx)]
+        if len(self._rgb_pending) * 3 * t * t > self.rgb_buffer_bytes:
+            log.info("RGB channels do not arrive together, the quicklook is going to be read from the band files")
+            self._rgb_deferred = True
+            self._rgb_pending.clear()
+
+    def _rgb_from_files(self) -> None:
+        """
+        Write the tiles that were not completed in flight from the closed band files.
+        """
+        t = ResultSink.rgb_tile
+        tiles = [(ty, tx) for ty in range((self.rgb.height - 1) // t + 1) for tx in range((self.rgb.width - 1) // t + 1)
+                 if (ty, tx) not in self._rgb_written]
+        if len(tiles) == 0:
+            return
+        log.debug(f"Reading {len(tiles)} RGB tile(s) from the band files")
+        datasets = [rasterio.open(self.paths[key]) for key in ResultSink.rgb_bands]
+        try:
+            for ty, tx in tiles:
+                tile = self._tile_window(ty, tx)
+                self.rgb.write(apply_lut(np.stack([d.read(1, window=tile) for d in datasets]), self.lut), window=tile)
+        finally:
+            for dataset in datasets:
+                dataset.close()
+
+    def close(self) -> Dict[str, str]:
+        """
+        Flush and close all datasets.
+        :return: key -> path to the file, nothing for the in-memory sink
+        """
+        if self.in_memory:
+            return {}
+        for key, dataset in self.datasets.items():
+            dataset.close()
+            if self.output_profile.layout == "COG":
+                self._to_cog(self._target(self.paths[key]), self.paths[key])
+        if self.rgb is not None:
+            self._rgb_pending.clear()
+            self._rgb_from_files()
+            self.rgb.build_overviews([2, 4, 8, 16, 32], Resampling.nearest)
+            self.rgb.update_tags(ns='rio_overview', resampling='nearest')
+            self.rgb.close()
+        return self.paths
+
+    def persist(self) -> Dict[str, str]:
+        """
+        Write the in-memory result to the path, the same files as the streaming sink would produce.
+        :return: key -> path to the file
+        """
+        if not self.in_memory:
+            return self.paths
+        sink = ResultSink(self.path, self.keys, self.prof, self.spatial_resolution, self.tile, self.output_profile,
+                          self.gain)
+        for key, data in self.arrays.items():
+            sink.write(key, data)
+        return sink.close()
+
+    def result(self, bands: List[str]) -> S2Granule:
+        """
+        Result granule of the closed sink, in-memory sink gives the granule backed by its arrays.
+        :param bands: bands of the granule, e.g. output bands and 'rgb' (in-memory granule has no RGB
+        until it is persisted)
+        """
+        if not self.in_memory:
+            if all(re.fullmatch(ResultSink.band_pattern, key) for key in bands):
+                return S2Granule(self.path, self.spatial_resolution, bands)
+            # files of other keys (e.g. B04_Q50) are not recognized by the name
+            return S2Granule.from_files(self.path, self.spatial_resolution,
+                                        {key: self.paths[key] for key in bands if key in self.paths})
+        return S2Granule.from_arrays(self.path, self.spatial_resolution,
+                                     {key: self.arrays[key] for key in bands if key in self.arrays}, self.prof, self)
+
+    def _to_cog(self, tmp_path: str, path: str) -> None:
+        with rasterio.open(tmp_path, 'r+') as tmp:
+            if len(self.output_profile.overviews) > 0:
+                tmp.build_overviews(self.output_profile.overviews, Resampling.nearest)
+                tmp.update_tags(ns='rio_overview', resampling='nearest')
+        with rasterio.open(tmp_path) as tmp:
+            self.output_profile.copy_as_cog(tmp, path, self.output_profile.profile(tmp.profile))
+        os.remove(tmp_path)
@@ -0,0 +1,111 @@
+import os
+
+from Pipeline.logger import log
+
+
+class RuntimeConfig:
+    """
+    Thread budget of the pipeline process.
+    The budget (all cores by default) is split among the workers that run at the same time, each worker then
+    shares its part among numba, GDAL/OpenJPEG decoding and compression, and the pipeline's own pools.
+    Use the module level instance `runtime` (Pipeline.Runtime.runtime) and configure it with `configure`.
+    Process of the scheduler's pool is daemonic, it must not start process pools of its own (not allowed on
+    Python 3.7), stages that would use one run in the process instead.
+    Under the scheduler the number of workers is a counter shared with the scheduler (running), the share of
+    a job grows as the other jobs finish and it is rebalanced whenever the job creates a pool.
+    """
+
+    def __init__(self, threads: int = None, workers: int = 1, gdal_cache_mb: int = None, daemon: bool = False):
+        """
+        :param threads: threads of the whole machine (or job) that we may use
+        :param workers: number of workers running at the same time
+        :param gdal_cache_mb: GDAL block cache of each worker in MB, None keeps the GDAL default
+        :param daemon: the process is a worker of the scheduler's pool
+        """
+        self.threads = threads or os.cpu_count()
+        self.workers = max(1, workers)
+        self.gdal_cache_mb = gdal_cache_mb
+        self.daemon = daemon
+        #  multiprocessing.Value of the jobs running, set in the processes of the scheduler's pool
+        self.running = None
+        #  threads of the worker numba and GDAL were set to, None until apply()
+        self._applied = None
+
+    @property
+    def worker_threads(self) -> int:
+        """
+        Threads of one worker.
+        """
+        workers = self.workers
+        if self.running is not None and self.running.value > 0:
+            workers = self.running.value
+        return max(1, self.threads // workers)
+
+    def pool_size(self, requested: int = None) -> int:
+        """
+        Size of a pool of the pipeline, it never exceeds the budget of the worker.
+        :param requested: size the pool would like to have
+        """
+        if self.running is not None:
+            #  the share of the scheduler's job changes as the other jobs finish
+            self.rebalance()
+        if requested is None:
+            return self.worker_threads
+        return max(1, min(requested, self.worker_threads))
+
+    def rebalance(self) -> None:
+        """
+        Apply the budget if it has not been applied yet or the share of the worker changed since.
+        """
+        if self._applied != self.worker_threads:
+            self.apply()
+
+    def apply(self) -> None:
+        """
+        Propagate the budget to numba and GDAL of this process.
+        """
+        threads = self.worker_threads
+        self._applied = threads
+        try:
+            import numba
+            numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+        except (ImportError, ValueError) as e:
+            log.warning(f"Unable to set numba threads: {e}")
+        #  GDAL reads the options from the environment when they are not set explicitly,
+        #  this covers osgeo and the GDAL that is bundled with rasterio as well
+        os.environ["GDAL_NUM_THREADS"] = str(threads)
+        os.environ["OPJ_NUM_THREADS"] = str(threads)
+        #  GDAL_CACHEMAX is read once, when the block cache is initialized, the size is set explicitly,
+        #  rasterio bundles its own GDAL
+        if self.gdal_cache_mb is not None:
+            try:
+                import rasterio.env
+                rasterio.env.set_gdal_config("GDAL_CACHEMAX", self.gdal_cache_mb * 1024 ** 2)
+            except ImportError:
+                pass
+        try:
+            from osgeo import gdal
+            gdal.SetConfigOption("GDAL_NUM_THREADS", str(threads))
+            if self.gdal_cache_mb is not None:
+                gdal.SetCacheMax(self.gdal_cache_mb * 1024 ** 2)
+        except ImportError:
+            pass
+        log.debug(f"Runtime: {self}")
+
+    def __str__(self):
+        return f"threads: {self.threads}, workers: {self.workers}, threads per worker: {self.worker_threads}, " \
+               f"GDAL cache: {self.gdal_cache_mb or 'default'} MB" + (", daemon" if self.daemon else "")
+
+
+runtime = RuntimeConfig()
+
+
+def configure(threads: int = None, workers: int = 1, gdal_cache_mb: int = None) -> RuntimeConfig:
+    """
+    Update the runtime of this process and apply it.
+    """
+    runtime.threads = threads or os.cpu_count()
+    runtime.workers = max(1, workers)
+    runtime.gdal_cache_mb = gdal_cache_mb
+    runtime.apply()
+    return runtime
@@ -0,0 +1,190 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Type, Iterator, Optional, Union, Dict
+
+from Pipeline.Granule import S2Granule
+from Pipeline.logger import log
+from Pipeline.Runtime import runtime, configure
+from Pipeline.Precision import PrecisionPolicy, precision, set_precision
+from Pipeline.Task import Task
+from Pipeline.Worker import S2Worker
+from Pipeline.utils import get_subdirectories, s2_is_safe_format, s2_get_resolution, bands_for_resolution, \
+    total_memory
+
+
+class JobResult:
+    """
+    Outcome of one tile.
+    """
+
+    def __init__(self, path: str, success: bool, result_path: Union[str, Dict[str, str]] = None,
+                 error: Exception = None, elapsed: float = 0.0):
+        """
+        :param result_path: directory of the result granule, product name -> directory for MultiProduct
+        """
+        self.path = path
+        self.success = success
+        self.result_path = result_path
+        self.error = error
+        self.elapsed = elapsed
+
+    def __str__(self):
+        state = f"done in {self.elapsed:.1f}s" if self.success else f"failed: {self.error}"
+        return f"{self.path} {state}"
+
+
+class _Job:
+    def __init__(self, path: str, estimate: int):
+        self.path = path
+        self.estimate = estimate
+        self.started = 0.0
+        self.attempts = 0
+
+
+def _init_process(threads: int, workers: int, gdal_cache_mb: int, policy: PrecisionPolicy, running) -> None:
+    """
+    Each process of the pool gets its share of the thread budget and the precision policy of the scheduler.
+    :param running: multiprocessing.Value, number of the jobs running, kept up to date by the scheduler
+    """
+    runtime.running = running
+    configure(threads, workers, gdal_cache_mb)
+    runtime.daemon = True
+    set_precision(policy)
+
+
+def _run_job(path: str, task: Type[Task], spatial_resolution: int, worker_kwargs: dict,
+             task_kwargs: dict) -> Union[str, Dict[str, str]]:
+    """
+    Runs inside of the worker process, the thread budget is split among the jobs running (see RuntimeConfig).
+    :return: path to the result granule, product name -> path for the tasks that give several granules
+    """
+    runtime.rebalance()
+    worker = S2Worker(path, spatial_resolution, **worker_kwargs)
+    result = task.perform_computation(worker, **task_kwargs)
+    #  Jobs hand the results over as files, in-memory results (in_memory_results) are written here
+    if isinstance(result, dict):
+        return {name: granule.persist() for name, granule in result.items()}
+    if isinstance(result, S2Granule):
+        return result.persist()
+    return worker.get_save_path()
+
+
+class S2Scheduler:
+    """
+    Runs the task over many tiles (mercator directories) in a process pool.
+    Jobs are started as long as their estimated memory fits into the RAM budget and there is a free core,
+    job bigger than the whole budget runs alone. Thread budget of the runtime is split among the jobs running,
+    the number of them is shared with the processes, so the jobs get more threads as the others finish.
+    """
+
+    def __init__(self, paths: List[str], task: Type[Task], spatial_resolution: int, worker_kwargs: dict = None,
+                 task_kwargs: dict = None, max_memory: int = None, max_workers: int = None, retries: int = 1):
+        """
+        :param paths: mercator directories, e.g. [.../T33UXQ, .../T33UXR]
+        :param task: Task subclass, e.g. NdviPerPixel
+        :param spatial_resolution: working resolution of the workers
+        :param worker_kwargs: other arguments of S2Worker (output_bands, slice_index, ...)
+        :param task_kwargs: arguments of task.perform_computation
+        :param max_memory: RAM budget in bytes, 80% of the physical memory by default
+        :param max_workers: number of processes, runtime threads by default
+        :param retries: how many times a job is resubmitted when the process pool breaks under it
+        (e.g. a process killed by the OOM killer)
+        """
+        self.paths = paths
+        self.task = task
+        self.spatial_resolution = spatial_resolution
+        self.worker_kwargs = worker_kwargs or {}
+        self.task_kwargs = task_kwargs or {}
+        memory = total_memory()
+        self.max_memory = max_memory or (int(memory * 0.8) if memory is not None else None)
+        self.max_workers = min(max_workers or runtime.threads, max(1, len(paths)))
+        self.retries = retries
+        self._running = multiprocessing.Value("i", 0)
+
+    def estimate_memory(self, path: str) -> int:
+        """
+        Estimated peak memory of the job in bytes.
+        """
+        granules = len([d for d in get_subdirectories(path) if s2_is_safe_format(d)])
+        bands = len(self.worker_kwargs.get("output_bands") or bands_for_resolution(self.spatial_resolution))
+        x, y = s2_get_resolution(self.spatial_resolution)
+        return self.task.memory_estimate(granules, bands, int(x * y), **self.task_kwargs)
+
+    def _fits(self, job: _Job, running: List[_Job]) -> bool:
+        if len(running) == 0 or self.max_memory is None:
+            return True
+        return sum(j.estimate for j in running) + job.estimate <= self.max_memory
+
+    def _executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_process,
+                                   initargs=(runtime.threads, self.max_workers, runtime.gdal_cache_mb, precision,
+                                             self._running))
+
+    def run(self) -> Iterator[JobResult]:
+        """
+        Run all jobs, results are streamed as the tiles finish (not in the order of paths).
+        """
+        pending = [_Job(path, self.estimate_memory(path)) for path in self.paths]
+        total = len(pending)
+        for job in pending:
+            log.info(f"{job.path}: estimated memory {job.estimate / 1024 ** 3:.2f} GiB")
+        finished = 0
+        running = {}
+        executor = self._executor()
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                #  First fit, jobs that do not fit now wait for the memory to be released,
+                #  the thread budget is split among the jobs running once these have started
+                starting = []
+                for job in list(pending):
+                    if len(running) + len(starting) >= self.max_workers:
+                        break
+                    if not self._fits(job, list(running.values()) + starting):
+                        continue
+                    pending.remove(job)
+                    starting.append(job)
+                self._running.value = len(running) + len(starting)
+                for job in starting:
+                    job.started = time.time()
+                    future = executor.submit(_run_job, job.path, self.task, self.spatial_resolution,
+                                             self.worker_kwargs, self.task_kwargs)
+                    running[future] = job
+                    log.info(f"Started {job.path}, running: {len(running)}, pending: {len(pending)}")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = any(isinstance(future.exception(), BrokenProcessPool) for future in done)
+                if broken:
+                    #  Process was killed (e.g. OOM), the pool is unusable and all its jobs are lost,
+                    #  they are resubmitted to a new pool unless they ran out of retries
+                    log.error("Process pool is broken, starting a new one")
+                    for future in list(running):
+                        if future not in done:
+                            future.cancel()
+                            done.add(future)
+                    executor.shutdown(wait=False)
+                    executor = self._executor()
+                for future in done:
+                    job = running.pop(future)
+                    self._running.value = len(running)
+                    elapsed = time.time() - job.started
+                    error = future.exception() if future.done() and not future.cancelled() else \
+                        BrokenProcessPool("Process pool is broken")
+                    if isinstance(error, BrokenProcessPool) and job.attempts < self.retries:
+                        job.attempts += 1
+                        pending.insert(0, job)
+                        log.warning(f"{job.path} is resubmitted ({job.attempts}/{self.retries})")
+                        continue
+                    finished += 1
+                    if error is None:
+                        result = JobResult(job.path, True, future.result(), elapsed=elapsed)
+                        log.info(f"[{finished}/{total}] {result}")
+                    else:
+                        result = JobResult(job.path, False, error=error, elapsed=elapsed)
+                        log.error(f"[{finished}/{total}] {result}")
+                    yield result
+        finally:
+            executor.shutdown(wait=True)
+
+    def run_all(self) -> List[JobResult]:
+        return list(self.run())
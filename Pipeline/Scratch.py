@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+from typing import Tuple, Union, Dict
+
+import numpy as np
+
+from Pipeline.logger import log
+
+
+class Scratch:
+    """
+    Out-of-core storage of the large intermediates of a task (current max NDVI, result, stacked batches).
+    Arrays are memory-mapped .npy files in a private directory under the scratch path, the OS keeps only the pages
+    in use in the memory and writes the rest back, so a job may need more memory than the machine has.
+    Arrays are (band, y, x) and the kernels walk them row by row, each band plane is read and written sequentially.
+    array() has the same signature as Checkpoint.array and StripeExecutor.array.
+    Scratch without a path is disabled, arrays live in memory. Use as a context manager, files are removed on exit.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        :param path: scratch directory, e.g. a local SSD, None disables out-of-core arrays
+        """
+        self.path = None
+        self.arrays: Dict[str, np.memmap] = {}
+        if path is None:
+            return
+        os.makedirs(path, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix="cloudless_", dir=path)
+        log.info(f"Out-of-core intermediates in {self.path}")
+
+    def __enter__(self) -> 'Scratch':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def _file(self, name: str) -> str:
+        return self.path + os.path.sep + name + ".npy"
+
+    def array(self, name: str, shape: Tuple, dtype, fill: Union[int, float, np.ndarray, None] = 0) -> np.ndarray:
+        """
+        :param fill: initial value, scalar or array of the shape, None leaves the array uninitialized
+        (zeros of a sparse file, no page is touched)
+        """
+        if not self.enabled:
+            if isinstance(fill, np.ndarray):
+                return fill.astype(dtype, copy=False)
+            return np.zeros(shape, dtype=dtype) if fill is None else np.full(shape, fill, dtype=dtype)
+        array = np.lib.format.open_memmap(self._file(name), mode="w+", dtype=dtype, shape=tuple(shape))
+        if fill is not None and not (np.isscalar(fill) and fill == 0):
+            # the file is sparse and reads as zeros already
+            array[...] = fill
+        self.arrays[name] = array
+        return array
+
+    def release(self, name: str) -> None:
+        """
+        Array is not needed anymore, its file is deleted (the pages of existing views stay valid until they are
+        garbage collected).
+        """
+        if self.arrays.pop(name, None) is None:
+            return
+        try:
+            os.remove(self._file(name))
+        except OSError:
+            pass  # still mapped on Windows, removed on close
+
+    def close(self) -> None:
+        self.arrays = {}
+        if self.enabled:
+            shutil.rmtree(self.path, ignore_errors=True)
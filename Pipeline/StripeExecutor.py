@@ -0,0 +1,185 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, Dict, Tuple
+
+import numpy as np
+import rasterio
+from numba.typed import List as LIST
+from rasterio.windows import Window
+
+from Pipeline.Checkpoint import Checkpoint
+from Pipeline.Indices import _normalized_difference, ndvi_mask, ndvi_mask_bands
+from Pipeline.logger import log
+from Pipeline.Mask import S2JIT
+from Pipeline.Precision import precision
+from Pipeline.Runtime import runtime, configure
+
+
+def _attach(spec: Tuple) -> Tuple[np.ndarray, object]:
+    """
+    Open the shared output in the worker process.
+    :param spec: ("shm", name, shape, dtype) or ("file", path) of a memory-mapped .npy
+    :return: array and the handle which has to be closed
+    """
+    if spec[0] == "file":
+        array = np.load(spec[1], mmap_mode="r+")
+        return array, array
+    shm = shared_memory.SharedMemory(name=spec[1])
+    return np.ndarray(spec[2], dtype=np.dtype(spec[3]), buffer=shm.buf), shm
+
+
+def _ndvi_stripe(start: int, stop: int, granules: List[Tuple[Dict[str, str], int]], output_bands: List[str],
+                 outputs: Dict[str, Tuple], constraint: int, index_dtype: str) -> int:
+    """
+    Whole NdviPerPixel pipeline (read -> mask -> select) of the rows [start, stop), runs in the worker process.
+    Each worker decodes its own stripe of the inputs, results are written straight to the shared outputs.
+    :param granules: (band -> path, doy) of each granule, in the order of processing, the paths hold the output
+    bands and the bands of the NDVI mask
+    :param index_dtype: type NDVI is computed in, precision.index of the parent process
+    :return: number of processed rows
+    """
+    handles = []
+    views = {}
+    for key, spec in outputs.items():
+        array, handle = _attach(spec)
+        handles.append(handle)
+        views[key] = array
+    try:
+        ndvi_res = np.asarray(views["ndvi_result"][start:stop])
+        result = np.asarray(views["result"][:, start:stop])
+        doy = np.asarray(views["doy"][start:stop])
+        height, width = ndvi_res.shape
+        window = Window(col_off=0, row_off=start, width=width, height=height)
+        for batch_start in range(0, len(granules), constraint):
+            batch = granules[batch_start: batch_start + constraint]
+            # same type as the max NDVI of the task (see PrecisionPolicy)
+            ndvi_arrays = np.empty(shape=(len(batch), height, width), dtype=ndvi_res.dtype)
+            current_data = LIST()
+            current_doy = LIST()
+            for i, (paths, granule_doy) in enumerate(batch):
+                bands = {}
+                for key in paths:
+                    with rasterio.open(paths[key]) as src:
+                        bands[key] = src.read(1, window=window)
+                # same type as S2IndexEngine computes NdviPerPixel's NDVI in
+                ndvi = np.empty(shape=(height, width), dtype=np.dtype(index_dtype))
+                _normalized_difference(bands["B8A"].astype(ndvi.dtype), bands["B04"].astype(ndvi.dtype), out=ndvi)
+                ndvi_arrays[i] = np.where(ndvi_mask(bands), ndvi, -1)
+                current_data.append(np.stack([bands[key] for key in output_bands]))
+                current_doy.append(granule_doy)
+            S2JIT.s2_ndvi_pixel_analysis(ndvi_arrays, ndvi_res, current_data, current_doy, result, doy,
+                                         width, height)
+        for handle in handles:
+            if isinstance(handle, np.memmap):
+                handle.flush()
+    finally:
+        views = array = ndvi_res = result = doy = None
+        for handle in handles:
+            if isinstance(handle, shared_memory.SharedMemory):
+                handle.close()
+    return stop - start
+
+
+class StripeExecutor:
+    """
+    Multiprocess backend of the per-pixel tasks.
+    The tile is split into row stripes and each worker process runs the whole per-pixel pipeline of its stripe.
+    Outputs live in multiprocessing.shared_memory (or memory-mapped checkpoint files), workers write into them
+    directly and nothing is pickled except the paths and the stripe bounds.
+    Use as a context manager, shared memory is released on exit.
+    """
+
+    def __init__(self, processes: int = None, rows_per_stripe: int = None):
+        """
+        :param processes: number of worker processes, by default the thread budget of the worker
+        :param rows_per_stripe: height of the stripes, by default the block height of the inputs (JPEG2000 tiles
+        are decoded whole, a stripe across tiles would decode them repeatedly)
+        Raises ValueError in a process of the scheduler's pool (runtime.daemon), daemonic processes can't have
+        children. The tasks check runtime.daemon and fall back to the in-process path before they get here,
+        the error guards direct use.
+        """
+        if runtime.daemon:
+            raise ValueError("StripeExecutor can't start processes in a process of the scheduler")
+        self.processes = processes or runtime.worker_threads
+        self.rows_per_stripe = rows_per_stripe
+        self._shared: Dict[int, shared_memory.SharedMemory] = {}
+
+    def __enter__(self) -> 'StripeExecutor':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def array(self, name: str, shape: Tuple, dtype, fill=0) -> np.ndarray:
+        """
+        Output array in the shared memory, same signature as Checkpoint.array.
+        """
+        dtype = np.dtype(dtype)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array[...] = fill
+        self._shared[id(array)] = shm
+        log.debug(f"Shared array {name} {shape} {dtype}: {shm.name}")
+        return array
+
+    def _spec(self, array: np.ndarray) -> Tuple:
+        if id(array) in self._shared:
+            return "shm", self._shared[id(array)].name, array.shape, array.dtype.str
+        if isinstance(array, np.memmap) and array.filename is not None:
+            return "file", array.filename
+        raise ValueError("Output has to be created by StripeExecutor.array or Checkpoint.array")
+
+    def _stripes(self, height: int, reference: str) -> List[Tuple[int, int]]:
+        rows = self.rows_per_stripe
+        if rows is None:
+            with rasterio.open(reference) as src:
+                rows = src.block_shapes[0][0]
+            #  every process gets at least one stripe
+            rows = min(rows, math.ceil(height / self.processes))
+        return [(start, min(start + rows, height)) for start in range(0, height, rows)]
+
+    def ndvi(self, granules: list, output_bands: List[str], constraint: int, ndvi_result: np.ndarray,
+             result: np.ndarray, doy: np.ndarray, progress: Checkpoint = None) -> None:
+        """
+        Per-pixel NDVI selection of NdviPerPixel, stripe by stripe.
+        :param granules: granules in the order of processing
+        :param constraint: how many granules a worker holds at the same time
+        :param ndvi_result: current max NDVI, updated in place
+        :param result: stacked result bands, updated in place
+        :param doy: DOY of the picked pixels, updated in place
+        :param progress: finished stripes are recorded in the checkpoint and skipped when resuming
+        """
+        if len(granules) == 0:
+            return
+        progress = progress if progress is not None else Checkpoint()
+        inputs = [({key: g.bands[g.spatial_resolution][key].path
+                    for key in output_bands + [key for key in ndvi_mask_bands(g) if key not in output_bands]}, g.doy)
+                  for g in granules]
+        outputs = {"ndvi_result": self._spec(ndvi_result), "result": self._spec(result), "doy": self._spec(doy)}
+        stripes = [(start, stop) for start, stop in self._stripes(ndvi_result.shape[0], inputs[0][0]["B02"])
+                   if not progress.is_done(f"stripe_{start}")]
+        log.info(f"Running {len(stripes)} stripe(s) in {self.processes} process(es)")
+        with ProcessPoolExecutor(max_workers=self.processes, initializer=configure,
+                                 initargs=(runtime.threads, runtime.workers * self.processes,
+                                           runtime.gdal_cache_mb)) as executor:
+            futures = {}
+            for start, stop in stripes:
+                # granules without any data in the stripe are not even opened by the worker
+                window = Window(col_off=0, row_off=start, width=ndvi_result.shape[1], height=stop - start)
+                stripe_inputs = [item for item, g in zip(inputs, granules) if g.block_index().has_data(window)]
+                futures[executor.submit(_ndvi_stripe, start, stop, stripe_inputs, output_bands, outputs, constraint,
+                                        precision.index.str)] = start
+            for future, start in futures.items():
+                future.result()
+                progress.mark_done(f"stripe_{start}")
+
+    def close(self) -> None:
+        for shm in self._shared.values():
+            try:
+                shm.close()
+            except BufferError:
+                # arrays of the task still use the buffer, it is released together with them
+                log.debug(f"Shared memory {shm.name} is still in use, it is unlinked and released with the arrays")
+            shm.unlink()
+        self._shared = {}
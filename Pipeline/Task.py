@@ -1,7 +1,9 @@
 import gc
+import shutil
 from abc import ABC, abstractmethod
 
 import rasterio
+from rasterio.windows import Window
 
 from Pipeline.logger import log
 from Pipeline.Worker import S2Worker
@@ -12,219 +14,835 @@ from Pipeline.Granule import S2Granule
 from Pipeline.utils import *
 from numba.typed import List as LIST
 from Pipeline.Mask import S2JIT
-from Pipeline.Detectors import S2Detectors
+from Pipeline.Detectors import S2Detectors, SCLClassifier
+from Pipeline.CompositeState import CompositeState
+from Pipeline.Checkpoint import Checkpoint
+from Pipeline.Scratch import Scratch
+from Pipeline.Precision import precision
+from Pipeline.Runtime import runtime
+from Pipeline.StripeExecutor import StripeExecutor
+from Pipeline.Prefetch import Prefetcher
+from Pipeline.BestPixel import BestPixelEngine, Scorer, Scorers
+from Pipeline.Indices import ndvi_mask, ndvi_mask_bands, _normalized_difference, NDVI_MASK_BANDS
+from Pipeline.Products import Product, MedianProduct, MaxNdviProduct, PerTileProduct, MultiProductRunner, DoyBin, \
+    temporal_products
 
 
 class Task(ABC):
 
     @staticmethod
     @abstractmethod
-    def perform_computation(worker: S2Worker, *args) -> S2Granule:
-        raise NotImplemented
+    def perform_computation(worker: S2Worker, *args) -> Union[S2Granule, Dict[str, S2Granule]]:
+        """
+        :param worker: s2worker with data
+        :return: result granule, tasks that produce several composites in one pass (MultiProduct) return
+        name -> result granule, each written to its own directory
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def memory_estimate(granules: int, bands: int, pixels: int, **kwargs) -> int:
+        """
+        Rough estimate of the peak memory of the computation, used by the scheduler.
+        :param granules: number of granules in the dataset
+        :param bands: number of output bands
+        :param pixels: number of pixels of one band in the working resolution
+        :param kwargs: arguments of perform_computation
+        :return: bytes
+        """
+        # result, DOY and a copy of the result bands
+        return 2 * (2 * bands + 1) * pixels
+
+    @staticmethod
+    def _row_windows(worker: S2Worker) -> List[Window]:
+        """
+        Full-width row stripes of the block height of the inputs (at least 256 rows), the unit the per-pixel tasks
+        read the granules in.
+        """
+        res_x, res_y = worker.get_res()
+        if worker.polygon is not None:
+            # bands are cropped to the polygon when they are loaded, they are read whole
+            return [Window(col_off=0, row_off=0, width=res_y, height=res_x)]
+        with rasterio.open(worker.granules[0][worker.output_bands[0]].path) as reference:
+            rows = max(reference.block_shapes[0][0], 256)
+        return [Window(col_off=0, row_off=start, width=res_y, height=min(rows, res_x - start))
+                for start in range(0, res_x, rows)]
+
+    @staticmethod
+    def _read_windows(granule: S2Granule, keys: List[str],
+                      windows: List[Window]) -> Iterator[Tuple[Window, Dict[str, np.ndarray]]]:
+        """
+        Read the bands window by window, windows without any data (see S2BlockIndex) are not read at all.
+        :return: (window, band -> block) of the windows with data
+        """
+        for window in windows:
+            if granule.polygon is not None:
+                yield window, {key: granule[key].raster() for key in keys}
+            elif granule.block_index().has_data(window):
+                yield window, {key: granule[key].read_window(window) for key in keys}
+        granule.free_resources()
+
+    @staticmethod
+    def _attach_scl(worker: S2Worker) -> bool:
+        """
+        Make SCL available in all granules for masking, also when it is not among the output bands.
+        :return: False if some granule has no SCL file
+        """
+        for granule in worker.granules:
+            if "SCL" in granule.bands[granule.spatial_resolution]:
+                continue
+            path = granule.find_band_file("SCL")
+            if path is None:
+                return False
+            granule.add_another_band(path, "SCL")
+        return True
 
 
 class NdviPerPixel(Task):
 
     @staticmethod
-    def perform_computation(worker: S2Worker, constraint: int = 5) -> S2Granule:
+    def _granule_bytes(bands: int) -> int:
+        """
+        Bytes per pixel of one granule of a batch, its NDVI and stacked bands, the inputs are read in stripes.
+        """
+        return precision.index.itemsize + np.dtype(np.uint16).itemsize * bands
+
+    @staticmethod
+    def memory_estimate(granules: int, bands: int, pixels: int, constraint: int = 5, scratch: str = None,
+                        **kwargs) -> int:
+        value = np.dtype(np.uint16).itemsize
+        if scratch is not None:
+            # bands (+ NDVI input bands) of the granule being loaded, the rest is on the disk
+            return pixels * 2 * value * (bands + len(NDVI_MASK_BANDS))
+        batch = min(granules, constraint)
+        # current max ndvi, result with DOY and two batches in flight (prefetch)
+        resident = precision.index.itemsize + value * bands + precision.doy.itemsize
+        return pixels * (resident + 2 * batch * NdviPerPixel._granule_bytes(bands))
+
+    @staticmethod
+    def perform_computation(worker: S2Worker, constraint: int = 5, incremental: bool = False,
+                            checkpoint: bool = False, processes: int = None, scratch: str = None) -> S2Granule:
+        """
+        :param worker: s2worker with data
+        :param constraint: how many granules are loaded at the same time
+        :param incremental: fold only the granules that are not in the previous result (see CompositeState)
+        :param checkpoint: keep the intermediate arrays memory-mapped on the disk and resume an interrupted run
+        (see Checkpoint)
+        :param processes: run the whole pipeline in row stripes in this many processes (see StripeExecutor),
+        by default (and under the scheduler) the granules are processed in this process
+        :param scratch: directory of the out-of-core intermediates, max NDVI, result and the batches are
+        memory-mapped files instead of arrays in the memory (see Scratch)
+        """
         # log.info(f"Running optimised ndvi masking. Dataset {worker.main_dataset_path}")
         res_x, res_y = worker.get_res()
-        # we don't need to stack all ndvi arrays, we need just the constraint and result
-        ndvi_arrays = np.zeros(
-            shape=(len(worker.granules) if len(worker.granules) < constraint else constraint, res_x, res_y),
-            dtype=np.float
-        )
+        state = CompositeState.load(worker, "NdviPerPixel") if incremental else None
+        granules = worker.granules if state is None else state.new_granules(worker.granules)
+        if state is not None and len(granules) == 0:
+            log.info("No new granules, the result is up to date")
+            return S2Granule(worker.save_result_path, worker.spatial_resolution, worker.output_bands + ["rgb"])
+        # granules without any data would not win a single pixel, do not even load them
+        granules = [g for g in granules if g.block_index().has_data()]
+        stripes = None
+        if processes is not None:
+            if worker.polygon is not None:
+                log.warning("Stripes are not supported with polygon, granules are processed in this process")
+            elif runtime.daemon:
+                log.warning("Stripes are not supported under the scheduler, granules are processed in this process")
+            else:
+                stripes = StripeExecutor(processes)
+        progress = Checkpoint.for_worker(worker, "NdviPerPixel", granules, constraint=constraint,
+                                         incremental=state is not None, stripes=stripes is not None,
+                                         precision=precision.name) if checkpoint else Checkpoint()
+        space = Scratch(scratch)
+        # outputs of the stripes are in the shared memory, unless they are memory-mapped by the checkpoint
+        # or the scratch
+        allocator = progress
+        if not progress.enabled:
+            allocator = space if space.enabled else stripes if stripes is not None else progress
+        ndvi_init, result_init, doy_init = -10, 1, 0
+        previous = None
+        if state is not None:
+            # continue from the max ndvi and the pixels of the previous result
+            previous = CompositeState.stash_result(worker)
+            if not progress.resumed:
+                ndvi_init = state.arrays["score"]
+                result_init, doy_init = CompositeState.read_result(previous, worker.output_bands,
+                                                                   worker.spatial_resolution)
+        elif incremental:
+            state = CompositeState(CompositeState.state_path(worker), "NdviPerPixel", worker.spatial_resolution,
+                                   worker.output_bands)
         # this ndvi array serves as a holder of the current max ndvi value for this pixel
-        ndvi_result = np.ones(shape=(res_x, res_y), dtype=np.float) * (-10)
-        result = np.ones(shape=(len(worker.output_bands), res_x, res_y), dtype=np.uint16)
-        doy = np.zeros(shape=(res_x, res_y), dtype=np.uint16)
-        log.info(f"{(len(worker.granules) - 1) // constraint + 1} iteration(s) expected!")
-        for iteration in range((len(worker.granules) - 1) // constraint + 1):
+        ndvi_result = allocator.array("ndvi_result", (res_x, res_y), precision.index, ndvi_init)
+        result = allocator.array("result", (len(worker.output_bands), res_x, res_y), np.uint16, result_init)
+        doy = allocator.array("doy", (res_x, res_y), precision.doy, doy_init)
+        del ndvi_init, result_init, doy_init
+        if stripes is not None:
+            stripes.ndvi(granules, worker.output_bands, constraint, ndvi_result, result, doy, progress)
+        else:
+            NdviPerPixel._select(worker, granules, constraint, ndvi_result, result, doy, progress, space)
+
+        gc.collect()
+        log.info("Saving result to the files...")
+        # the previous result of the incremental run is replaced by the files of this one
+        sink = worker.open_result_sink(in_memory=False if incremental else None)
+        for i, band in enumerate(worker.output_bands, 0):
+            sink.write(band, result[i])
+        sink.write("DOY", doy)
+        sink.close()
+        if state is not None:
+            state.update(worker.granules, {"score": ndvi_result})
+            state.save()
+        progress.remove()
+        if stripes is not None:
+            stripes.close()
+        del ndvi_result, result, doy
+        space.close()
+        if previous is not None:
+            shutil.rmtree(previous)
+        log.info("Done!")
+        worker.release_bands()
+        # If there's an intention to work further with the files
+        # Return result Granule
+        return sink.result(worker.output_bands + ["rgb"])
+
+    @staticmethod
+    def _select(worker: S2Worker, granules: List[S2Granule], constraint: int, ndvi_result: np.ndarray,
+                result: np.ndarray, doy: np.ndarray, progress: Checkpoint, scratch: Scratch = None) -> None:
+        """
+        Per-pixel selection in this process, granules are loaded batch by batch.
+        Next batch is loaded in the background while the kernel processes the current one.
+        Granules are read in row stripes, the stripes without any data are left empty (NDVI -1) and not decoded.
+        With scratch, batches are memory-mapped, only the stripe being read is in the memory.
+        """
+        res_x, res_y = ndvi_result.shape
+        scratch = scratch if scratch is not None else Scratch()
+        windows = Task._row_windows(worker)
+
+        def load(iteration: int):
             # compute NDVI
             current_doy = LIST()
             current_data = LIST()
             log.info(f"Calculating NDVI arrays for iteration {iteration}")
             # Acquire first batch of granules, for instance constraint=4, granules=[0,1,2,3]
-            workers = worker.granules[iteration * constraint: (iteration + 1) * constraint]
+            workers = granules[iteration * constraint: (iteration + 1) * constraint]
+            # we don't need to stack all ndvi arrays, we need just the batch
+            ndvi_arrays = scratch.array(f"ndvi_{iteration}", (len(workers), res_x, res_y), precision.index, -1)
             for i, w in enumerate(workers, 0):
                 current_doy.append(w.doy)
-                # Prepare data
-                w.load_bands()
-                GranuleCalculator.s2_ndvi(w)
-                # TODO: take mask as function (like per-tile)
-                mask = (w["B02"] > 100) & (w["B04"] > 100) & (w["B8A"] > 500) & (w["B8A"] < 8000) & (w["AOT"] < 100)
-                ndvi_arrays[i] = np.ma.array(w.temp["NDVI"], mask=~mask, fill_value=-1).filled()
-                del mask
-                current_data.append(w.stack_bands(worker.output_bands))
-                w.free_resources()  # We have copied the resources to the new numpy array inside current_data
-            S2JIT.s2_ndvi_pixel_analysis(ndvi_arrays, ndvi_result, current_data, current_doy, result, doy, res_x, res_y)
-            log.debug(f"Done!")
-            current_data = LIST()  # last iteration, del the pointer to the arrays
+                keys = worker.output_bands + [key for key in ndvi_mask_bands(w) if key not in worker.output_bands]
+                stack = scratch.array(f"stack_{iteration}_{i}", (len(worker.output_bands), res_x, res_y), np.uint16,
+                                      None)
+                for window, bands in Task._read_windows(w, keys, windows):
+                    # same computation as S2IndexEngine, window by window
+                    ndvi = np.empty(shape=(window.height, window.width), dtype=precision.index)
+                    _normalized_difference(bands["B8A"].astype(ndvi.dtype), bands["B04"].astype(ndvi.dtype), out=ndvi)
+                    ndvi_arrays[i][window.toslices()] = np.where(ndvi_mask(bands), ndvi, -1)
+                    for k, band in enumerate(worker.output_bands):
+                        stack[k][window.toslices()] = bands[band]
+                current_data.append(np.asarray(stack))
+            return iteration, np.asarray(ndvi_arrays), current_data, current_doy
 
-        # Init
-        for i, band in enumerate(worker.output_bands, 0):
-            worker.result[band] = result[i]
-        worker.result["DOY"] = doy
-        gc.collect()
-        log.info("Saving result to the files...")
-        worker._save_result()  # Save result into files
-        r, g, b = extract_rgb_paths(worker.save_result_path)
-        create_rgb_uint8(r, g, b, worker.save_result_path, worker.mercator)
-        log.info("Done!")
-        worker.release_bands()
-        # If there's an intention to work further with the files
-        # Return result Granule
-        return S2Granule(worker.save_result_path, worker.spatial_resolution, worker.output_bands + ["rgb"])
+        iterations = [iteration for iteration in range((len(granules) - 1) // constraint + 1)
+                      if not progress.is_done(f"batch_{iteration}")]
+        log.info(f"{len(iterations)} iteration(s) expected!")
+        batch_bytes = min(len(granules), constraint) * res_x * res_y * \
+            NdviPerPixel._granule_bytes(len(worker.output_bands))
+        if scratch.enabled:
+            batch_bytes = res_x * res_y * np.dtype(np.uint16).itemsize * (len(worker.output_bands) +
+                                                                          len(NDVI_MASK_BANDS))
+        for iteration, ndvi_arrays, current_data, current_doy in Prefetcher(iterations, load,
+                                                                            item_bytes=batch_bytes):
+            # memory maps are passed as plain ndarray views of the same buffer
+            S2JIT.s2_ndvi_pixel_analysis(ndvi_arrays, np.asarray(ndvi_result), current_data, current_doy,
+                                         np.asarray(result), np.asarray(doy), res_x, res_y)
+            # batch interrupted in the middle is repeated, taking the max again does not change the result
+            progress.mark_done(f"batch_{iteration}")
+            log.debug(f"Done!")
+            del ndvi_arrays, current_data  # the prefetcher loads the next batch once this one is released
+            scratch.release(f"ndvi_{iteration}")
+            for i in range(constraint):
+                scratch.release(f"stack_{iteration}_{i}")
 
 
 class S2CloudlessPerPixel(Task):
 
     @staticmethod
-    def perform_computation(worker: S2Worker, constraint: int = 10) -> S2Granule:
+    def memory_estimate(granules: int, bands: int, pixels: int, constraint: int = 10, lazy_masks: bool = False,
+                        scratch: str = None, **kwargs) -> int:
+        batch = min(granules, constraint)
+        # 160m masks are 64 times smaller than the working resolution at 20m, negligible
+        mask = 0 if lazy_masks else precision.probability.itemsize
+        if scratch is not None:
+            # masks and the bands of the granule being loaded, the rest is on the disk
+            return pixels * (2 * batch * mask + 2 * 2 * bands)
+        # result with DOY, final mask, probability masks and stacks of two batches in flight (prefetch)
+        return pixels * (2 * (bands + 1) + precision.probability.itemsize + 2 * batch * (mask + 2 * bands))
+
+    @staticmethod
+    def perform_computation(worker: S2Worker, constraint: int = 10, incremental: bool = False,
+                            checkpoint: bool = False, lazy_masks: bool = False, scratch: str = None) -> S2Granule:
         """
         This method uses the s2cloudless algorithm provided by sentinel hub to mask the images.
         Uses the detector that is also used for the per-tile.
         :param worker: s2worker with data
         :param constraint: how many mask we allow to be opened at the same time
+        :param incremental: fold only the granules that are not in the previous result (see CompositeState),
+        new granules are folded after the old ones
+        :param checkpoint: keep the intermediate arrays memory-mapped on the disk and resume an interrupted run
+        (see Checkpoint)
+        :param lazy_masks: keep the masks in 160m and map the pixels to them in the kernel (see CoarseMask),
+        otherwise the masks are up-sampled to the working resolution. Opt-in, no data are then the pixels without
+        data in all the bands instead of SCL no data
+        :param scratch: directory of the out-of-core intermediates, result, min probability and the batches are
+        memory-mapped files instead of arrays in the memory (see Scratch)
         :return: masked granule
         """
         res_x, res_y = worker.get_res()
-        result = np.ones(shape=(len(worker.output_bands), res_x, res_y), dtype=np.uint16)
-        doy = np.zeros(shape=(res_x, res_y), dtype=np.uint16)
-        #  We will provide probability mask as the result as well
-        final_mask = np.ones(shape=(res_x, res_y), dtype=np.int) * 255
         #  First thing, we will sort the granules based on their doy, so we get the latest result
         worker.granules.sort(key=lambda x: x.doy)
-        #  Each iteration we are going to compute the mask and then run the jitted function on the data
-        log.info(f"{(len(worker.granules) - 1) // constraint + 1} iteration(s) expected!")
-        for iteration in range((len(worker.granules) - 1) // constraint + 1):
+        state = CompositeState.load(worker, "S2CloudlessPerPixel") if incremental else None
+        granules = worker.granules if state is None else state.new_granules(worker.granules)
+        if state is not None and len(granules) == 0:
+            log.info("No new granules, the result is up to date")
+            return S2Granule(worker.save_result_path, worker.spatial_resolution, worker.output_bands + ["rgb"])
+        #  Empty granules are skipped, this also saves the download of their L1C counterpart
+        valid_granules = [g for g in granules if g.block_index().has_data()]
+        progress = Checkpoint.for_worker(worker, "S2CloudlessPerPixel", valid_granules, constraint=constraint,
+                                         incremental=state is not None,
+                                         precision=precision.name) if checkpoint else Checkpoint()
+        result_init, doy_init, mask_init = 1, 0, 255
+        previous = None
+        if state is not None:
+            #  continue from the min probability and the pixels of the previous result
+            previous = CompositeState.stash_result(worker)
+            if not progress.resumed:
+                mask_init = state.arrays["score"]
+                result_init, doy_init = CompositeState.read_result(previous, worker.output_bands,
+                                                                   worker.spatial_resolution)
+        elif incremental:
+            state = CompositeState(CompositeState.state_path(worker), "S2CloudlessPerPixel",
+                                   worker.spatial_resolution, worker.output_bands)
+        space = Scratch(scratch)
+        allocator = space if space.enabled and not progress.enabled else progress
+        result = allocator.array("result", (len(worker.output_bands), res_x, res_y), np.uint16, result_init)
+        doy = allocator.array("doy", (res_x, res_y), precision.doy, doy_init)
+        #  We will provide probability mask as the result as well, 255 (no data) fits the compact uint8 as well
+        final_mask = allocator.array("final_mask", (res_x, res_y), precision.probability, mask_init)
+        del result_init, doy_init, mask_init
+        iterations = [iteration for iteration in range((len(valid_granules) - 1) // constraint + 1)
+                      if not progress.is_done(f"batch_{iteration}")]
+        #  Masks are prepared in the background (downloads and inference) while we consume them batch by batch,
+        #  batches from the checkpoint do not need them
+        masks = S2Detectors.sentinel_cloudless_batch(
+            [g for it in iterations for g in valid_granules[it * constraint: (it + 1) * constraint]], probability=True,
+            lazy=lazy_masks)
+        windows = Task._row_windows(worker)
+
+        def load(iteration: int):
             current_doy = LIST()
             current_masks = LIST()  # mind these are probability masks !!
             current_data = LIST()
+            mask_rows, mask_cols = LIST(), LIST()
             # Acquire first batch of granules, for instance constraint=4, granules=[0,1,2,3]
-            granules = worker.granules[iteration * constraint: (iteration + 1) * constraint]
+            granules = valid_granules[iteration * constraint: (iteration + 1) * constraint]
             for i, g in enumerate(granules, 0):
                 current_doy.append(g.doy)
-                current_masks.append(S2Detectors.sentinel_cloudless(g, probability=True))
-                current_data.append(g.stack_bands(worker.output_bands))
-            S2JIT.s2_cloud_probability_analysis(current_data, current_masks, current_doy, result, doy, final_mask)
+                mask = next(masks)
+                if lazy_masks:
+                    current_masks.append(mask.data)
+                    mask_rows.append(mask.rows)
+                    mask_cols.append(mask.cols)
+                else:
+                    current_masks.append(mask)
+                # stripes without any data stay empty, they are not decoded
+                stack = space.array(f"stack_{iteration}_{i}", (len(worker.output_bands), res_x, res_y), np.uint16,
+                                    None)
+                for window, bands in Task._read_windows(g, worker.output_bands, windows):
+                    for k, band in enumerate(worker.output_bands):
+                        stack[k][window.toslices()] = bands[band]
+                current_data.append(np.asarray(stack))
+            return iteration, current_data, (current_masks, mask_rows, mask_cols), current_doy
+
+        #  Each iteration we are going to compute the mask and then run the jitted function on the data,
+        #  the next batch is stacked in the background meanwhile
+        log.info(f"{len(iterations)} iteration(s) expected!")
+        mask_bytes = 0 if lazy_masks else precision.probability.itemsize
+        batch_bytes = min(len(valid_granules), constraint) * res_x * res_y * \
+            (mask_bytes + (0 if space.enabled else 2 * len(worker.output_bands)))
+        for iteration, current_data, (current_masks, mask_rows, mask_cols), current_doy in \
+                Prefetcher(iterations, load, item_bytes=batch_bytes):
+            if lazy_masks:
+                S2JIT.s2_cloud_probability_analysis_coarse(current_data, current_masks, mask_rows, mask_cols,
+                                                           current_doy, np.asarray(result), np.asarray(doy),
+                                                           np.asarray(final_mask))
+            else:
+                S2JIT.s2_cloud_probability_analysis(current_data, current_masks, current_doy, np.asarray(result),
+                                                    np.asarray(doy), np.asarray(final_mask))
+            #  batch interrupted in the middle is repeated, taking the min again does not change the result
+            progress.mark_done(f"batch_{iteration}")
             del current_data
             del current_masks
+            for i in range(constraint):
+                space.release(f"stack_{iteration}_{i}")
         log.info("Masking done")
         gc.collect()
-        # Init
-        for i, band in enumerate(worker.output_bands, 0):
-            worker.result[band] = result[i]
-        worker.result["DOY"] = doy
         log.info("Saving result to the files...")
-        worker._save_result()  # Save result into files
-        r, g, b = extract_rgb_paths(worker.save_result_path)
-        create_rgb_uint8(r, g, b, worker.save_result_path, worker.mercator)
+        # the previous result of the incremental run is replaced by the files of this one
+        sink = worker.open_result_sink(in_memory=False if incremental else None)
+        for i, band in enumerate(worker.output_bands, 0):
+            sink.write(band, result[i])
+        sink.write("DOY", doy)
+        sink.close()
+        if state is not None:
+            state.update(worker.granules, {"score": final_mask})
+            state.save()
+        progress.remove()
+        del result, doy, final_mask
+        space.close()
+        if previous is not None:
+            shutil.rmtree(previous)
         worker.release_bands()
         # If there's an intention to work further with the files
-        return S2Granule(worker.save_result_path, worker.spatial_resolution, worker.output_bands + ["rgb"])
+        return sink.result(worker.output_bands + ["rgb"])
 
 
 class MedianPerPixel(Task):
+    """
+    Median has no sufficient statistics smaller than the values themselves, it is always computed from all granules.
+    """
+
+    @staticmethod
+    def memory_estimate(granules: int, bands: int, pixels: int, **kwargs) -> int:
+        # blocks of all granules for one window, RGB tiles waiting for the last band are bounded by the sink
+        return granules * 8 * 1024 * 1024 + 64 * 1024 ** 2
 
     @staticmethod
-    def perform_computation(worker: S2Worker, args=None) -> S2Granule:
+    def perform_computation(worker: S2Worker, args=None, checkpoint: bool = False) -> S2Granule:
         """
         This method takes the median of all the pixels.
+        :param checkpoint: computed windows are kept in memory-mapped bands on the disk, interrupted run only
+        computes the missing windows (see Checkpoint)
         """
         log.info(f"Running per-pixel median masking. Dataset {worker.main_dataset_path}")
         log.info(f"Picked bands: {worker.output_bands}, expected iterations: {len(worker.output_bands)}")
-        res_x, res_y = worker.get_res()
+        #  windows are small steps, they are flushed in groups
+        progress = Checkpoint.for_worker(worker, "MedianPerPixel", worker.granules, flush_steps=64,
+                                         flush_seconds=30) if checkpoint else None
+        #  Median has no DOY, windows are written as soon as they are computed
+        sink = worker.open_result_sink(worker.output_bands)
         for i, band_key in enumerate(worker.output_bands, 0):
             #  Reference object for yielding size of window block, since the blocks might not be same in each iteration
             #  this is the best of possible ways to get the block
             reference_object = worker.granules[0][band_key].path
-            worker.result[band_key] = np.ones(shape=(res_x, res_y), dtype=np.uint16)
             with rasterio.open(reference_object) as reference:
+                dtype = reference.dtypes[0]
+                computed = None
+                if progress is not None:
+                    computed = progress.array(band_key, (reference.height, reference.width), np.uint16)
+                windows = []
                 for ji, window in reference.block_windows(1):
+                    step = f"{band_key}_{ji[0]}_{ji[1]}"
+                    if progress is not None and progress.is_done(step):
+                        sink.write(band_key, computed[window.toslices()], window)
+                        continue
+                    windows.append((step, window))
+                block_bytes = len(worker.granules) * reference.block_shapes[0][0] * reference.block_shapes[0][1] * 2
+
+                def load(item):
+                    _step, _window = item
+                    # granules that have no data in this window contribute zeros, no need to decode them
+                    has_data = [granule.block_index().has_data(_window) for granule in worker.granules]
+                    if not any(has_data):
+                        return _step, _window, None
                     current_blocks = LIST()  # array of blocks where for each pixel median is picked
                     for j, granule in enumerate(worker.granules, 0):
-                        current_blocks.append(granule[band_key].rasterio_ref().read(1, window=window))
-                    data = np.stack(current_blocks)
+                        if has_data[j]:
+                            current_blocks.append(granule[band_key].read_window(_window))
+                        else:
+                            current_blocks.append(np.zeros(shape=(_window.height, _window.width), dtype=dtype))
+                    return _step, _window, np.stack(current_blocks)
+
+                # blocks of the next windows are decoded while the median of the current one is computed
+                for step, window, data in Prefetcher(windows, load, depth=2, item_bytes=block_bytes):
+                    if data is None:
+                        sink.write(band_key, np.zeros(shape=(window.height, window.width), dtype=np.uint16), window)
+                        continue
                     median_values = np.median(data, axis=0)
                     res = S2JIT.s2_median_analysis(data, median_values)
                     del data
                     # current_blocks is filled now get the median
-                    worker.result[band_key][window.row_off:window.row_off + window.height,
-                    window.col_off:window.col_off + window.width] = res
+                    sink.write(band_key, res, window)
+                    if progress is not None:
+                        computed[window.toslices()] = res
+                        progress.mark_done(step)
+            if progress is not None:
+                progress.flush()
             log.info(f"{band_key} done.")
-        log.info("Saving result to the files...")
-        worker._save_result()  # Save result into files
-        r, g, b = extract_rgb_paths(worker.save_result_path)
-        create_rgb_uint8(r, g, b, worker.save_result_path, worker.mercator)
+        sink.close()
+        if progress is not None:
+            progress.remove()
         log.info("Done!")
         worker.release_bands()
         # If there's an intention to work further with the files
         # Return result Granule
-        return S2Granule(worker.save_result_path, worker.spatial_resolution, worker.output_bands + ["rgb"])
+        return sink.result(worker.output_bands + ["rgb"])
+
+
+class QuantilePerPixel(Task):
+    """
+    Exact per-pixel quantiles (e.g. 25/50/75 %) with memory independent of the number of granules.
+    Two radix passes over uint16 reflectance: the first one counts the high bytes of the observations per pixel,
+    the second one counts the low bytes inside the bins the quantiles fall into. Quantiles are order statistics
+    (numpy's interpolation="lower"), the result is always an observed value. No data and pixels that
+    SCLClassifier weights (clouds, cirrus) are skipped, SCL is read for the masks even if it is not an output band.
+    Result bands are named <band>_Q<percent>, e.g. B04_Q50 or B04_Q33_3, <band>_COUNT holds the number
+    of observations of the band.
+    """
+
+    @staticmethod
+    def memory_estimate(granules: int, bands: int, pixels: int, quantiles: Tuple = (0.25, 0.5, 0.75),
+                        max_bytes: int = 256 * 1024 ** 2, **kwargs) -> int:
+        # histograms, masks and blocks of one chunk, the chunk sized by max_bytes
+        return max_bytes + 2 * pixels
+
+    @staticmethod
+    def names(quantiles: Tuple) -> List[str]:
+        """
+        Suffixes of the result bands, Q50 for 0.5, Q33_3 for 0.333.
+        """
+        return [f"Q{q * 100:.3g}".replace(".", "_") for q in quantiles]
+
+    @staticmethod
+    def perform_computation(worker: S2Worker, quantiles: Tuple = (0.25, 0.5, 0.75),
+                            max_bytes: int = 256 * 1024 ** 2, detector: SCLClassifier = None) -> S2Granule:
+        """
+        :param worker: s2worker with data
+        :param quantiles: quantiles in [0, 1]
+        :param max_bytes: memory of the histograms, windows are processed in chunks of rows that fit into it
+        :param detector: weights of SCL classes which are skipped, SCLClassifier defaults by default
+        :return: result granule, keys <band>_Q<percent> and <band>_COUNT
+        """
+        if any(not 0 <= q <= 1 for q in quantiles):
+            raise ValueError(f"Quantiles have to be in [0, 1], got {quantiles}")
+        names = QuantilePerPixel.names(quantiles)
+        if len(set(names)) != len(names):
+            raise ValueError(f"Quantiles {quantiles} give the same band names {names}")
+        detector = detector if detector is not None else SCLClassifier()
+        bands = [band for band in worker.output_bands if band != "SCL"]
+        if len(bands) == 0:
+            raise ValueError(f"No band to compute the quantiles of, output bands are {worker.output_bands}")
+        masked = Task._attach_scl(worker)
+        if not masked:
+            log.warning("SCL is not available, only no data is skipped")
+        log.info(f"Running per-pixel quantiles {names}. Dataset {worker.main_dataset_path}")
+        keys = [f"{band}_{name}" for band in bands for name in names + ["COUNT"]]
+        sink = worker.open_result_sink(keys)
+        # coarse and fine histograms (uint16) of each pixel, counts, ranks and bins,
+        # the mask and the block of each granule are kept for both passes
+        pixel_bytes = 512 * (1 + len(quantiles)) + 24 * len(quantiles) + 8 + 3 * len(worker.granules)
+
+        with rasterio.open(worker.granules[0][bands[0]].path) as reference:
+            windows = [window for _, window in reference.block_windows(1)]
+        for block in windows:
+            rows = max(1, max_bytes // (pixel_bytes * block.width))
+            for row in range(0, block.height, rows):
+                window = Window(col_off=block.col_off, row_off=block.row_off + row, width=block.width,
+                                height=min(rows, block.height - row))
+                granules = [g for g in worker.granules if g.block_index().has_data(window)]
+                shape = (window.height, window.width)
+                # SCL is read once per window and shared by all bands and both passes
+                masks = [detector.clear(g["SCL"].read_window(window)) if masked else np.ones(shape, dtype=np.bool_)
+                         for g in granules]
+                for band_key in bands:
+                    data = [g[band_key].read_window(window) for g in granules]
+                    counts = np.zeros(shape, dtype=np.uint16)
+                    coarse = np.zeros(shape + (256,), dtype=np.uint16)
+                    for values, valid in zip(data, masks):
+                        S2JIT.s2_histogram_coarse(values, valid, coarse, counts)
+                    bins = np.empty((len(quantiles),) + shape, dtype=np.int64)
+                    rest = np.empty((len(quantiles),) + shape, dtype=np.int64)
+                    for j, q in enumerate(quantiles):
+                        rank = np.floor(q * (counts.astype(np.int64) - 1)).astype(np.int64)
+                        rank[counts == 0] = -1
+                        S2JIT.s2_histogram_rank(coarse, rank, bins[j], rest[j])
+                    del coarse
+                    fine = np.zeros((len(quantiles),) + shape + (256,), dtype=np.uint16)
+                    for values, valid in zip(data, masks):
+                        S2JIT.s2_histogram_fine(values, valid, bins, fine)
+                    del data
+                    low = np.empty(shape, dtype=np.int64)
+                    unused = np.empty(shape, dtype=np.int64)
+                    for j, name in enumerate(names):
+                        S2JIT.s2_histogram_rank(fine[j], rest[j], low, unused)
+                        value = np.where(bins[j] >= 0, (bins[j] << 8) | low, 0)
+                        sink.write(f"{band_key}_{name}", value, window)
+                    del fine
+                    sink.write(f"{band_key}_COUNT", counts, window)
+        sink.close()
+        log.info("Done!")
+        worker.release_bands()
+        return sink.result(keys)
+
+
+class MedoidPerPixel(Task):
+    """
+    Per-pixel medoid, the observation closest (sum of euclidean distances over the bands) to all the other valid
+    observations. Unlike the median, all bands of a pixel come from the same date.
+    The cost is quadratic in the number of observations, windows are split into chunks of rows that fit
+    into max_bytes and the kernel runs in parallel over the rows.
+    No data and, when SCL is among the bands, pixels that SCLClassifier weights (clouds, cirrus) are skipped,
+    SCL itself does not enter the distance.
+    """
+
+    @staticmethod
+    def memory_estimate(granules: int, bands: int, pixels: int, max_bytes: int = 256 * 1024 ** 2, **kwargs) -> int:
+        # result with DOY and two chunks in flight
+        return pixels * 2 * (bands + 1) + 2 * max_bytes
+
+    @staticmethod
+    def perform_computation(worker: S2Worker, max_bytes: int = 256 * 1024 ** 2,
+                            detector: SCLClassifier = None) -> S2Granule:
+        """
+        :param worker: s2worker with data
+        :param max_bytes: memory of the stacked observations of one chunk
+        :param detector: weights of SCL classes which are skipped, SCLClassifier defaults by default
+        """
+        detector = detector if detector is not None else SCLClassifier()
+        bands = worker.output_bands
+        spectral = np.array([i for i, band in enumerate(bands) if band != "SCL"], dtype=np.int64)
+        if len(spectral) == 0:
+            raise ValueError("Medoid needs at least one band other than SCL")
+        masked = "SCL" in bands
+        if not masked:
+            log.warning("SCL is not among the bands, only no data is skipped")
+        log.info(f"Running per-pixel medoid. Dataset {worker.main_dataset_path}")
+        worker.granules.sort(key=lambda x: x.doy)
+        sink = worker.open_result_sink(bands + ["DOY"])
+        with rasterio.open(worker.granules[0][bands[0]].path) as reference:
+            blocks = [window for _, window in reference.block_windows(1)]
+        # stacked bands and the mask of each granule
+        pixel_bytes = len(worker.granules) * (2 * len(bands) + 1)
+        windows = []
+        for block in blocks:
+            rows = max(1, max_bytes // (pixel_bytes * block.width))
+            for row in range(0, block.height, rows):
+                windows.append(Window(col_off=block.col_off, row_off=block.row_off + row, width=block.width,
+                                      height=min(rows, block.height - row)))
+
+        def load(window: Window):
+            granules = [g for g in worker.granules if g.block_index().has_data(window)]
+            data = np.empty(shape=(len(granules), len(bands), window.height, window.width), dtype=np.uint16)
+            valid = np.ones(shape=(len(granules), window.height, window.width), dtype=np.bool_)
+            for i, g in enumerate(granules):
+                for k, band in enumerate(bands):
+                    data[i, k] = g[band].read_window(window)
+                if masked:
+                    valid[i] = detector.clear(data[i, bands.index("SCL")])
+            return window, data, valid, np.array([g.doy for g in granules], dtype=np.int64)
+
+        for window, data, valid, doys in Prefetcher(windows, load, item_bytes=max_bytes):
+            result = np.zeros(shape=(len(bands), window.height, window.width), dtype=np.uint16)
+            doy = np.zeros(shape=(window.height, window.width), dtype=np.uint16)
+            if len(doys) > 0:
+                S2JIT.s2_medoid(data, valid, spectral, doys, result, doy)
+            del data, valid
+            for k, band in enumerate(bands):
+                sink.write(band, result[k], window)
+            sink.write("DOY", doy, window)
+        log.info("Done!")
+        sink.close()
+        worker.release_bands()
+        return sink.result(bands + ["rgb"])
 
 
 class PerTile(Task):
 
     @staticmethod
-    def perform_computation(worker: S2Worker, detector: S2Detectors = S2Detectors.scl) -> S2Granule:
+    def memory_estimate(granules: int, bands: int, pixels: int, **kwargs) -> int:
+        # SCL of one granule and the RGB channels of one slice row waiting to be written
+        return 2 * pixels
+
+    @staticmethod
+    def perform_computation(worker: S2Worker, detector: S2Detectors = S2Detectors.scl,
+                            incremental: bool = False) -> S2Granule:
+        """
+        :param worker: s2worker with data
+        :param detector: cloud detector, returns cloud percentage of each slice
+        :param incremental: only the new granules are scored, slices of the previous result are kept
+        unless a new granule is less cloudy (see CompositeState)
+        """
         log.info(f"Running per-tile masking. Dataset {worker.main_dataset_path}")
         # Gather information
         res_x, res_y = s2_get_resolution(worker.spatial_resolution)
         slice_index = worker.slice_index
+        if detector is S2Detectors.scl:
+            # Same weights, but computed at SCL's native resolution without materializing the mask
+            detector = SCLClassifier()
 
         # Check if might proceed to the next step which is per-tile procedure
         for _worker in worker.granules:
             if _worker.slice_index != slice_index:
                 raise Exception("Terminating job. Workers with different slice index are not allowed!")
 
-        # slice_raster(slice_index, res)  # For easier assignments
-        doy = slice_raster(slice_index, np.zeros(shape=(res_x, res_y), dtype=np.uint16))
-        log.warning(doy.size)
-        # Result array, where we are going to store the result intensities of pixel
-        # shape -> bands, slices, x, y
-        res = np.zeros(shape=(len(worker.output_bands), doy.shape[0], doy.shape[1], doy.shape[2]), dtype=np.uint16)
-        log.info(
-            f"Initialized result array shape: {len(worker.output_bands), doy.shape[0], doy.shape[1], doy.shape[2]}")
+        state = CompositeState.load(worker, "PerTile") if incremental else None
+        if state is not None and state.arrays["score"].shape != (slice_index * slice_index,):
+            log.warning("Composite state was computed with a different slice index, it is going to be replaced")
+            state = None
+        granules = worker.granules if state is None else state.new_granules(worker.granules)
+        if state is not None and len(granules) == 0:
+            log.info("No new granules, the result is up to date")
+            return S2Granule(worker.save_result_path, worker.spatial_resolution, worker.output_bands + ["rgb"])
+
         # using numpy for slicing features, could've been simple python 2D list as well
-        cloud_info = np.zeros(shape=(len(worker.granules), slice_index * slice_index))
+        cloud_info = np.zeros(shape=(len(granules), slice_index * slice_index))
 
         # Imagine sit.: slice_index=5, func(w) returns [10,15,20,50,35], each of the number
         # corresponds to the cloud percentage of that area that was calculated with the 'func'
         # cloud_info[i] = func(w)
-        for i, w in enumerate(worker.granules, 0):
+        for i, w in enumerate(granules, 0):
             cloud_info[i] = GranuleCalculator.s2_pertile_cloud_index_mask(w, detector)
 
         # After iterations we hold 2D array where the y-axis stands for index of worker and
         # x-axis for the cloud percentage in the xth area of yth worker, now we just have to pick the one
         # with least cloud %
-        # { worker_index: [slice_indices] }
-        workers_to_use = {}
-        for i in range(slice_index ** 2):
-            winner = cloud_info[:, i].argmin()
-            if winner in workers_to_use:
-                workers_to_use[winner].append(i)
-            else:
-                workers_to_use[winner] = [i]
-        for value in workers_to_use.keys():
-            worker.granules[value].load_bands()
-            stack = worker.granules[value].stack_bands(worker.output_bands)
-            worker.granules[value].free_resources()
-            log.info(f"Loading bands for worker with index: {value}, "
-                     f"worker occupies slices - {workers_to_use[value]}")
-            for sl_index in workers_to_use[value]:
-                doy[sl_index] = worker.granules[value].doy
-                res[:, sl_index, :, :] = stack[:, sl_index, :, :]
-            stack = None
-        worker.result["DOY"] = glue_raster(doy, res_y, res_x)
-        result = np.zeros(shape=(len(worker.output_bands), res_x, res_y), dtype=np.uint16)
-        for i in range(len(worker.output_bands)):
-            result[i] = glue_raster(res[i, :, :, :], res_y, res_x)  # (25, 1098, 1098) => (5049, 5049)
-        # Save it to the result
+        winners = cloud_info.argmin(axis=0)
+        score = cloud_info.min(axis=0)
+        previous = None
+        if state is not None:
+            # the previous result keeps the slice on a tie, as the earlier granule would in a full run
+            previous = CompositeState.stash_result(worker)
+            keep = state.arrays["score"] <= score
+            score = np.where(keep, state.arrays["score"], score)
+            winners = np.where(keep, -1, winners)
+        elif incremental:
+            state = CompositeState(CompositeState.state_path(worker), "PerTile", worker.spatial_resolution,
+                                   worker.output_bands)
+        # Only the windows each granule won are read, they are written straight to the result files.
+        # Slices go in the spatial order, so the blocks of the files are completed one after another.
+        sink = worker.open_result_sink(in_memory=False if incremental else None)
+        for sl_index, value in enumerate(winners):
+            window = slice_window(slice_index, sl_index, res_x, res_y)
+            if value < 0:
+                log.debug(f"Slice {sl_index} is taken from the previous result")
+                data, doy = CompositeState.read_result(previous, worker.output_bands, worker.spatial_resolution,
+                                                       window)
+                sink.write("DOY", doy, window)
+                for i, band in enumerate(worker.output_bands):
+                    sink.write(band, data[i], window)
+                continue
+            granule = granules[value]
+            log.debug(f"Slice {sl_index} is taken from worker with index: {value}")
+            sink.write("DOY", np.full(shape=(window.height, window.width), fill_value=granule.doy,
+                                      dtype=np.uint16), window)
+            for band in worker.output_bands:
+                sink.write(band, granule[band].read_window(window), window)
+        sink.close()
+        if state is not None:
+            state.update(worker.granules, {"score": score})
+            state.save()
+        if previous is not None:
+            shutil.rmtree(previous)
+        worker.release_bands()
+        return sink.result(worker.output_bands + ["rgb"])
+
+
+class BestPixel(Task):
+    """
+    Best-pixel composite with a pluggable scorer (see BestPixelEngine), e.g. NDVI, cloud probability,
+    distance to a target date or AOT. Besides the bands, DOY and QUALITY (scaled score) of the picked pixels
+    are written.
+    """
+
+    @staticmethod
+    def _granule_bytes(bands: int, scorer: Scorer) -> int:
+        """
+        Bytes per pixel of one granule of a batch, its stacked bands and features, and their copies stacked
+        by the engine.
+        """
+        value = np.dtype(np.uint16).itemsize
+        features = sum(precision.probability.itemsize if band == "PROB" else value for band in scorer.bands)
+        return 2 * value * bands + features + np.dtype(np.float32).itemsize * len(scorer.bands)
+
+    @staticmethod
+    def memory_estimate(granules: int, bands: int, pixels: int, scorer: Union[Scorer, str] = Scorers.NDVI,
+                        constraint: int = 5, **kwargs) -> int:
+        scorer = Scorers.get(scorer) if isinstance(scorer, str) else scorer
+        batch = min(granules, constraint)
+        value = np.dtype(np.uint16).itemsize
+        # score (float64), result with DOY and quality, two batches in flight
+        resident = np.dtype(np.float64).itemsize + value * (bands + 2)
+        return pixels * (resident + 2 * batch * BestPixel._granule_bytes(bands, scorer))
+
+    @staticmethod
+    def perform_computation(worker: S2Worker, scorer: Union[Scorer, str] = Scorers.NDVI, params: Tuple = None,
+                            tie: str = "latest", constraint: int = 5) -> S2Granule:
+        """
+        :param worker: s2worker with data
+        :param scorer: Scorer or its name, e.g. "doy_distance"
+        :param params: parameters of the scorer, e.g. (target DOY,) for "doy_distance"
+        :param tie: tie-breaking rule, "latest", "earliest" or "first"
+        :param constraint: how many granules are loaded at the same time
+        """
+        scorer = Scorers.get(scorer) if isinstance(scorer, str) else scorer
+        log.info(f"Running best-pixel composite with {scorer}. Dataset {worker.main_dataset_path}")
+        worker.granules.sort(key=lambda x: x.doy)
+        granules = [g for g in worker.granules if g.block_index().has_data()]
+        engine = BestPixelEngine(scorer, len(worker.output_bands), worker.get_res(), params, tie)
+        masks = None
+        if "PROB" in scorer.bands:
+            #  scorers read the features pixel by pixel in the working resolution, the masks are up-sampled
+            masks = S2Detectors.sentinel_cloudless_batch(granules, probability=True, lazy=False)
+
+        def load(iteration: int):
+            data, features, doys = [], [], []
+            for g in granules[iteration * constraint: (iteration + 1) * constraint]:
+                data.append(g.stack_bands(worker.output_bands))
+                features.append({band: next(masks) if band == "PROB" else g[band].raster() for band in scorer.bands})
+                doys.append(g.doy)
+                g.free_resources()  # stacks and features are copies or detached arrays
+            return data, features, doys
+
+        res_x, res_y = worker.get_res()
+        batch_bytes = min(len(granules), constraint) * res_x * res_y * \
+            BestPixel._granule_bytes(len(worker.output_bands), scorer)
+        for data, features, doys in Prefetcher(range((len(granules) - 1) // constraint + 1), load,
+                                               item_bytes=batch_bytes):
+            engine.add(data, features, doys)
+            del data, features
+        log.info("Saving result to the files...")
+        sink = worker.open_result_sink(worker.output_bands + ["DOY", "QUALITY"])
         for i, band in enumerate(worker.output_bands, 0):
-            worker.result[band] = result[i]
-        worker._save_result()
-        r, g, b = extract_rgb_paths(worker.save_result_path)
-        create_rgb_uint8(r, g, b, worker.save_result_path, worker.mercator)
+            sink.write(band, engine.result[i])
+        sink.write("DOY", engine.doy)
+        sink.write("QUALITY", engine.quality())
+        sink.close()
         worker.release_bands()
-        return S2Granule(worker.save_result_path, worker.spatial_resolution, worker.output_bands + ["rgb"])
+        return sink.result(worker.output_bands + ["rgb"])
+
+
+class MultiProduct(Task):
+    """
+    Several composites from one read pass, each product is written to <dataset>/result_<name>.
+    With bins, each product is composited for each period, granules are routed to the periods during the pass.
+    """
+
+    @staticmethod
+    def memory_estimate(granules: int, bands: int, pixels: int, **kwargs) -> int:
+        # SCL of the per-tile scoring and the blocks of all granules of two windows in flight
+        return 2 * pixels + 2 * granules * (bands + 4) * 2 * 1024 * 1024
+
+    @staticmethod
+    def perform_computation(worker: S2Worker, products: List[Product] = None,
+                            bins: List[DoyBin] = None) -> Dict[str, S2Granule]:
+        """
+        :param worker: s2worker with data
+        :param products: e.g. [MedianProduct(), MaxNdviProduct()], median, max NDVI and per-tile SCL by default
+        :param bins: periods, e.g. DoyBin.monthly(2021) or DoyBin.every(10), one composite per product and period
+        :return: product name -> result granule
+        """
+        if products is None:
+            products = [MedianProduct(), MaxNdviProduct(), PerTileProduct()]
+        if bins is not None:
+            products = temporal_products(products, bins)
+        log.info(f"Running products {[p.name for p in products]}. Dataset {worker.main_dataset_path}")
+        return MultiProductRunner(worker, products).run()
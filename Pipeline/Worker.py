@@ -7,21 +7,30 @@ from Pipeline.GranuleCalculator import *
 from rasterio import dtypes as rastTypes
 from concurrent.futures import ThreadPoolExecutor
 from shapely.geometry import box
+from Pipeline.OutputProfile import OutputProfile
+from Pipeline.ResultSink import ResultSink
+from Pipeline.Runtime import runtime
 
 
 class S2Worker:
 
     def __init__(self, path: str, spatial_resolution: int, slice_index: int = 1, output_bands: List[str] = [],
-                 target_projection='EPSG:32633', polygon: List = None):
+                 target_projection='EPSG:32633', polygon: List = None, output_profile: OutputProfile = None,
+                 in_memory_results: bool = False):
         """
         :param path: to the dataset
         :param spatial_resolution: on which we are going to operate on
         :param slice_index: per-pixel: always 1, per-tile from pre-defined choices
         :param output_bands: bands we work with
         :param polygon: polygon that crops out our data
+        :param output_profile: layout and compression of the result files, LZW GeoTIFF (OutputProfile.legacy) by
+        default, COG is opt-in with OutputProfile.cog()
+        :param in_memory_results: tasks return the result granule in memory, it is written by granule.persist()
         """
         if not is_dir_valid(path):
             raise FileNotFoundError("{} may not exist\nPlease check if file exists".format(path))
+        #  numba and GDAL of this process follow the thread budget, also outside of the scheduler
+        runtime.rebalance()
         if not s2_is_spatial_correct(spatial_resolution):
             raise Exception("Wrong spatial resolution, please choose between 10, 20 and 60m")
         if s2_get_resolution(spatial_resolution)[0] % slice_index != 0:
@@ -65,6 +74,8 @@ class S2Worker:
         self.result_worker = None
         self.slice_index = slice_index
         self.t_srs = target_projection
+        self.output_profile = output_profile if output_profile is not None else OutputProfile.legacy()
+        self.in_memory_results = in_memory_results
         log.info(f"Initialized S2Runner:\n{self}")
 
     def get_save_path(self) -> str:
@@ -96,12 +107,35 @@ class S2Worker:
         profile = list(self.granules[-1].bands[self.spatial_resolution].values())[0].profile
         log.debug(f"Profile: {profile}")
         log.debug(f"Loaded from  {list(self.granules[-1].bands[self.spatial_resolution].values())[0].path}")
-        with ThreadPoolExecutor(max_workers=10) as executor:
+        with ThreadPoolExecutor(max_workers=runtime.pool_size(10)) as executor:
+            futures = {}
             for key in self.result.keys():
                 path = self.save_result_path + os.path.sep + key + "_" + str(self.spatial_resolution)
-                executor.submit(GranuleCalculator.save_band_rast, self.result[key], path=path, prof=profile,
-                                driver="GTiff",
-                                dtype=rastTypes.uint16)
+                futures[key] = executor.submit(GranuleCalculator.save_band_rast, self.result[key], path=path,
+                                               prof=profile, dtype=rastTypes.uint16,
+                                               output_profile=self.output_profile)
+        #  Surface the errors of the writes, an incomplete result must not pass silently
+        for key, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                log.error(f"Writing {key} to {self.save_result_path} failed")
+                raise e
+
+    def open_result_sink(self, keys: List[str] = None, path: str = None, in_memory: bool = None) -> ResultSink:
+        """
+        Open streaming writer of the result, see ResultSink.
+        :param keys: keys that are going to be written, output bands and DOY by default
+        :param path: result directory, save_result_path by default
+        :param in_memory: keep the result in memory, in_memory_results of the worker by default
+        """
+        if in_memory is None:
+            in_memory = self.in_memory_results
+        if keys is None:
+            keys = self.output_bands + ["DOY"]
+        profile = list(self.granules[-1].bands[self.spatial_resolution].values())[0].profile
+        return ResultSink(path or self.save_result_path, keys, profile, self.spatial_resolution, self.mercator,
+                          self.output_profile, in_memory=in_memory)
 
     def _load_bands(self, desired_bands: List[str] = None):
         """
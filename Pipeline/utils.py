@@ -6,8 +6,13 @@ import rasterio
 import glob
 from skimage import exposure
 from Pipeline.logger import log
+from Pipeline.Precision import precision
+from Pipeline.Mask import S2JIT
 import subprocess
+from collections import OrderedDict
+from functools import lru_cache
 from rasterio.enums import Resampling
+from rasterio.windows import Window
 
 
 # --------------- FILE UTILS ---------------
@@ -42,6 +47,26 @@ def get_files_in_directory(path: str, _type: str = None) -> List[str]:
     return result
 
 
+def total_memory() -> Optional[int]:
+    """
+    Physical memory of the machine in bytes, None if the platform does not tell.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, AttributeError, OSError):
+        return None
+
+
+def available_memory() -> Optional[int]:
+    """
+    Currently free physical memory in bytes, None if the platform does not tell.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, AttributeError, OSError):
+        return None
+
+
 def extract_rgb_paths(path):
     r = glob.glob(path + os.path.sep + "*B04*")[0]
     g = glob.glob(path + os.path.sep + "*B03*")[0]
@@ -142,9 +167,13 @@ def find_closest_slice(index: int):
 
 
 def ndvi(red: numpy.ndarray, nir: numpy.ndarray) -> numpy.ndarray:
+    """
+    NDVI in the index type of the precision policy.
+    """
     ndvi1 = (nir - red)
     ndvi2 = (nir + red)
-    return numpy.divide(ndvi1, ndvi2, out=numpy.zeros_like(ndvi1).astype(float), where=ndvi2 != 0).squeeze()
+    out = numpy.zeros(shape=ndvi1.shape, dtype=precision.index)
+    return numpy.divide(ndvi1, ndvi2, out=out, where=ndvi2 != 0).squeeze()
 
 
 def slice_raster(index: int, image: numpy.ndarray) -> numpy.ndarray:
@@ -162,6 +191,33 @@ def slice_raster(index: int, image: numpy.ndarray) -> numpy.ndarray:
             .reshape(-1, res_y // index, res_x // index))
 
 
+def slice_window(index: int, sl: int, res_y: int, res_x: int) -> Window:
+    """
+    Window of the sl-th slice within the raster of shape (res_y, res_x).
+    The order of the slices is the same as in slice_raster.
+    :param index - slicing index
+    :param sl - index of the slice
+    """
+    if res_y % index != 0 or res_x % index != 0:
+        raise Exception("Raster slice index is not correct!")
+    height, width = res_y // index, res_x // index
+    return Window(col_off=(sl % index) * width, row_off=(sl // index) * height, width=width, height=height)
+
+
+def upsample_nearest(image: numpy.ndarray, shape: Tuple[int, int]) -> numpy.ndarray:
+    """
+    Nearest neighbour up-sampling to the shape.
+    Integer factors are done by block replication, otherwise each output pixel centre is mapped to the input.
+    """
+    h, w = image.shape
+    res_y, res_x = int(shape[0]), int(shape[1])
+    if res_y % h == 0 and res_x % w == 0:
+        return numpy.repeat(numpy.repeat(image, res_y // h, axis=0), res_x // w, axis=1)
+    rows = ((numpy.arange(res_y) + 0.5) * h / res_y).astype(numpy.intp)
+    cols = ((numpy.arange(res_x) + 0.5) * w / res_x).astype(numpy.intp)
+    return image[numpy.ix_(rows, cols)]
+
+
 def glue_raster(image: numpy.ndarray, res_y: int, res_x: int):
     """
     Return an array of shape (res_x, res_y) where
@@ -191,13 +247,41 @@ def rescale_intensity(image, _min, _max):
     return exposure.rescale_intensity(image, in_range=(_min, _max), out_range=(0, 255)).astype(numpy.uint8)
 
 
+@lru_cache(maxsize=16)
+def stretch_lut(gain: float = 1.0, _min: float = 0, _max: float = 4096, gamma: float = 1.0) -> numpy.ndarray:
+    """
+    Look-up table of the uint16 -> uint8 stretch, computed once for each setting. Do not modify it.
+    Value * gain is clipped to <_min, _max>, normalized to <0, 1>, raised to gamma and scaled to <0, 255>.
+    With gamma 1 it is the same as rescale_intensity(value * gain, _min, _max).
+    """
+    values = numpy.clip(numpy.arange(65536, dtype=numpy.float64) * gain, _min, _max)
+    normalized = (values - _min) / (_max - _min)
+    if gamma != 1:
+        normalized = normalized ** gamma
+    return (normalized * 255).astype(numpy.uint8)
+
+
+def apply_lut(image: numpy.ndarray, lut: numpy.ndarray) -> numpy.ndarray:
+    """
+    Stretch uint16 raster (2D or stacked 3D) to uint8 with the look-up table, in parallel, without float temporaries.
+    """
+    image = numpy.ascontiguousarray(image.astype(numpy.uint16, copy=False))
+    flat = image.reshape(-1, image.shape[-1])
+    out = numpy.empty(shape=flat.shape, dtype=lut.dtype)
+    S2JIT.s2_apply_lut(flat, lut, out)
+    return out.reshape(image.shape)
+
+
 def create_rgb_uint8(r, g, b, path, tile):
     gain = 1.5
-    red = rescale_intensity(rasterio.open(r).read(1) * gain, 0, 4096)
-    green = rescale_intensity(rasterio.open(g).read(1) * gain, 0, 4096)
-    blue = rescale_intensity(rasterio.open(b).read(1) * gain, 0, 4096)
-
-    rgb_profile = rasterio.open(r).profile
+    lut = stretch_lut(gain, 0, 4096)
+    channels = []
+    for channel in [r, g, b]:
+        with rasterio.open(channel) as dataset:
+            channels.append(apply_lut(dataset.read(1), lut))
+
+    with rasterio.open(r) as dataset:
+        rgb_profile = dataset.profile
     rgb_profile['dtype'] = 'uint8'
     rgb_profile['count'] = 3
     rgb_profile['photometric'] = "RGB"
@@ -210,40 +294,24 @@ def create_rgb_uint8(r, g, b, path, tile):
     rgb_profile['nodata'] = 0
     log.debug(f"RGB PROFILE:\n{rgb_profile}")
     with rasterio.open(path + os.path.sep + f"{tile}_rgb.tif", 'w', **rgb_profile) as dst:
-        for count, band in enumerate([red, green, blue], 1):
+        for count, band in enumerate(channels, 1):
             dst.write(band, count)
         dst.build_overviews([2, 4, 8, 16, 32], Resampling.nearest)
         dst.update_tags(ns='rio_overview', resampling='nearest')
 
 
-def build_mosaic(destination: str, paths: List[str], name: str = "mosaic", rgb=False, **kwargs) -> None:
+def build_mosaic(destination: str, paths: List[str], name: str = "mosaic", rgb=False, **kwargs) -> str:
     """
-    Build mosaic from files. Using gdal vrt.
+    Build mosaic from files. Done in-process, see Pipeline.Mosaic.MosaicBuilder.
     @param destination - path where the mosaic will be available
     @param paths - paths to tiff files
     @param name - name of the result file
     @param rgb - yep
+    @param kwargs - options of the MosaicBuilder (threads, vrt_only, ...)
+    @return path to the mosaic
     """
-    _destination = format_path(destination) + "mosaic.vrt"
-    final_image = format_path(destination) + name + ".tif"
-    escaped_paths = " ".join(f'"{p}"' for p in paths)
-    process = subprocess.Popen(f"gdalbuildvrt -q \"{_destination}\" {escaped_paths}", shell=True,
-                               stdout=subprocess.PIPE)
-    process.wait()
-    #  Experiment, NOTE: TILED is making artefacts on monochromatic pictures!
-    if rgb:
-        process = subprocess.Popen(f"gdal_translate -of GTiff --config GDAL_CACHE_MAX 128 -co \"TILED=YES\" "
-                                   f"-co \"COMPRESS=JPEG\" -co "
-                                   f"\"PHOTOMETRIC=YCBCR\" \"{_destination}\" \"{final_image}\" -q", shell=True,
-                                   stdout=subprocess.PIPE)
-        process.wait()
-    else:
-        process = subprocess.Popen(
-            f"gdal_translate -of GTiff -co \"TILED=YES\" \"{_destination}\" \"{final_image}\" -q",
-            shell=True, stdout=subprocess.PIPE)
-        process.wait()
-    process = subprocess.Popen(f"rm \"{_destination}\"", shell=True, stdout=subprocess.PIPE)
-    process.wait()
+    from Pipeline.Mosaic import MosaicBuilder  # Mosaic depends on utils
+    return MosaicBuilder(**kwargs).build(destination, paths, name, rgb)
 
 
 # --------------- GRANULE UTILS ---------------
@@ -314,6 +382,35 @@ def profile_for_rgb(profile: rasterio.profiles.Profile) -> rasterio.profiles.Pro
     return profile
 
 
+class TempCache(OrderedDict):
+    """
+    Temporary products of a granule (e.g. NDVI). Once the arrays exceed max_bytes,
+    the least recently used ones are evicted. The most recent entry is always kept.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        super().__init__()
+        self.max_bytes = max_bytes
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        self._evict()
+
+    def nbytes(self) -> int:
+        return sum(getattr(value, "nbytes", 0) for value in self.values())
+
+    def _evict(self) -> None:
+        while self.max_bytes is not None and len(self) > 1 and self.nbytes() > self.max_bytes:
+            key, _ = self.popitem(last=False)
+            log.debug(f"Evicted {key} from the granule temps")
+
+
 def supported_granule_type(_type: str) -> bool:
     return _type in ["L1C", "L2A"]
 
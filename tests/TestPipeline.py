@@ -1,14 +1,66 @@
 import os
+import shutil
+import signal
 
 import numpy as np
 import pytest
+import rasterio
 from Pipeline.utils import *
 from Pipeline.Worker import S2Worker
 from Pipeline.Granule import S2Granule
+from Pipeline.GranuleCalculator import GranuleCalculator
 from Pipeline.Band import Band
-from Pipeline.Mask import S2JIT
-from Pipeline.Detectors import S2Detectors
+from Pipeline.OutputProfile import OutputProfile
+from Pipeline.ResultSink import ResultSink
+from Pipeline.Indices import S2IndexEngine
+from Pipeline.Precision import PrecisionPolicy, set_precision
+from Pipeline.Scheduler import S2Scheduler
+from Pipeline.Runtime import runtime
+from Pipeline.Task import Task, NdviPerPixel, PerTile, QuantilePerPixel, BestPixel
+from Pipeline.Mask import S2JIT, CoarseMask
+from Pipeline.Detectors import S2Detectors, SCLClassifier
+from Pipeline.CompositeState import CompositeState
+from Pipeline.Checkpoint import Checkpoint
+from Pipeline.Scratch import Scratch
+from Pipeline.StripeExecutor import StripeExecutor
+from Pipeline.Mosaic import MosaicBuilder
+from Pipeline.Products import MaxNdviProduct, MedianProduct, DoyBin, temporal_products
+from Pipeline.BestPixel import BestPixelEngine, Scorer, Scorers
+from rasterio.windows import Window
+from concurrent.futures.process import BrokenProcessPool
+from rasterio.transform import from_origin
 import pathlib
+from numba.typed import List as LIST
+from numba import njit
+
+
+@njit
+def farthest_score(f, doy, params):
+    return abs(doy - params[0])
+
+
+def lower_quantile(a: np.ndarray, q: float):
+    """
+    numpy's order-statistic quantile, the keyword is interpolation= up to numpy 1.21 and method= since 1.22
+    (interpolation= is deprecated there).
+    """
+    try:
+        return np.quantile(a, q, method="lower")
+    except TypeError:
+        return np.quantile(a, q, interpolation="lower")
+
+
+class KilledOnce(Task):
+    """
+    Per-tile whose process is killed on the first attempt, as if by the OOM killer.
+    """
+
+    @staticmethod
+    def perform_computation(worker: S2Worker, marker: str = None) -> S2Granule:
+        if not os.path.exists(marker):
+            open(marker, "w").close()
+            os.kill(os.getpid(), signal.SIGKILL)
+        return PerTile.perform_computation(worker)
 
 
 class TestPipeline:
@@ -43,6 +95,226 @@ class TestPipeline:
         assert len(self.worker.datasets) == len(os.listdir(self.path))
         assert len(self.worker.granules) == len(self.worker.datasets)
 
+    def test_scheduler_memory_estimate(self):
+        bands = ["B02", "B03", "B04", "B8A", "SCL"]
+        scheduler = S2Scheduler([self.path], NdviPerPixel, 60, worker_kwargs={"output_bands": bands})
+        assert scheduler.max_workers == 1
+        assert scheduler.estimate_memory(self.path) == NdviPerPixel.memory_estimate(1, len(bands), 1830 * 1830)
+        assert PerTile.memory_estimate(1, len(bands), 1830 * 1830) < scheduler.estimate_memory(self.path)
+        #  Estimates follow the precision policy
+        legacy = [NdviPerPixel.memory_estimate(10, 5, 1830 * 1830),
+                  BestPixel.memory_estimate(10, 5, 1830 * 1830, scorer="cloud_probability")]
+        set_precision(PrecisionPolicy.compact())
+        try:
+            assert NdviPerPixel.memory_estimate(10, 5, 1830 * 1830) < legacy[0]
+            assert BestPixel.memory_estimate(10, 5, 1830 * 1830, scorer="cloud_probability") < legacy[1]
+        finally:
+            set_precision(PrecisionPolicy.legacy())
+
+    def test_scheduler_run(self, tmp_path):
+        bands = ["B02", "B03", "B04", "B8A", "SCL"]
+        safe = os.listdir(self.path)[0]
+        paths = [str(tmp_path / name / self.dataset) for name in ["a", "b"]]
+        for path in paths:
+            shutil.copytree(self.path + os.path.sep + safe, path + os.path.sep + safe)
+        results = list(S2Scheduler(paths, PerTile, 60, worker_kwargs={"output_bands": bands}, max_workers=2).run())
+        assert all(result.success for result in results)
+        assert sorted(result.result_path for result in results) == [path + os.path.sep + "result" for path in paths]
+        for result in results:
+            assert os.path.isfile(CompositeState.result_file(result.result_path, "B02", 60))
+
+    def test_scheduler_retry(self, tmp_path):
+        bands = ["B02", "B03", "B04", "B8A", "SCL"]
+        safe = os.listdir(self.path)[0]
+        path = str(tmp_path / self.dataset)
+        shutil.copytree(self.path + os.path.sep + safe, path + os.path.sep + safe)
+        marker = str(tmp_path / "killed")
+        #  The job is resubmitted to a new pool after its process was killed
+        result, = S2Scheduler([path], KilledOnce, 60, worker_kwargs={"output_bands": bands},
+                              task_kwargs={"marker": marker}).run()
+        assert os.path.exists(marker) and result.success and result.result_path == path + os.path.sep + "result"
+        #  Without retries the job fails
+        os.remove(marker)
+        result, = S2Scheduler([path], KilledOnce, 60, worker_kwargs={"output_bands": bands},
+                              task_kwargs={"marker": marker}, retries=0).run()
+        assert not result.success and isinstance(result.error, BrokenProcessPool)
+
+    def test_composite_state(self, tmp_path):
+        bands = ["B02", "B03", "B04", "B8A", "SCL"]
+        state = CompositeState(str(tmp_path / "result_state"), "NdviPerPixel", 60, bands)
+        state.update(self.worker.granules[:1], {"score": np.full((4, 4), 0.5)})
+        state.save()
+        assert state.new_granules(self.worker.granules) == self.worker.granules[1:]
+        worker = type("Worker", (), {"main_dataset_path": str(tmp_path), "spatial_resolution": 60,
+                                     "output_bands": bands, "save_result_path": str(tmp_path / "result")})
+        #  State without the result is not usable
+        assert CompositeState.load(worker, "NdviPerPixel") is None
+        os.mkdir(worker.save_result_path)
+        loaded = CompositeState.load(worker, "NdviPerPixel")
+        assert loaded.processed == state.processed
+        assert np.array_equal(loaded.arrays["score"], state.arrays["score"])
+        assert CompositeState.load(worker, "S2CloudlessPerPixel") is None
+
+    def test_incremental_fold(self, tmp_path):
+        bands = ["B02", "B03", "B04", "B8A", "SCL"]
+        safe = os.listdir(self.path)[0]
+        added = safe.replace("T115211", "T115212")
+        shutil.copytree(self.path + os.path.sep + safe, str(tmp_path / "base" / self.dataset / safe))
+        base = str(tmp_path / "base" / self.dataset)
+        #  Plain run does not keep any state
+        NdviPerPixel.perform_computation(S2Worker(base, 60, output_bands=bands))
+        assert not os.path.exists(CompositeState.state_path(S2Worker(base, 60, output_bands=bands)))
+        NdviPerPixel.perform_computation(S2Worker(base, 60, output_bands=bands), incremental=True)
+        shutil.copytree(self.path + os.path.sep + safe, base + os.path.sep + added)
+        worker = S2Worker(base, 60, output_bands=bands)
+        NdviPerPixel.perform_computation(worker, incremental=True)
+        assert sorted(CompositeState.load(worker, "NdviPerPixel").processed) == sorted([safe, added])
+        full = str(tmp_path / "full" / self.dataset)
+        for name in [safe, added]:
+            shutil.copytree(self.path + os.path.sep + safe, full + os.path.sep + name)
+        NdviPerPixel.perform_computation(S2Worker(full, 60, output_bands=bands))
+        for key in bands + ["DOY"]:
+            with rasterio.open(CompositeState.result_file(worker.save_result_path, key, 60)) as folded, \
+                    rasterio.open(CompositeState.result_file(full + os.path.sep + "result", key, 60)) as src:
+                assert np.array_equal(folded.read(1), src.read(1))
+
+    def test_checkpoint_resume(self, tmp_path):
+        path = str(tmp_path / "result_checkpoint")
+        progress = Checkpoint(path, {"task": "NdviPerPixel", "constraint": 5})
+        array = progress.array("doy", (4, 4), np.uint16, 7)
+        array[0, 0] = 42
+        progress.mark_done("batch_0")
+        #  Same configuration continues where it stopped
+        resumed = Checkpoint(path, {"task": "NdviPerPixel", "constraint": 5})
+        assert resumed.resumed and resumed.is_done("batch_0") and not resumed.is_done("batch_1")
+        array = resumed.array("doy", (4, 4), np.uint16, 7)
+        assert array[0, 0] == 42 and array[1, 1] == 7
+        #  Different configuration starts over
+        assert not Checkpoint(path, {"task": "NdviPerPixel", "constraint": 10}).resumed
+        #  Steps are flushed in groups
+        batched = Checkpoint(str(tmp_path / "batched"), {"task": "MedianPerPixel"}, flush_steps=2)
+        batched.array("B02", (4, 4), np.uint16)
+        batched.mark_done("B02_0_0")
+        assert not os.path.exists(str(tmp_path / "batched" / Checkpoint.progress_file))
+        batched.mark_done("B02_0_1")
+        batched.mark_done("B02_1_0")
+        batched.flush()
+        assert Checkpoint(str(tmp_path / "batched"), {"task": "MedianPerPixel"}).is_done("B02_1_0")
+        #  Disabled checkpoint works in memory
+        assert not isinstance(Checkpoint().array("doy", (4, 4), np.uint16, 7), np.memmap)
+
+    def test_scratch(self, tmp_path):
+        with Scratch(str(tmp_path)) as scratch:
+            result = scratch.array("result", (3, 16, 16), np.uint16, 1)
+            stack = scratch.array("stack_0_0", (3, 16, 16), np.uint16, None)
+            assert isinstance(result, np.memmap) and (result == 1).all() and (stack == 0).all()
+            files = os.listdir(scratch.path)
+            assert sorted(files) == ["result.npy", "stack_0_0.npy"]
+            scratch.release("stack_0_0")
+            assert os.listdir(scratch.path) == ["result.npy"]
+            path = scratch.path
+        assert not os.path.exists(path)
+        # disabled scratch allocates in the memory
+        assert not isinstance(Scratch().array("result", (2, 2), np.float32, -10), np.memmap)
+
+    def test_stripe_executor(self):
+        shape = self.worker.get_res()
+        bands = self.worker.output_bands
+        expected_ndvi = np.full(shape, -10, dtype=np.float64)
+        expected = np.ones((len(bands),) + shape, dtype=np.uint16)
+        expected_doy = np.zeros(shape, dtype=np.uint16)
+        NdviPerPixel._select(self.worker, self.worker.granules, 5, expected_ndvi, expected, expected_doy,
+                             Checkpoint())
+        with StripeExecutor(processes=2, rows_per_stripe=512) as stripes:
+            ndvi = stripes.array("ndvi_result", shape, np.float64, -10)
+            result = stripes.array("result", (len(bands),) + shape, np.uint16, 1)
+            doy = stripes.array("doy", shape, np.uint16, 0)
+            stripes.ndvi(self.worker.granules, bands, 5, ndvi, result, doy)
+            assert np.array_equal(result, expected)
+            assert np.array_equal(doy, expected_doy)
+            assert np.allclose(ndvi, expected_ndvi)
+        #  Process of the scheduler's pool must not start processes
+        runtime.daemon = True
+        try:
+            with pytest.raises(ValueError):
+                StripeExecutor(processes=2)
+        finally:
+            runtime.daemon = False
+
+    def test_max_ndvi_product(self):
+        shape = self.worker.get_res()
+        bands = self.worker.output_bands
+        expected = np.ones((len(bands),) + shape, dtype=np.uint16)
+        expected_doy = np.zeros(shape, dtype=np.uint16)
+        NdviPerPixel._select(self.worker, self.worker.granules, 5, np.full(shape, -10, dtype=np.float64), expected,
+                             expected_doy, Checkpoint())
+        product = MaxNdviProduct()
+        product.prepare(self.worker)
+        window = Window(col_off=256, row_off=512, width=300, height=200)
+        product.start(window)
+        for i, g in enumerate(self.worker.granules):
+            if product.needs(i, g, window):
+                product.add(i, g, {key: g[key].read_window(window) for key in product.inputs()})
+        result = product.finish()
+        for i, band in enumerate(bands):
+            assert np.array_equal(result[band], expected[i][512:712, 256:556])
+        assert np.array_equal(result["DOY"], expected_doy[512:712, 256:556])
+
+    def test_doy_bins(self):
+        months = DoyBin.monthly(2020)
+        assert len(months) == 12 and months[1].end == 60 and months[2].start == 61 and months[11].end == 366
+        decades = DoyBin.every(10, end=365)
+        assert len(decades) == 37 and (decades[-1].start, decades[-1].end) == (361, 365)
+        products = temporal_products([MedianProduct()], months)
+        assert [p.name for p in products][:2] == ["median_01", "median_02"]
+        granule = self.worker.granules[0]
+        assert sum(p.accepts(granule) for p in products) == 1
+
+    def test_result_rgb_tiles(self, tmp_path):
+        profile = {"driver": "GTiff", "dtype": "uint16", "count": 1, "width": 610, "height": 610, "nodata": 0,
+                   "crs": "EPSG:32633", "transform": from_origin(600000, 5500000, 60, 60)}
+        rng = np.random.default_rng(3)
+        bands = ResultSink.rgb_bands
+        data = {band: rng.integers(1, 4096, size=(610, 610), dtype=np.uint16) for band in bands}
+        windows = [slice_window(5, sl, 610, 610) for sl in range(25)]  # 122 px, not aligned with the JPEG tiles
+
+        def rgb(name: str, order: list, **kwargs) -> np.ndarray:
+            sink = ResultSink(str(tmp_path / name), bands, profile, 60, "T33UXQ", **kwargs)
+            for band, window in order:
+                sink.write(band, data[band] if window is None else data[band][window.toslices()], window)
+            with rasterio.open(sink.close()["rgb"]) as src:
+                return src.read()
+
+        expected = rgb("whole", [(band, None) for band in bands])
+        #  channels of each window together, tiles are completed in flight
+        assert np.array_equal(rgb("windows", [(band, w) for w in windows for band in bands]), expected)
+        #  band by band over the buffer limit, tiles are read from the band files
+        assert np.array_equal(rgb("bands", [(band, w) for band in bands for w in windows], rgb_buffer_bytes=0),
+                              expected)
+
+    def test_mosaic_builder(self, tmp_path):
+        with rasterio.open(TestPipeline.granule["B02"].path) as src:
+            data, profile = src.read(1), src.profile.copy()
+        for key in ["blockxsize", "blockysize", "tiled", "compress"]:
+            profile.pop(key, None)
+        #  two results, left and right halves of the tile
+        paths = []
+        for name, columns in [("left", slice(0, 915)), ("right", slice(915, 1830))]:
+            transform = profile["transform"] * profile["transform"].translation(columns.start, 0)
+            profile.update(driver="GTiff", width=915, transform=transform)
+            os.mkdir(str(tmp_path / name))
+            paths.append(str(tmp_path / name / "B02_60.tif"))
+            with rasterio.open(paths[-1], "w", **profile) as dst:
+                dst.write(data[:, columns], 1)
+        result = MosaicBuilder(threads=2).build_all(str(tmp_path), {"B02": paths})
+        with rasterio.open(result["B02"]) as mosaic:
+            assert mosaic.profile["tiled"] and mosaic.compression.name.upper() == "DEFLATE"
+            assert np.array_equal(mosaic.read(1), data)
+        assert not os.path.exists(str(tmp_path / "B02_mosaic.vrt"))
+        vrt = MosaicBuilder(vrt_only=True).build_all(str(tmp_path), {"B02": paths})
+        with rasterio.open(vrt["B02"]) as mosaic:
+            assert np.array_equal(mosaic.read(1), data)
+
     """
     GRANULE
     """
@@ -83,6 +355,27 @@ class TestPipeline:
         assert type(TestPipeline.granule["B04"]) == Band
         assert type(TestPipeline.granule["B02"]) == Band
 
+    def test_in_memory_result(self, tmp_path):
+        profile = {"driver": "GTiff", "dtype": "uint16", "count": 1, "width": 512, "height": 512, "nodata": 0,
+                   "crs": "EPSG:32633", "transform": from_origin(600000, 5500000, 60, 60)}
+        path = str(tmp_path / "result")
+        sink = ResultSink(path, ["B02", "DOY"], profile, 60, "T33UXQ", in_memory=True)
+        data = np.arange(512 * 512, dtype=np.uint16).reshape(512, 512)
+        window = Window(col_off=0, row_off=256, width=512, height=256)
+        sink.write("B02", data[256:], window)
+        sink.write("DOY", np.full((512, 512), 100))
+        assert sink.close() == {} and not os.path.exists(path)
+        granule = sink.result(["B02", "rgb"])
+        assert granule.in_memory and granule.get_initialized_bands() == ["B02"]
+        assert np.array_equal(granule["B02"].read_window(window), data[256:])
+        assert not granule.block_index().has_data(Window(col_off=0, row_off=0, width=512, height=128))
+        granule.free_resources()  # nothing to reload the data from, they are kept
+        assert granule["B02"].raster()[0, 0] == 0
+        granule.persist()
+        assert not granule.in_memory
+        with rasterio.open(granule["B02"].path) as src:
+            assert np.array_equal(src.read(1)[256:], data[256:])
+
     """
     BANDS
     """
@@ -91,6 +384,70 @@ class TestPipeline:
         TestPipeline.granule["B03"].load_raster()
         assert type(TestPipeline.granule["B03"].raster()) == numpy.ndarray
 
+    def test_block_index(self):
+        index = TestPipeline.granule.block_index()
+        #  Cached on the granule
+        assert index is TestPipeline.granule.block_index()
+        assert index.valid.shape == (1830, 1830)
+        with rasterio.open(TestPipeline.granule["SCL"].path) as dataset:
+            scl = dataset.read(1)
+        assert index.has_data() == bool((scl > 0).any())
+        assert 0 <= index.valid_fraction() <= 1
+
+    def test_cog_output_profile(self, tmp_path):
+        data = (np.arange(1830 * 1830) % 4096).astype(np.uint16).reshape(1830, 1830)
+        path = OutputProfile.cog().write(data, str(tmp_path / "B02"), TestPipeline.granule["B02"].profile)
+        assert path.endswith(".tif")
+        with rasterio.open(path) as dataset:
+            assert dataset.profile["tiled"]
+            assert dataset.compression.name.upper() == "DEFLATE"
+            assert dataset.overviews(1) == [2, 4, 8, 16, 32]
+            assert np.array_equal(dataset.read(1), data)
+        #  the temporary GeoTIFF is removed
+        assert os.listdir(str(tmp_path)) == ["B02.tif"]
+
+    def test_index_engine(self):
+        granule = TestPipeline.granule
+        granule.temp.clear()
+        result = S2IndexEngine.compute(granule, ["NDVI"], rows_per_block=100)
+        assert result["NDVI"].dtype == np.float64
+        expected = ndvi(red=granule["B04"].raster().astype(float), nir=granule["B8A"].raster().astype(float))
+        assert np.allclose(result["NDVI"], expected)
+        #  Cached
+        assert S2IndexEngine.compute(granule, ["NDVI"])["NDVI"] is result["NDVI"]
+        #  Compact policy computes float32, the cached float64 result is not reused
+        set_precision(PrecisionPolicy.compact())
+        try:
+            compact = S2IndexEngine.compute(granule, ["NDVI"])["NDVI"]
+            assert compact.dtype == np.float32 and np.allclose(compact, expected, atol=1e-6)
+        finally:
+            set_precision(PrecisionPolicy.legacy())
+        #  Streamed from the files, the bands are not loaded
+        granule.temp.clear()
+        granule["B04"].free_resources()
+        granule["B8A"].free_resources()
+        streamed = S2IndexEngine.compute(granule, ["NDVI"], rows_per_block=100)["NDVI"]
+        assert np.allclose(streamed, expected)
+        assert not granule["B04"].is_loaded() and not granule["B8A"].is_loaded()
+        granule.temp.clear()
+
+    def test_band_expression(self):
+        granule = TestPipeline.granule
+        b02, b8a = granule["B02"].raster(), granule["B8A"].raster()
+        expected = (b02 > 100) & ~(b8a >= 8000)
+        expression = (granule.expr("B02") > 100) & ~(granule.expr("B8A") >= 8000)
+        assert np.array_equal(expression.evaluate(), expected)
+        #  Streamed from the files
+        granule["B02"].free_resources()
+        granule["B8A"].free_resources()
+        assert np.array_equal(expression.evaluate(rows_per_block=500), expected)
+        ratio = (granule.expr("B8A") / granule.expr("B02")).evaluate()
+        assert ratio.dtype == np.float32
+        assert np.allclose(ratio, np.divide(b8a, b02, out=np.zeros(b02.shape), where=b02 != 0), rtol=1e-6)
+        #  non-finite constants are numpy constants in the kernel
+        assert (granule.expr("B02") < float("inf")).evaluate().all()
+        assert not (granule.expr("B02") == float("nan")).evaluate().any()
+
     """
     JIT-ed computations
     """
@@ -134,6 +491,104 @@ class TestPipeline:
         assert np.array_equal(doy, expected_doy)
         assert np.array_equal(ndvi_current_max, ndvi[1])  # TEST IF THE CURRENT MAX NDVI HAS BEEN CHANGED AS WELL
 
+    def test_best_pixel_engine(self):
+        data = [np.full((2, 2, 2), 10, dtype=np.uint16), np.full((2, 2, 2), 20, dtype=np.uint16)]
+        data[1][:, 1, 1] = 0  # no data, never picked
+        features = [{"B8A": np.full((2, 2), 3000), "B04": np.full((2, 2), 1000)},
+                    {"B8A": np.array([[4000, 3000], [2000, 4000]]), "B04": np.full((2, 2), 1000)}]
+        engine = BestPixelEngine(Scorers.NDVI, 2, (2, 2))
+        engine.add(data, features, [100, 120])
+        assert np.array_equal(engine.result[0], [[20, 20], [10, 10]])  # [0, 1] is a tie, the latest wins
+        assert np.array_equal(engine.doy, [[120, 120], [100, 100]])
+        assert engine.quality()[1, 0] == 15000  # NDVI 0.5
+        first = BestPixelEngine(Scorers.NDVI, 2, (2, 2), tie="first")
+        first.add(data, features, [100, 120])
+        assert first.doy[0, 1] == 100
+        closest = BestPixelEngine(Scorers.DOY_DISTANCE, 2, (2, 2), params=(105,))
+        closest.add(data, [{}, {}], [100, 120])
+        assert np.array_equal(closest.doy, [[100, 100], [100, 100]])
+        #  Same name, different function, the kernel of the first scorer must not be reused
+        farthest = BestPixelEngine(Scorer(Scorers.DOY_DISTANCE.name, farthest_score), 2, (2, 2), params=(105,))
+        farthest.add(data, [{}, {}], [100, 120])
+        assert farthest.doy[0, 0] == 120
+
+    def test_radix_quantile(self):
+        rng = np.random.default_rng(0)
+        data = rng.integers(0, 10000, size=(7, 8, 8), dtype=np.uint16)
+        data[:3, 0, 0] = 0  # no data
+        valid = np.ones((8, 8), dtype=np.bool_)
+        quantiles = [0.25, 0.5, 0.75]
+        counts = np.zeros((8, 8), dtype=np.uint16)
+        coarse = np.zeros((8, 8, 256), dtype=np.uint16)
+        for block in data:
+            S2JIT.s2_histogram_coarse(block, valid, coarse, counts)
+        bins = np.empty((3, 8, 8), dtype=np.int64)
+        rest = np.empty((3, 8, 8), dtype=np.int64)
+        for j, q in enumerate(quantiles):
+            S2JIT.s2_histogram_rank(coarse, np.floor(q * (counts.astype(np.int64) - 1)).astype(np.int64), bins[j],
+                                    rest[j])
+        fine = np.zeros((3, 8, 8, 256), dtype=np.uint16)
+        for block in data:
+            S2JIT.s2_histogram_fine(block, valid, bins, fine)
+        low = np.empty((8, 8), dtype=np.int64)
+        for j, q in enumerate(quantiles):
+            S2JIT.s2_histogram_rank(fine[j], rest[j], low, np.empty((8, 8), dtype=np.int64))
+            for y, x in [(0, 0), (3, 5), (7, 7)]:
+                observations = data[:, y, x][data[:, y, x] != 0]
+                assert (bins[j, y, x] << 8 | low[y, x]) == lower_quantile(observations, q)
+        #  no dots in the names of the files
+        assert QuantilePerPixel.names((0.25, 1 / 3, 0.999)) == ["Q25", "Q33_3", "Q99_9"]
+        with pytest.raises(ValueError):
+            QuantilePerPixel.perform_computation(S2Worker(TestPipeline.path, 60, output_bands=["SCL"]))
+
+    def test_medoid(self):
+        rng = np.random.default_rng(1)
+        data = rng.integers(1, 10000, size=(6, 3, 5, 5), dtype=np.uint16)
+        data[2, 1, 0, 0] = 0  # no data in one band
+        valid = np.ones((6, 5, 5), dtype=np.bool_)
+        valid[0, 4, 4] = False
+        doys = np.arange(10, 70, 10, dtype=np.int64)
+        result = np.zeros((3, 5, 5), dtype=np.uint16)
+        doy = np.zeros((5, 5), dtype=np.uint16)
+        S2JIT.s2_medoid(data, valid, np.array([0, 1, 2]), doys, result, doy)
+        for y, x in [(0, 0), (2, 3), (4, 4)]:
+            candidates = [i for i in range(6) if valid[i, y, x] and (data[i, :, y, x] != 0).all()]
+            pixels = data[candidates, :, y, x].astype(np.float64)
+            sums = np.sqrt(((pixels[:, None] - pixels[None]) ** 2).sum(axis=2)).sum(axis=1)
+            best = candidates[int(np.argmin(sums))]
+            assert (result[:, y, x] == data[best, :, y, x]).all()
+            assert doy[y, x] == doys[best]
+
+    def test_coarse_mask(self):
+        rng = np.random.default_rng(2)
+        for coarse, fine in [((3, 3), (12, 12)), ((3, 4), (7, 9))]:
+            mask = CoarseMask(rng.random(coarse, dtype=np.float32), fine)
+            assert np.array_equal(mask.materialize(), upsample_nearest(mask.data, fine))
+        # lazy kernel picks the same pixels as the kernel with the up-sampled masks
+        data = rng.integers(1, 10000, size=(4, 2, 12, 12), dtype=np.uint16)
+        masks = [CoarseMask(rng.random((3, 3), dtype=np.float32), (12, 12)) for _ in range(4)]
+        masks[1].data[0, 0] = 255
+        results = []
+        for lazy in [False, True]:
+            result = np.ones((2, 12, 12), dtype=np.uint16)
+            doy = np.zeros((12, 12), dtype=np.uint16)
+            final_mask = np.full((12, 12), 255, dtype=np.float64)
+            current_data, current_masks, rows, cols, doys = LIST(), LIST(), LIST(), LIST(), LIST()
+            for i, mask in enumerate(masks):
+                current_data.append(data[i])
+                current_masks.append(mask.data if lazy else mask.materialize())
+                rows.append(mask.rows)
+                cols.append(mask.cols)
+                doys.append(10 * (i + 1))
+            if lazy:
+                S2JIT.s2_cloud_probability_analysis_coarse(current_data, current_masks, rows, cols, doys, result, doy,
+                                                           final_mask)
+            else:
+                S2JIT.s2_cloud_probability_analysis(current_data, current_masks, doys, result, doy, final_mask)
+            results.append((result, doy, final_mask))
+        for a, b in zip(*results):
+            assert np.array_equal(a, b)
+
     """
     DETECTORS
     """
@@ -151,3 +606,23 @@ class TestPipeline:
         #  No cloud test
         TestPipeline.granule.bands[60]["SCL"].raster_image = c * 0 + 3
         assert 0 == S2Detectors.scl(TestPipeline.granule).sum()
+
+    def test_scl_classifier(self):
+        """
+        LUT classifier with default weights has to agree with the SCL detector.
+        """
+        with rasterio.open(TestPipeline.granule["SCL"].native_path) as dataset:
+            scl = dataset.read(1)
+        #  same weights as S2Detectors.scl
+        detector = lambda block: ((block > 7) & (block < 11)) | (block < 1) * 10
+        expected = detector(scl)
+        classifier = SCLClassifier()
+        assert np.allclose(classifier.cloud_fractions(TestPipeline.granule), [expected.sum() / expected.size])
+        assert np.array_equal(classifier.clear(scl), expected == 0)
+        windowed = GranuleCalculator.s2_pertile_cloud_index_windowed(TestPipeline.granule, "SCL", detector)
+        assert np.allclose(windowed, [expected.sum() / expected.size])
+        #  Custom weights, everything but no data is cloudy
+        classifier = SCLClassifier(weights={i: 1 for i in range(1, 12)})
+        assert np.allclose(classifier.cloud_fractions(TestPipeline.granule), [(scl > 0).sum() / scl.size])
+        with pytest.raises(ValueError):
+            SCLClassifier(weights={8: 0.5})
@@ -1,7 +1,12 @@
+import multiprocessing
 import os
 import pytest
 from Pipeline.utils import *
 from Pipeline.Granule import S2Granule
+from Pipeline.Indices import ndvi_mask
+from Pipeline.Runtime import RuntimeConfig
+from Pipeline.Precision import PrecisionPolicy
+from Pipeline.Prefetch import Prefetcher
 import numpy as np
 from xml.etree import ElementTree  # xml
 import pathlib
@@ -71,6 +76,23 @@ class TestUtils:
             arr = slice_raster(TestUtils.supported[i], arr)
             assert arr.shape == expected[i]
 
+    def test_slice_window(self):
+        arr = np.arange(90 * 90).reshape(90, 90)
+        for index in [5, 10, 15, 18, 45]:
+            sliced = slice_raster(index, arr)
+            for sl in range(index ** 2):
+                rows, cols = slice_window(index, sl, 90, 90).toslices()
+                assert np.array_equal(arr[rows, cols], sliced[sl])
+
+    def test_upsample_nearest(self):
+        image = np.arange(6).reshape(2, 3)
+        #  Integer factor, block replication
+        assert np.array_equal(upsample_nearest(image, (4, 6)), np.kron(image, np.ones(shape=(2, 2), dtype=int)))
+        #  Non-integer factor, shape and values are kept
+        res = upsample_nearest(image, (5, 7))
+        assert res.shape == (5, 7)
+        assert res[0, 0] == image[0, 0] and res[-1, -1] == image[-1, -1]
+
     def test_found_bands_spatial_res(self):
         """
         Tests whether the intervals are correct
@@ -113,3 +135,65 @@ class TestUtils:
         third = np.array([1, 2, 3, 4, 5, 6])
         assert np.array_equal(ndvi(first, second), second.astype(float))
         assert np.allclose(ndvi(second, third), np.array([0, 1/3, 0.5, 3/5, 2/3, 5/7], dtype=float), atol=0.0001)
+
+    def test_ndvi_mask(self):
+        bands = {"B02": np.array([200, 50, 200]), "B04": np.array([200, 200, 200]),
+                 "B8A": np.array([1000, 1000, 1000])}
+        assert np.array_equal(ndvi_mask(bands), [True, False, True])
+        #  AOT is optional
+        bands["AOT"] = np.array([50, 50, 150])
+        assert np.array_equal(ndvi_mask(bands), [True, False, False])
+
+    def test_stretch_lut(self):
+        values = np.array([[0, 1, 100, 2730], [2731, 4096, 10000, 65535]], dtype=np.uint16)
+        lut = stretch_lut(1.5, 0, 4096)
+        expected = rescale_intensity(values * 1.5, 0, 4096)
+        assert np.array_equal(lut[values], expected)
+        stretched = apply_lut(np.stack([values, values]), lut)
+        assert stretched.dtype == np.uint8
+        assert np.array_equal(stretched[1], expected)
+        #  Gamma only changes the middle of the range
+        gamma = stretch_lut(1.0, 0, 4096, 0.5)
+        assert gamma[0] == 0 and gamma[4096] == 255 and gamma[1024] > lut[683]
+
+    def test_temp_cache_eviction(self):
+        cache = TempCache(max_bytes=250)
+        cache["A"] = np.zeros(100, dtype=np.uint8)
+        cache["B"] = np.zeros(100, dtype=np.uint8)
+        assert cache["A"] is not None  # A is now the most recently used
+        cache["C"] = np.zeros(100, dtype=np.uint8)
+        assert list(cache.keys()) == ["A", "C"]
+        #  Entry bigger than the budget is kept alone
+        cache["D"] = np.zeros(1000, dtype=np.uint8)
+        assert list(cache.keys()) == ["D"]
+
+    def test_runtime_budget(self):
+        config = RuntimeConfig(threads=8, workers=3)
+        assert config.worker_threads == 2
+        assert config.pool_size(10) == 2 and config.pool_size(1) == 1 and config.pool_size() == 2
+        #  More workers than threads still leaves every worker one thread
+        assert RuntimeConfig(threads=2, workers=4).worker_threads == 1
+        #  Share of the scheduler's job grows as the other jobs finish
+        config.running = multiprocessing.Value("i", 2)
+        assert config.worker_threads == 4
+        config.running.value = 1
+        assert config.pool_size() == 8
+
+    def test_precision_policy(self):
+        compact, legacy = PrecisionPolicy.compact(), PrecisionPolicy.legacy()
+        probability = np.array([[0.0, 0.234], [0.5, 1.0]])
+        assert np.array_equal(compact.cloud_mask(probability, True), np.array([[0, 23], [50, 100]], dtype=np.uint8))
+        assert compact.cloud_mask(np.array([0, 1]), False).dtype == np.uint8
+        assert legacy.cloud_mask(probability, True).dtype == np.float64
+        data = np.array([0, 5000, 10000], dtype=np.uint16)
+        assert compact.scale_reflectance(data).dtype == np.float32
+        assert np.allclose(compact.scale_reflectance(data), legacy.scale_reflectance(data))
+        #  legacy is the default
+        assert ndvi(np.array([1, 2]), np.array([3, 2])).dtype == np.float64
+
+    def test_prefetcher(self):
+        assert list(Prefetcher(range(10), lambda x: x * 2, depth=3)) == [x * 2 for x in range(10)]
+        #  Items in flight have to fit into the memory
+        assert Prefetcher([], lambda x: x, depth=3, item_bytes=100, max_bytes=150).depth == 1
+        no_prefetch = Prefetcher(range(3), lambda x: x, depth=3, item_bytes=100, max_bytes=50)
+        assert no_prefetch.depth == 0 and list(no_prefetch) == [0, 1, 2]